@@ -1,211 +1,296 @@
+import os
 import time
+import concurrent.futures
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from server.entities.docindex import DocumentIndex
+from server.entities.searchindex import search_index
+from server.entities.docstore import DISPLAY_FIELDS
 from server.functions.rank import calculate_bm25
-from server.entities.lexicon import Lexicon
-from server.functions.autosuggest import Autosuggestion
 from server.lib.utils import preprocess_text
+from server.lib.analyzer import analyze_query
 import json
-from fuzzywuzzy import fuzz, process
 from flask import request, jsonify
-from server.functions.addcontent import AddContent
+from server.functions.addcontent import AddContent, start_bulk_pool
+from server.lib.cache import positions_cache, postings_cache
 
-lexicon = Lexicon().lexicon
-words_list = list(lexicon.keys())
-auto = Autosuggestion(words_list)
+# number of results returned by /search
+SEARCH_RESULTS = 50
+# searches scored at once, other requests keep their threads while searches queue here
+SEARCH_WORKERS = os.cpu_count()
+# seconds a search may wait for and spend in scoring before it is given up with a 503
+SEARCH_TIMEOUT = 30
+# number of corrections returned by /typos
+TYPO_SUGGESTIONS = 5
+# fields every added document must have
+ADD_REQUIRED_FIELDS = ['title', 'abstract', 'keywords', 'venue', 'year']
 
-with DocumentIndex() as doc_index:
+# open everything a search needs once, shared by every route
+start = time.time()
+search_index.open()
+search_index.report()
+print(f"Server startup took {time.time() - start:.4} seconds")
+# bulk adds preprocess in worker processes forked now, before any request thread
+start_bulk_pool()
 
-    app = Flask(__name__)
-    CORS(app)
+scoring_executor = concurrent.futures.ThreadPoolExecutor(SEARCH_WORKERS, thread_name_prefix="scoring")
 
-    @app.route('/search')
-    def search():
-        totalStart = time.time()
-        try:
-            query = request.args.get('q', '')
-            if not query:
-                return jsonify({"error": "No query provided"}), 400
-
-            query_terms = preprocess_text(query).split(" ")
-
-            start = time.time()
-            results, logs = calculate_bm25(query_terms, len(lexicon))
-            end = time.time()
-            print(f"BM25 calculation took {end - start:.4} seconds")
-
-            formatted_results = []
-            
-            start = time.time()
-            # Simply use the global instance directly
-            doc_ids = [doc_id for doc_id, _ in results][:50]
-            documents = doc_index.get_documents(doc_ids)
-            
-            for (doc_id, score), doc in zip(results, documents):
-                if doc:
-                    formatted_results.append({
-                        "doc_id": doc_id,
-                        "score": score, 
-                        "title": doc['title'],
-                        "abstract": doc['abstract'],
-                        "keywords": doc['keywords'],
-                        "year": doc['year'],
-                        "venue": doc['venue'],
-                        "citations": doc['n_citation'],
-                        "url": doc['url']
-                    })
-            end = time.time()
-
-            totalEnd = time.time()
-            print(f"Document retrieval took {end - start:.4} seconds")
-
-            print(f"Total time is {totalEnd - totalStart:.4} seconds")
+app = Flask(__name__)
+CORS(app)
 
-            return jsonify({
-                "results_count": len(results),
-                "query": " ".join(query_terms),
-                "results": formatted_results[:50]
-            }), 200
+@app.route('/search')
+def search():
+    totalStart = time.time()
+    try:
+        query = request.args.get('q', '')
+        if not query:
+            return jsonify({"error": "No query provided"}), 400
 
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
+        query_terms = analyze_query(query).split(" ")
+        original_terms = query_terms
+        corrections = []
+        # unknown and rare terms are searched as their likely spelling unless ?spellcheck=0
+        if request.args.get('spellcheck', '1') != '0':
+            query_terms, corrections = search_index.spelling.rewrite(query_terms)
 
-    @app.route('/typos')
-    def suggest():
+        start = time.time()
+        scoring = scoring_executor.submit(calculate_bm25, query_terms, len(search_index.lexicon), top_k=SEARCH_RESULTS)
         try:
-            query = request.args.get('q', '')
-            if not query:
-                return jsonify({"error": "No query provided"}), 400
-            matches = process.extract(
-                    query,
-                    words_list,
-                    scorer=fuzz.ratio,
-                    limit=5,
-                    score_cutoff=70
-                )
-            
+            results, logs = scoring.result(timeout=SEARCH_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            scoring.cancel()
+            return jsonify({"error": "Search timed out, try again"}), 503
+        end = time.time()
+        print(f"BM25 calculation took {end - start:.4} seconds")
+
+        formatted_results = []
+        
+        start = time.time()
+        # Simply use the global instance directly
+        ordinals = [ordinal for ordinal, _ in results][:SEARCH_RESULTS]
+        # only the rendered fields, straight from the compressed docstore
+        documents = search_index.documents.get_documents(ordinals, fields=DISPLAY_FIELDS)
+        # results carry doc ordinals, external ids are only needed in the response
+        doc_ids = search_index.doc_map.doc_ids(ordinals)
+        
+        for (_, score), doc_id, doc in zip(results, doc_ids, documents):
+            if doc:
+                formatted_results.append({
+                    "doc_id": doc_id,
+                    "score": score, 
+                    "title": doc['title'],
+                    "abstract": doc['abstract'],
+                    "keywords": doc['keywords'],
+                    "year": doc['year'],
+                    "venue": doc['venue'],
+                    "citations": doc['n_citation'],
+                    "url": doc['url']
+                })
+        end = time.time()
+
+        totalEnd = time.time()
+        print(f"Document retrieval took {end - start:.4} seconds")
+
+        print(f"Total time is {totalEnd - totalStart:.4} seconds")
+
+        return jsonify({
+            # the results returned, at most SEARCH_RESULTS: top-k retrieval never visits
+            # every matching document, so how many there are is not known
+            "results_count": len(results),
+            "query": " ".join(query_terms),
+            "original_query": " ".join(original_terms),
+            "corrections": [{"term": term, "correction": correction} for term, correction in corrections],
+            "results": formatted_results[:SEARCH_RESULTS]
+        }), 200
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/typos')
+def suggest():
+    try:
+        query = request.args.get('q', '')
+        if not query:
+            return jsonify({"error": "No query provided"}), 400
+        # closest frequent words by edit distance, then by how often they occur
+        matches = search_index.spelling.suggest(query.strip(), TYPO_SUGGESTIONS)
+
+        return jsonify({
+            "matches": matches
+        }), 200
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/test')
+def test():
+    return jsonify({"message": "Hello World!"}), 200
+
+@app.route('/stats')
+def stats():
+    return jsonify({"postings_cache": postings_cache.stats(),
+                    "positions_cache": positions_cache.stats(),
+                    "segments": search_index.segments.stats(),
+                    "index_load_times": search_index.timings}), 200
+
+@app.route('/autocomplete')
+def autocomplete():
+    try:
+        query = request.args.get('q', '')
+        if not query:
+            return jsonify({"error": "No query provided"}), 400
+        
+        query_terms=  query.split(" ")
+        query_term = analyze_query(query_terms[-1])
+        print("this is the query term", query_term)
+
+        if(query_term == ""):
             return jsonify({
-                "matches": [word for word, _, _ in matches]
+                "suggestions": []
             }), 200
-        except Exception as e:
-            return jsonify({"error": str(e)}), 500
-
-    @app.route('/test')
-    def test():
-        return jsonify({"message": "Hello World!"}), 200
 
-    @app.route('/autocomplete')
-    def autocomplete():
-        try:
-            query = request.args.get('q', '')
-            if not query:
-                return jsonify({"error": "No query provided"}), 400
-            
-            query_terms=  query.split(" ")
-            query_term = preprocess_text(query_terms[-1])
-            print("this is the query term", query_term)
-
-            if(query_term == ""):
-                return jsonify({
-                    "suggestions": []
-                }), 200
-
-            suggestions = auto.suggest(query_term)
-            print(query_term, suggestions)
-            # print(query_terms)
-            if(len(query_terms) == 1):
-                return jsonify({
-                    "suggestions": suggestions
-                }), 200
-            print("hahaahahah")
-            # join each suggestion with the remaining query terms and return
-            suggestions = [" ".join(query_terms[:-1] + [suggestion]) for suggestion in suggestions]
-            print(suggestions)
+        suggestions = search_index.autosuggest.suggest(query_term)
+        print(query_term, suggestions)
+        # print(query_terms)
+        if(len(query_terms) == 1):
             return jsonify({
                 "suggestions": suggestions
             }), 200
-        except Exception as e:
-            print(e)
-            return jsonify({"error": str(e)}), 500
-    
-
-    preprocess_test = preprocess_text("This is a test")
-    @app.route('/preprocess', methods=['POST'])
-    def preprocess_document():
-        try:
-            # Get request payload
-            doc = request.get_json()
-            if not doc:
-                return jsonify({
-                    "error": "No data provided or invalid JSON",
-                    "success": False
-                }), 400
-            required_fields = ['title', 'abstract', 'keywords']
-            print(doc['keywords'])
+        print("hahaahahah")
+        # join each suggestion with the remaining query terms and return
+        suggestions = [" ".join(query_terms[:-1] + [suggestion]) for suggestion in suggestions]
+        print(suggestions)
+        return jsonify({
+            "suggestions": suggestions
+        }), 200
+    except Exception as e:
+        print(e)
+        return jsonify({"error": str(e)}), 500
+
+
+preprocess_test = preprocess_text("This is a test")
+@app.route('/preprocess', methods=['POST'])
+def preprocess_document():
+    try:
+        # Get request payload
+        doc = request.get_json()
+        if not doc:
             return jsonify({
-                "title": preprocess_text(doc['title']),
-                "abstract": preprocess_text(doc['abstract']),
-                "keywords": preprocess_text(" ".join(doc['keywords'])),
-                "success": True
-            }), 200
-        except ValueError as ve:
-            print("ValueError", ve)
+                "error": "No data provided or invalid JSON",
+                "success": False
+            }), 400
+        required_fields = ['title', 'abstract', 'keywords']
+        print(doc['keywords'])
+        return jsonify({
+            "title": preprocess_text(doc['title']),
+            "abstract": preprocess_text(doc['abstract']),
+            "keywords": preprocess_text(" ".join(doc['keywords'])),
+            "success": True
+        }), 200
+    except ValueError as ve:
+        print("ValueError", ve)
+        return jsonify({
+            "error": f"Invalid input: {str(ve)}",
+            "success": False
+        }), 400
+    except Exception as e:
+        print("Exception", e)
+        return jsonify({
+            "error": f"Server error: {str(e)}",
+            "success": False
+        }), 500
+
+@app.route('/add', methods=['POST'])
+def add_document():
+    try:
+        # Get request payload
+        doc = request.get_json()
+        if not doc:
             return jsonify({
-                "error": f"Invalid input: {str(ve)}",
+                "error": "No data provided or invalid JSON",
                 "success": False
             }), 400
-        except Exception as e:
-            print("Exception", e)
+        # Validate required fields
+        missing_fields = [field for field in ADD_REQUIRED_FIELDS if field not in doc]
+        
+        if missing_fields:
             return jsonify({
-                "error": f"Server error: {str(e)}",
+                "error": f"Missing required fields: {', '.join(missing_fields)}",
+                "success": False
+            }), 400
+        # AddContent works on the shared index, so searches see the document at once
+        adder = AddContent(search_index)
+        success = adder.add_document(doc)
+        if success:
+            return jsonify({
+                "message": "Document added successfully",
+                "success": True
+            }), 200
+        else:
+            return jsonify({
+                "message": "Failed to add document",
                 "success": False
             }), 500
+    except ValueError as ve:
+        print("ValueError", ve)
+        return jsonify({
+            "error": f"Invalid input: {str(ve)}",
+            "success": False
+        }), 400
+    except Exception as e:
+        print("Exception", e)
+        return jsonify({
+            "error": f"Server error: {str(e)}",
+            "success": False
+        }), 500
 
-    @app.route('/add', methods=['POST'])
-    def add_document():
-        try:
-            # Get request payload
-            doc = request.get_json()
-            if not doc:
-                return jsonify({
-                    "error": "No data provided or invalid JSON",
-                    "success": False
-                }), 400
-            # Validate required fields
-            required_fields = ['title', 'abstract', 'keywords', 'venue', 'year']
-            missing_fields = [field for field in required_fields if field not in doc]
-            
-            if missing_fields:
-                return jsonify({
-                    "error": f"Missing required fields: {', '.join(missing_fields)}",
-                    "success": False
-                }), 400
-            # Initialize AddContent and add document
-            adder = AddContent()
-            success = adder.add_document(doc)
-            if success:
-                return jsonify({
-                    "message": "Document added successfully",
-                    "success": True
-                }), 200
-            else:
-                return jsonify({
-                    "message": "Failed to add document",
-                    "success": False
-                }), 500
-        except ValueError as ve:
-            print("ValueError", ve)
+def parse_documents(body):
+    """Documents of a bulk request, a JSON array or one JSON object per line"""
+    body = body.strip()
+    if body.startswith('['):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+@app.route('/add/bulk', methods=['POST'])
+def add_documents():
+    try:
+        docs = parse_documents(request.get_data(as_text=True))
+        if not docs:
             return jsonify({
-                "error": f"Invalid input: {str(ve)}",
+                "error": "No documents provided",
                 "success": False
             }), 400
-        except Exception as e:
-            print("Exception", e)
+        # the whole batch is rejected if any document is invalid, nothing is half ingested
+        invalid = [i for i, doc in enumerate(docs)
+                   if not isinstance(doc, dict) or any(field not in doc for field in ADD_REQUIRED_FIELDS)]
+        if invalid:
+            return jsonify({
+                "error": f"Documents missing required fields ({', '.join(ADD_REQUIRED_FIELDS)}): {invalid[:20]}",
+                "success": False
+            }), 400
+        added = AddContent(search_index).add_documents(docs)
+        if added:
+            return jsonify({
+                "message": f"{added} documents added successfully",
+                "added": added,
+                "success": True
+            }), 200
+        else:
             return jsonify({
-                "error": f"Server error: {str(e)}",
+                "message": "Failed to add documents",
+                "added": 0,
                 "success": False
             }), 500
+    except ValueError as ve:
+        print("ValueError", ve)
+        return jsonify({
+            "error": f"Invalid input: {str(ve)}",
+            "success": False
+        }), 400
+    except Exception as e:
+        print("Exception", e)
+        return jsonify({
+            "error": f"Server error: {str(e)}",
+            "success": False
+        }), 500
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
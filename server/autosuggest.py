@@ -65,7 +65,7 @@ class Autosuggestion:
 def main():
     # Sample lexicon
     
-    words_list = list(Lexicon().lexicon.keys())
+    words_list = Lexicon().words()
     
     # Initialize autosuggestion
     auto = Autosuggestion(words_list)
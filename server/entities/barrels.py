@@ -1,13 +1,279 @@
 import os
 import json
 import hashlib
+import itertools
+import mmap
+import struct
 import time
 import ijson
+import numpy as np
+from server.lib.cache import positions_cache, postings_cache
+from server.lib.codec import BLOCK_SIZE, EncodedPostings, PostingsEncoder
+from server.lib.bm25 import max_tf_score
 
 
 BARREL_SIZE_THRESHOLD = 2 * 1024 * 1024  # Define the threshold size for barrels
 
+# Binary barrel layout (little-endian):
+#   header       magic, term_count, avg_doc_length
+#   word_ids     u4[term_count]          sorted, for binary search
+#   dfs          u4[term_count]
+#   offsets      u4[term_count + 1]      byte range of each term's encoded postings
+#   max_scores   f8[term_count]          max tf score of each term at avg_doc_length
+#   postings     posting lists encoded by server/lib/codec.py
+# Postings refer to documents by their ordinal in the doc map (server/entities/docmap.py).
+BINARY_BARREL_MAGIC = b"BRL3"
+BINARY_BARREL_HEADER = struct.Struct("<4sId")
+
+
+def match_ordinals(ordinals, wanted):
+    """Indexes of the wanted ordinals found in the sorted ordinals, and the rows they are found at"""
+    rows = np.searchsorted(ordinals, wanted)
+    if not len(ordinals):
+        return np.zeros(0, dtype=np.int64), rows[:0]
+    found = np.flatnonzero(ordinals[np.minimum(rows, len(ordinals) - 1)] == wanted)
+    return found, rows[found]
+
+
+class BarrelPostings:
+    """
+    Columnar view over the postings of a single term, sorted by doc ordinal.
+    max_score bounds the tf score of the postings, computed at avg_doc_length.
+    """
+
+    def __init__(self, ordinals, frequencies, lengths, pos_starts, positions, max_score=None, avg_doc_length=None):
+        self.ordinals = ordinals
+        self.frequencies = frequencies
+        self.lengths = lengths
+        self.pos_starts = pos_starts
+        self.positions = positions
+        self.max_score = max_score
+        self.avg_doc_length = avg_doc_length
+
+    def __len__(self):
+        return len(self.ordinals)
+
+    def get_positions(self, i):
+        return self.positions[self.pos_starts[i]:self.pos_starts[i + 1]].tolist()
+
+    def lookup(self, ordinals):
+        """
+        Postings of the given sorted doc ordinals, as the indexes of the ordinals
+        found and their rows, frequencies and lengths.
+        """
+        found, rows = match_ordinals(self.ordinals, ordinals)
+        return found, rows, self.frequencies[rows], self.lengths[rows]
+
+    def upper_bound(self, avg_doc_length):
+        """Upper bound of the tf score of any posting at the given average document length."""
+        if self.max_score is None:
+            self.max_score = max_tf_score(self.frequencies.tolist(), self.lengths.tolist(), avg_doc_length)
+            self.avg_doc_length = avg_doc_length
+        if not self.avg_doc_length:
+            return self.max_score
+        # a larger average can only shrink the length norm, by at most the ratio of the averages
+        return self.max_score * max(1.0, avg_doc_length / self.avg_doc_length)
+
+    @property
+    def nbytes(self):
+        return (self.ordinals.nbytes + self.frequencies.nbytes + self.lengths.nbytes +
+                self.pos_starts.nbytes + self.positions.nbytes)
+
+    def copy(self):
+        """Copy the columns out of the barrel mmap so they stay resident."""
+        return BarrelPostings(self.ordinals.copy(), self.frequencies.copy(), self.lengths.copy(),
+                              self.pos_starts.copy(), self.positions.copy(), self.max_score, self.avg_doc_length)
+
+    def to_json(self):
+        """Postings as JSON barrel posting dicts, the inverse of from_json."""
+        return [{"doc_id": ordinal, "frequency": frequency, "positions": self.get_positions(i), "doc_length": length}
+                for i, (ordinal, frequency, length) in
+                enumerate(zip(self.ordinals.tolist(), self.frequencies.tolist(), self.lengths.tolist()))]
+
+    @classmethod
+    def from_json(cls, postings):
+        """Convert a list of JSON barrel postings into columnar form."""
+        postings = sorted(postings, key=lambda posting: posting["doc_id"])
+        pos_starts = [0]
+        positions = []
+        for posting in postings:
+            positions.extend(posting.get("positions", []))
+            pos_starts.append(len(positions))
+        return cls(
+            np.array([posting["doc_id"] for posting in postings], dtype=np.int64),
+            np.array([posting["frequency"] for posting in postings], dtype=np.uint32).reshape(-1, 3),
+            np.array([posting.get("doc_length", posting.get("length", 0)) for posting in postings], dtype=np.uint32),
+            np.array(pos_starts, dtype=np.uint32),
+            np.array(positions, dtype=np.uint32),
+        )
+
+
+# tells apart the instances whose blocks share positions_cache
+_postings_keys = itertools.count()
+
+
+class CompressedPostings(BarrelPostings):
+    """
+    Postings decoded from a binary barrel. Ordinals, frequencies and lengths of
+    the whole list are decoded on first use; lookups before that decode only the
+    blocks the skip table points them to, and positions are always decoded one
+    block at a time. Decoded position blocks go to positions_cache under a key
+    of their own, so a cached instance stays the size nbytes says.
+    """
+
+    def __init__(self, encoded, meta=None, max_score=None, avg_doc_length=None):
+        self.encoded = encoded
+        # (ordinals, frequencies, lengths, counts) once decoded
+        self.meta = meta
+        self.max_score = max_score
+        self.avg_doc_length = avg_doc_length
+        self.key = next(_postings_keys)
+
+    def decoded(self):
+        if self.meta is None:
+            self.meta = self.encoded.decode_meta()
+        return self.meta
+
+    @property
+    def ordinals(self):
+        return self.decoded()[0]
+
+    @property
+    def frequencies(self):
+        return self.decoded()[1]
+
+    @property
+    def lengths(self):
+        return self.decoded()[2]
+
+    @property
+    def counts(self):
+        return self.decoded()[3]
+
+    def __len__(self):
+        return self.encoded.df
+
+    def lookup(self, ordinals):
+        if self.meta is not None:
+            return super().lookup(ordinals)
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        blocks = self.encoded.find_blocks(ordinals)
+        block_ordinals, frequencies, lengths, counts = self.encoded.decode_blocks(blocks)
+        found, rows = match_ordinals(block_ordinals, ordinals)
+        # every block but the last is full, so a row of the decoded blocks maps back by its block
+        sizes = np.minimum((blocks + 1) * BLOCK_SIZE, self.encoded.df) - blocks * BLOCK_SIZE
+        starts = np.cumsum(sizes) - sizes
+        # position counts of the blocks, for get_positions before the whole list is decoded
+        for block, start, size in zip(blocks.tolist(), starts.tolist(), sizes.tolist()):
+            positions_cache.put(f"{self.key}:{block}:counts", (counts[start:start + size].copy(),))
+        shifts = np.repeat(blocks * BLOCK_SIZE - starts, sizes)
+        return found, rows + shifts[rows], frequencies[rows], lengths[rows]
+
+    def get_positions(self, i):
+        block = i // BLOCK_SIZE
+        key = f"{self.key}:{block}"
+        entry = positions_cache.get(key)
+        if entry is None:
+            start, end = self.encoded.block_bounds(block)
+            if self.meta is not None:
+                counts = self.counts[start:end]
+            else:
+                cached = positions_cache.get(f"{key}:counts")
+                counts = cached[0] if cached is not None else self.encoded.decode_blocks([block])[3]
+            entry = (self.encoded.decode_positions(block, counts), np.concatenate(([0], np.cumsum(counts))))
+            positions_cache.put(key, entry)
+        positions, starts = entry
+        row = i - block * BLOCK_SIZE
+        return positions[starts[row]:starts[row + 1]].tolist()
+
+    @property
+    def nbytes(self):
+        # the decoded columns are counted before they are decoded, so a cache budget holds once they are
+        return 6 * 8 * self.encoded.df + self.encoded.data.nbytes
+
+    def copy(self):
+        """Copy the encoded postings out of the barrel mmap so they stay resident."""
+        return CompressedPostings(EncodedPostings(self.encoded.data.copy(), self.encoded.df), self.meta,
+                                  self.max_score, self.avg_doc_length)
+
+
+class BinaryBarrel:
+    """Memory-mapped reader for a barrel_N.bin file."""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, term_count, self.avg_doc_length = BINARY_BARREL_HEADER.unpack_from(self.mm, 0)
+        if magic != BINARY_BARREL_MAGIC:
+            raise ValueError(f"{path} is not a binary barrel")
+
+        offset = BINARY_BARREL_HEADER.size
+        self.word_ids, offset = self.__column(offset, '<u4', term_count)
+        self.dfs, offset = self.__column(offset, '<u4', term_count)
+        self.offsets, offset = self.__column(offset, '<u4', term_count + 1)
+        self.max_scores, offset = self.__column(offset, '<f8', term_count)
+        self.data_offset = offset
+
+    def __column(self, offset, dtype, count):
+        column = np.frombuffer(self.mm, dtype=dtype, count=count, offset=offset)
+        return column, offset + column.nbytes
+
+    def get(self, word_id):
+        """The postings of a term, decoded as they are read, or None if the barrel does not hold it."""
+        word_id = int(word_id)
+        i = int(np.searchsorted(self.word_ids, word_id))
+        if i == len(self.word_ids) or self.word_ids[i] != word_id:
+            return None
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        data = np.frombuffer(self.mm, dtype=np.uint8, count=end - start, offset=self.data_offset + start)
+        return CompressedPostings(EncodedPostings(data, int(self.dfs[i])), None,
+                                  float(self.max_scores[i]), self.avg_doc_length)
+
+    @staticmethod
+    def encode(postings, avg_doc_length):
+        """Encode the postings of a term, returning its df, max tf score and encoded bytes."""
+        ordinals = np.array([posting["doc_id"] for posting in postings], dtype=np.int64)
+        return BinaryBarrel.encode_chunks([[postings[i] for i in np.argsort(ordinals, kind='stable')]], avg_doc_length)
+
+    @staticmethod
+    def encode_chunks(chunks, avg_doc_length):
+        """
+        Encode the postings of a term given as chunks in doc ordinal order, holding
+        one chunk at a time, returning its df, max tf score and encoded bytes.
+        """
+        encoder = PostingsEncoder()
+        max_score = 0.0
+        for postings in chunks:
+            frequencies = [posting["frequency"] for posting in postings]
+            lengths = [posting.get("doc_length", posting.get("length", 0)) for posting in postings]
+            encoder.add([posting["doc_id"] for posting in postings], frequencies, lengths,
+                        [posting.get("positions", []) for posting in postings])
+            max_score = max(max_score, max_tf_score(frequencies, lengths, avg_doc_length))
+        data = encoder.finish()
+        return encoder.df, max_score, data
+
+    @staticmethod
+    def write(path, terms, avg_doc_length):
+        """Write (word_id, df, max_score, encoded postings) tuples as a binary barrel."""
+        terms = sorted(terms, key=lambda term: int(term[0]))
+        offsets = np.concatenate(([0], np.cumsum([len(term[3]) for term in terms], dtype=np.int64)))
+
+        with open(path, 'wb') as f:
+            f.write(BINARY_BARREL_HEADER.pack(BINARY_BARREL_MAGIC, len(terms), avg_doc_length))
+            np.array([int(term[0]) for term in terms], dtype='<u4').tofile(f)
+            np.array([term[1] for term in terms], dtype='<u4').tofile(f)
+            offsets.astype('<u4').tofile(f)
+            np.array([term[2] for term in terms], dtype='<f8').tofile(f)
+            for term in terms:
+                f.write(term[3])
+
+
 class Barrels:
+    # binary barrels are immutable, so readers can be shared across instances
+    _binary_barrels = {}
+
     def __init__(self):
         self.inverted_index_path = "server/data/inverted_index.json"
         self.barrels_dir = "server/data/barrels"
@@ -66,8 +332,111 @@ class Barrels:
         return barrel_path
 
 
-    def build_barrels(self):
+    def build_binary_barrels(self):
+        """Stream the inverted index into binary barrels (barrel_N.bin)."""
+        self.__ensure_dir()
+        self.__clear_barrels(".json")
+        Barrels._binary_barrels.clear()
+        postings_cache.clear()
+        word_locations = {}
+        current_barrel = 0
+        current_terms = []
+        current_size = 0
+
+        # the average length is needed to store the per-term score bounds
+        try:
+            with open("server/data/metadata.json", 'r') as f:
+                metadata = json.load(f)
+            avg_doc_length = metadata["total_doc_length"] / metadata["forward_index_length"]
+        except (FileNotFoundError, KeyError, ZeroDivisionError, json.JSONDecodeError):
+            avg_doc_length = 0.0
+
+        with open(self.inverted_index_path, 'r') as f:
+            parser = ijson.kvitems(f, '')
+            for word_id, postings in parser:
+                df, max_score, data = BinaryBarrel.encode(postings, avg_doc_length)
+                entry_size = len(data)
+                # If adding this entry would exceed threshold, flush the barrel
+                if current_terms and current_size + entry_size >= BARREL_SIZE_THRESHOLD:
+                    BinaryBarrel.write(self.binary_barrel_path(current_barrel), current_terms, avg_doc_length)
+                    current_barrel += 1
+                    current_terms = []
+                    current_size = 0
+
+                word_locations[word_id] = current_barrel
+                current_terms.append((word_id, df, max_score, data))
+                current_size += entry_size
+
+        BinaryBarrel.write(self.binary_barrel_path(current_barrel), current_terms, avg_doc_length)
+
+        with open('server/data/barrel_metadata.json', 'w') as f:
+            json.dump(word_locations, f, indent=1)
+
+        return current_barrel
+
+    @staticmethod
+    def write_binary_barrels(terms, directory, prefix, avg_doc_length):
+        """
+        Encode (word_id, chunks) pairs, the postings of each word in chunks in doc
+        ordinal order, into binary barrels named prefix_N.bin in directory,
+        returning the path and word ids of each for install_binary_barrels.
+        """
+        barrels = []
+        current_terms = []
+        current_size = 0
+
+        def flush():
+            path = os.path.join(directory, f"{prefix}_{len(barrels)}.bin")
+            BinaryBarrel.write(path, current_terms, avg_doc_length)
+            barrels.append((path, [term[0] for term in current_terms]))
+
+        for word_id, chunks in terms:
+            df, max_score, data = BinaryBarrel.encode_chunks(chunks, avg_doc_length)
+            # If adding this entry would exceed threshold, flush the barrel
+            if current_terms and current_size + len(data) >= BARREL_SIZE_THRESHOLD:
+                flush()
+                current_terms = []
+                current_size = 0
+            current_terms.append((word_id, df, max_score, data))
+            current_size += len(data)
+
+        if current_terms:
+            flush()
+        return barrels
+
+    def install_binary_barrels(self, barrels):
+        """
+        Move binary barrels written elsewhere, given in order as (path, word_ids)
+        pairs, into place as barrel_0.bin onwards and save their metadata.
+        """
+        self.__ensure_dir()
+        self.__clear_barrels(".json")
+        self.__clear_barrels(".bin")
+        Barrels._binary_barrels.clear()
+        postings_cache.clear()
+        word_locations = {}
+
+        for barrel_id, (path, word_ids) in enumerate(barrels):
+            os.replace(path, self.binary_barrel_path(barrel_id))
+            for word_id in word_ids:
+                word_locations[str(word_id)] = barrel_id
+
+        with open('server/data/barrel_metadata.json', 'w') as f:
+            json.dump(word_locations, f, indent=1)
+
+        self.__save_last_barrel(len(barrels) - 1)
+        return len(barrels)
+
+    def build_barrels(self, binary=False):
+        if binary:
+            current_barrel = self.build_binary_barrels()
+            self.__save_last_barrel(current_barrel)
+            return current_barrel + 1
+
         self.__ensure_dir()
+        self.__clear_barrels(".bin")
+        Barrels._binary_barrels.clear()
+        postings_cache.clear()
         word_locations = {}
         current_barrel = 0
         current_barrel_path = self.create_new_barrel(current_barrel)
@@ -117,47 +486,93 @@ class Barrels:
             if not current_file.closed:
                 current_file.close()
 
-        # save the last barrel id to the metadata file
-        with open("server/data/metadata.json", 'w+') as f:
-            try:
+        self.__save_last_barrel(current_barrel)
+        return current_barrel + 1
+
+    def __save_last_barrel(self, current_barrel):
+        # save the last barrel id to the metadata file, keeping the forward index stats
+        try:
+            with open("server/data/metadata.json", 'r') as f:
                 metadaata = json.load(f)
-            except json.JSONDecodeError:
-                metadaata = {"last_barrel": current_barrel}
-            metadaata["last_barrel"] = current_barrel
-            f.seek(0)
+        except (FileNotFoundError, json.JSONDecodeError):
+            metadaata = {}
+        metadaata["last_barrel"] = current_barrel
+        with open("server/data/metadata.json", 'w') as f:
             json.dump(metadaata, f, indent=1)
-            f.truncate()
 
-        return current_barrel + 1
+    def __clear_barrels(self, extension):
+        """Remove barrels of the other format left over from a previous build."""
+        for name in os.listdir(self.barrels_dir):
+            if name.startswith("barrel_") and name.endswith(extension):
+                os.remove(os.path.join(self.barrels_dir, name))
         
     def get_barrel(self, barrel_id):
         with open(f"server/data/barrels/barrel_{str(barrel_id)}.json", 'r') as f:
             return json.load(f)
 
-    def add_word_to_barrel(self, term_id, doc_id, frequency, position, barrel_metadata, metadata):
+    def binary_barrel_path(self, barrel_id):
+        return os.path.join(self.barrels_dir, f"barrel_{barrel_id}.bin")
+
+    def get_binary_barrel(self, barrel_id):
+        """Return the mmap reader for a binary barrel, or None if it was not built."""
+        barrel = Barrels._binary_barrels.get(barrel_id)
+        if barrel is None:
+            path = self.binary_barrel_path(barrel_id)
+            if not os.path.exists(path):
+                return None
+            barrel = Barrels._binary_barrels[barrel_id] = BinaryBarrel(path)
+        return barrel
+
+    def get_postings(self, barrel_id, word_id):
+        """
+        Get the postings blocks of a term. Binary barrels are immutable, so documents
+        added afterwards live in a JSON barrel of the same number and come as a second block.
+        """
+        word_id = str(word_id)
+        blocks = postings_cache.get(word_id)
+        if blocks is not None:
+            return blocks
+
+        blocks = []
+        binary_barrel = self.get_binary_barrel(barrel_id)
+        if binary_barrel is not None:
+            postings = binary_barrel.get(word_id)
+            if postings is not None:
+                blocks.append(postings.copy())
+
+        barrel_path = os.path.join(self.barrels_dir, f"barrel_{barrel_id}.json")
+        if os.path.exists(barrel_path):
+            postings = self.get_barrel(barrel_id).get(word_id)
+            if postings:
+                blocks.append(BarrelPostings.from_json(postings))
+        postings_cache.put(word_id, blocks)
+        return blocks
+
+    def __append_posting(self, barrel_path, term_id, posting):
+        barrel = {}
+        if os.path.exists(barrel_path):
+            with open(barrel_path, 'r') as f:
+                barrel = json.load(f)
+        barrel.setdefault(term_id, []).append(posting)
+        with open(barrel_path, 'w') as f:
+            json.dump(barrel, f)
+
+    def add_word_to_barrel(self, term_id, ordinal, frequency, position, barrel_metadata, metadata):
         # print(f"Adding word {term_id} to barrels")
+        # barrel metadata is keyed by the string form of the id
+        term_id = str(term_id)
+        postings_cache.invalidate(term_id)
         # first check if the word is already in the barrels
         if term_id in barrel_metadata:
             barrel_id = barrel_metadata[term_id]
             barrel_path = os.path.join(self.barrels_dir, f"barrel_{barrel_id}.json")
             print("already in barrels with path", barrel_path)
-            with open(barrel_path, 'r+') as f:
-                barrel = json.load(f)
-                if term_id in barrel:
-                    barrel[term_id].append({
-                        "doc_id": doc_id,
-                        "frequency": frequency,
-                        "positions": position
-                    })
-                else:
-                    barrel[term_id] = [{
-                        "doc_id": doc_id,
-                        "frequency": frequency,
-                        "positions": position
-                    }]
-                f.seek(0)
-                json.dump(barrel, f)
-                f.truncate()
+            # binary barrels are read-only, new postings go to the JSON barrel next to them
+            self.__append_posting(barrel_path, term_id, {
+                "doc_id": ordinal,
+                "frequency": frequency,
+                "positions": position
+            })
             return metadata["last_barrel"]
         
 
@@ -166,53 +581,44 @@ class Barrels:
         last_barrel = metadata["last_barrel"]
         print(f"Last barrel: {last_barrel}")
         # before adding the word to the barrel, check if the size of the barrel is less than the threshold
+        if os.path.exists(self.binary_barrel_path(last_barrel)):
+            # binary barrels are sealed, start a fresh JSON barrel after them
+            last_barrel += 1
+            metadata["last_barrel"] = last_barrel
+            with open("server/data/metadata.json", 'w') as f:
+                json.dump(metadata, f, indent=1)
         barrel_path = os.path.join(self.barrels_dir, f"barrel_{last_barrel}.json")
-        if os.path.exists(barrel_path):
-            print(f"Barrel {last_barrel} exists")
-            print(f"Size of barrel {last_barrel}: {self.get_file_size(barrel_path)}", BARREL_SIZE_THRESHOLD)
-            if self.get_file_size(barrel_path) < BARREL_SIZE_THRESHOLD:
-                print(f"Adding word {term_id} to existing barrel {last_barrel}")
-                with open(barrel_path, 'r+') as f:
-                    barrel = json.load(f)
-                    if term_id in barrel:
-                        barrel[term_id].append({
-                            "doc_id": doc_id,
-                            "frequency": frequency,
-                            "positions": position
-                        })
-                    else:
-                        barrel[term_id] = [{
-                            "doc_id": doc_id,
-                            "frequency": frequency,
-                            "positions": position
-                        }]
-                    f.seek(0)
-                    json.dump(barrel, f)
-                    f.truncate()
-            else:
-                print(f"Creating new barrel {last_barrel + 1} for word {term_id}")
-                last_barrel += 1
-                new_barrel_path = os.path.join(self.barrels_dir, f"barrel_{last_barrel}.json")
-                
-                with open(new_barrel_path, 'w') as f:
-                    json.dump({term_id: [{
-                        "doc_id": doc_id,
-                        "frequency": frequency,
-                        "positions": position
-                    }]}, f)
-                
-                metadata["last_barrel"] = last_barrel
-                with open("server/data/metadata.json", 'w') as f:
-                        f.seek(0)
-                        json.dump(metadata, f, indent=1)
-                        f.truncate()
-
-            barrel_metadata[term_id] = last_barrel
-            with open("server/data/barrel_metadata.json", 'w') as f:
+        if not os.path.exists(barrel_path) or self.get_file_size(barrel_path) < BARREL_SIZE_THRESHOLD:
+            print(f"Adding word {term_id} to barrel {last_barrel}")
+            self.__append_posting(barrel_path, term_id, {
+                "doc_id": ordinal,
+                "frequency": frequency,
+                "positions": position
+            })
+        else:
+            print(f"Creating new barrel {last_barrel + 1} for word {term_id}")
+            last_barrel += 1
+            new_barrel_path = os.path.join(self.barrels_dir, f"barrel_{last_barrel}.json")
+
+            with open(new_barrel_path, 'w') as f:
+                json.dump({term_id: [{
+                    "doc_id": ordinal,
+                    "frequency": frequency,
+                    "positions": position
+                }]}, f)
+
+            metadata["last_barrel"] = last_barrel
+            with open("server/data/metadata.json", 'w') as f:
                     f.seek(0)
-                    json.dump(barrel_metadata, f, indent=1)
+                    json.dump(metadata, f, indent=1)
                     f.truncate()
 
+        barrel_metadata[term_id] = last_barrel
+        with open("server/data/barrel_metadata.json", 'w') as f:
+                f.seek(0)
+                json.dump(barrel_metadata, f, indent=1)
+                f.truncate()
+
 
     
     def load_barrel(self, word_id):
@@ -1,129 +1,207 @@
 import csv
-import json
+import mmap
+import os
+import struct
 import time
+import numpy as np
 from typing import Dict, Optional, Tuple, List
+from server.entities.docmap import DocMap
+from server.entities.docstore import DISPLAY_FIELDS, DocStore
+
+# Document index layout (little-endian): header (magic, doc_count) then one
+# (offset u8, length u4) record per doc ordinal, giving the byte range of the
+# document's row in the CSV. A zero length marks an ordinal without a row.
+DOC_INDEX_MAGIC = b"DIX1"
+DOC_INDEX_HEADER = struct.Struct("<4sI")
+DOC_INDEX_RECORD = np.dtype([('offset', '<u8'), ('length', '<u4')])
+
+FIELDNAMES = ['id', 'title', 'keywords', 'venue', 'year', 'n_citation', 'url', 'abstract',
+              'authors', 'doc_type', 'references']
+
 
 class DocumentIndex:
     def __init__(self):
         self.csv_path = "server/data/test_100k.csv"
-        self.index_path = "server/data/document_index.json"
-        # Load the index once during initialization
-        try:
-            with open(self.index_path, 'r') as index_file:
-                self.index = json.load(index_file)
-        except FileNotFoundError:
-            self.index = {}
-        # Keep the CSV file handle as an instance variable
+        self.index_path = "server/data/document_index.bin"
+        # Map the index once during initialization, a record per doc ordinal
+        self.index = self.__load()
+        # Keep the mmap'd CSV as an instance variable
         self.csv_file = None
+        self.docstore = None
+
+    def __load(self) -> np.ndarray:
+        if not os.path.exists(self.index_path):
+            return np.zeros(0, dtype=DOC_INDEX_RECORD)
+        with open(self.index_path, 'rb') as index_file:
+            mm = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, doc_count = DOC_INDEX_HEADER.unpack_from(mm, 0)
+        if magic != DOC_INDEX_MAGIC:
+            raise ValueError(f"{self.index_path} is not a document index")
+        return np.frombuffer(mm, dtype=DOC_INDEX_RECORD, count=doc_count, offset=DOC_INDEX_HEADER.size)
 
     def __enter__(self):
-        """Context manager entry - opens the CSV file"""
+        """Context manager entry - opens the CSV file, read with pread so threads can share it"""
         start = time.time()
-        self.csv_file = open(self.csv_path, 'r', encoding='utf-8')
+        self.csv_file = open(self.csv_path, 'rb')
+        self.docstore = DocStore()
         end = time.time()
 
         print("mmaz kelite", end-start)
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        """Context manager exit - closes the CSV file"""
+        """Context manager exit - closes the CSV file and the docstore"""
         if self.csv_file:
             self.csv_file.close()
             self.csv_file = None
+        if self.docstore:
+            self.docstore.close()
+            self.docstore = None
 
-    def read_next_record(self, csv_file) -> Tuple[Optional[str], int]:
-        """Read next CSV record, returning doc_id and start position."""
+    def read_next_record(self, csv_file) -> Tuple[Optional[List[str]], int, int]:
+        """Read next CSV record from a binary file, returning its fields and its start and end positions."""
         start_pos = csv_file.tell()
-        
+
         chunks = []
         while True:
             chunk = csv_file.readline()
             if not chunk:
-                return None, 0
-                
+                return None, 0, 0
+
             chunks.append(chunk)
             try:
-                record = next(csv.reader([''.join(chunks)]))
-                return record[0], start_pos
+                record = next(csv.reader([b''.join(chunks).decode('utf-8')]))
+                return record, start_pos, csv_file.tell()
             except csv.Error:
                 continue
-    
-    def build_index(self) -> None:
-        with open(self.index_path, 'w') as index_file:
-            index_file.write('{\n')
-            
-            with open(self.csv_path, 'r', encoding='utf-8') as csv_file:
+
+    def build_index(self, docstore=True) -> None:
+        """Index the byte range of every CSV row and, unless docstore is False, build the docstore."""
+        doc_map = DocMap()
+        records = np.zeros(len(doc_map), dtype=DOC_INDEX_RECORD)
+
+        def display_records():
+            # rows come in ordinal order, since ordinals are assigned in dataset order
+            next_ordinal = 0
+            with open(self.csv_path, 'rb') as csv_file:
                 csv_file.readline()  # Skip header
-                first = True
-                
+
                 while True:
-                    doc_id, pos = self.read_next_record(csv_file)
-                    if doc_id is None:
+                    record, start, end = self.read_next_record(csv_file)
+                    if record is None:
                         break
-                        
-                    if not first:
-                        index_file.write(',\n')
-                    else:
-                        first = False
-                        
-                    index_file.write(f'"{doc_id}": {pos}')
-                    
-            index_file.write('\n}')
-
-    def get_documents(self, doc_ids: List[str]) -> List[Optional[Dict]]:
-        """Get multiple documents by their IDs efficiently."""
+
+                    ordinal = doc_map.ordinal(record[0])
+                    if ordinal is None or ordinal < next_ordinal:
+                        continue
+                    records[ordinal] = (start, end - start)
+                    for _ in range(next_ordinal, ordinal):
+                        yield None
+                    document = dict(zip(FIELDNAMES, record))
+                    yield {field: document.get(field, '') for field in DISPLAY_FIELDS}
+                    next_ordinal = ordinal + 1
+            for _ in range(next_ordinal, len(doc_map)):
+                yield None
+
+        if docstore:
+            DocStore.write(display_records(), len(doc_map))
+            self.docstore = DocStore()
+        else:
+            for _ in display_records():
+                pass
+
+        with open(self.index_path, 'wb') as index_file:
+            index_file.write(DOC_INDEX_HEADER.pack(DOC_INDEX_MAGIC, len(records)))
+            records.tofile(index_file)
+        self.index = self.__load()
+
+    def append(self, ordinal: int, offset: int, length: int) -> None:
+        """Record the byte range of a document appended to the CSV"""
+        self.extend(ordinal, [offset], [length])
+
+    def extend(self, ordinal: int, offsets: List[int], lengths: List[int]) -> None:
+        """Record the byte ranges of documents appended to the CSV, numbered from ordinal"""
+        if not os.path.exists(self.index_path):
+            with open(self.index_path, 'wb') as index_file:
+                index_file.write(DOC_INDEX_HEADER.pack(DOC_INDEX_MAGIC, 0))
+
+        end = ordinal + len(offsets)
+        with open(self.index_path, 'r+b') as index_file:
+            magic, doc_count = DOC_INDEX_HEADER.unpack(index_file.read(DOC_INDEX_HEADER.size))
+            # ordinals without a row in between get empty records
+            records = np.zeros(max(end - doc_count, 0), dtype=DOC_INDEX_RECORD)
+            index_file.seek(DOC_INDEX_HEADER.size + doc_count * DOC_INDEX_RECORD.itemsize)
+            records.tofile(index_file)
+            index_file.seek(DOC_INDEX_HEADER.size + ordinal * DOC_INDEX_RECORD.itemsize)
+            np.array(list(zip(offsets, lengths)), dtype=DOC_INDEX_RECORD).tofile(index_file)
+            index_file.seek(0)
+            index_file.write(DOC_INDEX_HEADER.pack(magic, max(doc_count, end)))
+        self.index = self.__load()
+
+    def has_row(self, ordinal: int) -> bool:
+        """Whether the document index records a CSV row for an ordinal"""
+        return self.__range(ordinal) is not None
+
+    def append_rows(self, ordinal: int, offset: int, rows: List[bytes]) -> None:
+        """Write CSV rows at offset, dropping anything after it, and record them from ordinal"""
+        with open(self.csv_path, 'r+b') as csv_file:
+            csv_file.seek(offset)
+            csv_file.write(b"".join(rows))
+            csv_file.truncate()
+        offsets = []
+        for row in rows:
+            offsets.append(offset)
+            offset += len(row)
+        self.extend(ordinal, offsets, [len(row) for row in rows])
+
+    def __range(self, ordinal: int) -> Optional[Tuple[int, int]]:
+        if ordinal >= len(self.index):
+            # documents added since the index was loaded
+            self.index = self.__load()
+        if 0 <= ordinal < len(self.index):
+            offset, length = self.index[ordinal].tolist()
+            if length:
+                return offset, length
+        return None
+
+    def __record(self, offset: int, length: int) -> Dict:
+        # no shared file position, and rows appended since the file was opened are read the same way
+        row = os.pread(self.csv_file.fileno(), length, offset).decode('utf-8')
+        return next(csv.DictReader([row], fieldnames=FIELDNAMES))
+
+    def get_documents(self, ordinals: List[int], fields: Optional[List[str]] = None) -> List[Optional[Dict]]:
+        """
+        Get multiple documents by their ordinals. Only the given fields are returned
+        when fields is set, from the docstore when it holds them, otherwise
+        every CSV column, reading the CSV in offset order.
+        """
         if not self.csv_file:
             raise RuntimeError("DocumentIndex must be used as a context manager")
 
-        results = []
-        for doc_id in doc_ids:
-            if doc_id not in self.index:
-                results.append(None)
-                continue
-
-            self.csv_file.seek(self.index[doc_id])
-            content = []
-            
-            while True:
-                chunk = self.csv_file.readline()
-                content.append(chunk)
-                try:
-                    reader = csv.DictReader([''.join(content)],
-                                          fieldnames=['id', 'title', 'keywords', 'venue', 
-                                                    'year', 'n_citation', 'url', 'abstract',
-                                                    'authors', 'doc_type', 'references'])
-                    results.append(next(reader))
-                    break
-                except csv.Error:
-                    continue
+        results = [None] * len(ordinals)
+        if fields is not None and set(fields) <= set(DISPLAY_FIELDS):
+            results = self.docstore.get(ordinals, fields)
 
+        # documents added after the docstore was built come from the CSV
+        missing = [i for i, result in enumerate(results) if result is None]
+        ranges = {i: self.__range(ordinals[i]) for i in missing}
+        for i in sorted((i for i in missing if ranges[i] is not None), key=lambda i: ranges[i][0]):
+            document = self.__record(*ranges[i])
+            results[i] = document if fields is None else {field: document.get(field) for field in fields}
         return results
 
-    def get_document(self, doc_id: str) -> Optional[Dict]:
-        """Get a single document by ID"""
+    def get_document(self, ordinal: int) -> Optional[Dict]:
+        """Get a single document by ordinal"""
         if not self.csv_file:
             raise RuntimeError("DocumentIndex must be used as a context manager")
 
-        if doc_id not in self.index:
+        doc_range = self.__range(ordinal)
+        if doc_range is None:
             return None
-            
-        self.csv_file.seek(self.index[doc_id])
-        content = []
-        
-        while True:
-            chunk = self.csv_file.readline()
-            content.append(chunk)
-            try:
-                reader = csv.DictReader([''.join(content)],
-                                      fieldnames=['id', 'title', 'keywords', 'venue', 
-                                                'year', 'n_citation', 'url', 'abstract',
-                                                'authors', 'doc_type', 'references'])
-                return next(reader)
-            except csv.Error:
-                continue
-        
+        return self.__record(*doc_range)
+
 if __name__ == "__main__":
     with DocumentIndex() as documentIndex:
         documentIndex.build_index()
-        # doc = documentIndex.get_document('0000a1fd')
-        # print(doc)
\ No newline at end of file
+        # doc = documentIndex.get_document(0)
+        # print(doc)
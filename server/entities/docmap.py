@@ -0,0 +1,160 @@
+import mmap
+import os
+import struct
+import threading
+import numpy as np
+from server.lib.bloom import BloomFilter
+
+# Doc map layout (little-endian):
+#   header        magic, doc_count, sorted_count, doc_id_width
+#   sorted_order  u4[sorted_count]         ordinals ordered by doc id, for reverse lookups
+#   doc_ids       S<width>[doc_count]      external doc id of every ordinal, null padded
+# Documents added after the build are appended to doc_ids and looked up through a small dict.
+# A Bloom filter of the sorted doc ids, kept in its own file, turns most unknown ids away
+# without a binary search.
+DOC_MAP_MAGIC = b"DMP1"
+DOC_MAP_HEADER = struct.Struct("<4sIII")
+# wide enough for the doc_<uuid> ids generated by AddContent
+MIN_DOC_ID_WIDTH = 40
+
+
+class DocMap:
+    """Table of dense document ordinals (0..N-1) and their external doc ids."""
+    path = 'server/data/doc_map.bin'
+    bloom_path = 'server/data/doc_map_bloom.bin'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bloom = None
+        self.__load()
+
+    def __map(self):
+        """The doc map file mapped, with its header counts and columns"""
+        mm = None
+        doc_count = sorted_count = 0
+        width = MIN_DOC_ID_WIDTH
+        sorted_order = np.zeros(0, dtype='<u4')
+        doc_ids_column = np.zeros(0, dtype=f'S{width}')
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, doc_count, sorted_count, width = DOC_MAP_HEADER.unpack_from(mm, 0)
+            if magic != DOC_MAP_MAGIC:
+                raise ValueError(f"{self.path} is not a doc map")
+            offset = DOC_MAP_HEADER.size
+            sorted_order = np.frombuffer(mm, dtype='<u4', count=sorted_count, offset=offset)
+            offset += sorted_order.nbytes
+            doc_ids_column = np.frombuffer(mm, dtype=f'S{width}', count=doc_count, offset=offset)
+        return mm, doc_count, sorted_count, width, sorted_order, doc_ids_column
+
+    def __load(self):
+        mm, doc_count, sorted_count, width, sorted_order, doc_ids_column = self.__map()
+        appended = {doc_ids_column[ordinal].decode(): ordinal for ordinal in range(sorted_count, doc_count)}
+
+        # other threads read the map while it reloads, so the count that bounds their reads goes in last
+        self.mm, self.width, self.sorted_order, self.doc_ids_column = mm, width, sorted_order, doc_ids_column
+        self.appended = appended
+        self.sorted_count, self.doc_count = sorted_count, doc_count
+        self.__load_bloom()
+
+    def __load_bloom(self):
+        # the sorted ids only change with a rebuild, appends keep the filter
+        if self.bloom is not None and self.bloom.key_count == self.sorted_count:
+            return
+        if os.path.exists(self.bloom_path):
+            self.bloom = BloomFilter.read(self.bloom_path)
+            if self.bloom.key_count == self.sorted_count:
+                return
+        # doc maps written before the filter existed get one on first load
+        self.bloom = BloomFilter.build(self.doc_ids_column[:self.sorted_count].tolist())
+        self.bloom.write(self.bloom_path)
+
+    def __len__(self):
+        return self.doc_count
+
+    def __refresh(self, ordinal):
+        # another DocMap instance may have appended documents since this one was loaded
+        if ordinal >= self.doc_count:
+            with self.lock:
+                if ordinal >= self.doc_count:
+                    self.__load()
+
+    def doc_id(self, ordinal):
+        """External doc id of an ordinal"""
+        self.__refresh(ordinal)
+        return self.doc_ids_column[ordinal].decode()
+
+    def doc_ids(self, ordinals):
+        """External doc ids of a list of ordinals"""
+        if len(ordinals):
+            self.__refresh(max(ordinals))
+        return [doc_id.decode() for doc_id in self.doc_ids_column[np.asarray(ordinals, dtype=np.int64)].tolist()]
+
+    def ordinal(self, doc_id):
+        """Ordinal of an external doc id, or None if the document is unknown"""
+        if doc_id in self.appended:
+            return self.appended[doc_id]
+        key = doc_id.encode()
+        # most ids asked about are new ones, which the filter turns away
+        if self.bloom is not None and key not in self.bloom:
+            return None
+        # binary search over the doc ids in sorted order
+        lo, hi = 0, self.sorted_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.doc_ids_column[self.sorted_order[mid]] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.sorted_count and self.doc_ids_column[self.sorted_order[lo]] == key:
+            return int(self.sorted_order[lo])
+        return None
+
+    def __contains__(self, doc_id):
+        return self.ordinal(doc_id) is not None
+
+    def append(self, doc_id):
+        """Assign the next ordinal to a new document and persist it"""
+        return self.extend([doc_id])
+
+    def extend(self, doc_ids):
+        """Assign consecutive ordinals to new documents and persist them, returning the first"""
+        encoded = [doc_id.encode() for doc_id in doc_ids]
+        for doc_id, key in zip(doc_ids, encoded):
+            if len(key) > self.width:
+                raise ValueError(f"Doc id {doc_id} is longer than {self.width} bytes")
+        with self.lock:
+            if not os.path.exists(self.path):
+                self.build([])
+            with open(self.path, 'r+b') as f:
+                magic, doc_count, sorted_count, width = DOC_MAP_HEADER.unpack(f.read(DOC_MAP_HEADER.size))
+                # after the last counted id, over any left by a write the header never recorded
+                f.seek(DOC_MAP_HEADER.size + 4 * sorted_count + width * doc_count)
+                f.write(b"".join(key.ljust(width, b"\0") for key in encoded))
+                f.truncate()
+                f.seek(0)
+                f.write(DOC_MAP_HEADER.pack(magic, doc_count + len(encoded), sorted_count, width))
+            if (doc_count, sorted_count) != (self.doc_count, self.sorted_count):
+                # another instance changed the file since this one read it
+                self.__load()
+                return doc_count
+            # the file grew past the old mapping, but only the new ids go into appended;
+            # the Bloom filter covers the sorted ids alone, which appends leave as they are
+            mm, new_count, _, _, sorted_order, doc_ids_column = self.__map()
+            self.mm, self.sorted_order, self.doc_ids_column = mm, sorted_order, doc_ids_column
+            self.appended.update((doc_id, ordinal) for ordinal, doc_id in enumerate(doc_ids, doc_count))
+            self.doc_count = new_count
+            return doc_count
+
+    @classmethod
+    def build(cls, doc_ids):
+        """Write a doc map assigning ordinals to doc_ids in the given order"""
+        doc_ids = np.array([str(doc_id).encode() for doc_id in doc_ids], dtype=np.bytes_)
+        width = max(doc_ids.dtype.itemsize if len(doc_ids) else 0, MIN_DOC_ID_WIDTH)
+        doc_ids = doc_ids.astype(f'S{width}')
+        sorted_order = np.argsort(doc_ids, kind='stable').astype('<u4')
+        with open(cls.path, 'wb') as f:
+            f.write(DOC_MAP_HEADER.pack(DOC_MAP_MAGIC, len(doc_ids), len(doc_ids), width))
+            sorted_order.tofile(f)
+            doc_ids.tofile(f)
+        BloomFilter.build(doc_ids.tolist()).write(cls.bloom_path)
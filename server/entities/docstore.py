@@ -0,0 +1,121 @@
+import json
+import mmap
+import os
+import struct
+import zlib
+from collections import defaultdict
+import numpy as np
+from server.lib.cache import docstore_cache
+
+# Docstore layout (little-endian):
+#   header      magic, doc_count, block_size, field_count, directory offset
+#   blocks      for every group of block_size doc ordinals, one zlib-compressed
+#               JSON list of values per field, so a field is decoded without the others
+#   directory   u8[n_blocks * field_count + 1], start of every compressed column
+DOCSTORE_MAGIC = b"DST1"
+DOCSTORE_HEADER = struct.Struct("<4sIIIQ")
+DOCSTORE_BLOCK_SIZE = 16
+
+# the fields search results are rendered from
+DISPLAY_FIELDS = ['title', 'abstract', 'keywords', 'year', 'venue', 'n_citation', 'url']
+
+
+class DocStore:
+    """Compressed columnar store of the display fields of every document, by doc ordinal."""
+    path = 'server/data/docstore.bin'
+
+    def __init__(self):
+        self.doc_count = 0
+        self.mm = None
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.doc_count, self.block_size, field_count, directory = DOCSTORE_HEADER.unpack_from(self.mm, 0)
+        if magic != DOCSTORE_MAGIC or field_count != len(DISPLAY_FIELDS):
+            raise ValueError(f"{self.path} is not a docstore of {DISPLAY_FIELDS}")
+        n_blocks = (self.doc_count + self.block_size - 1) // self.block_size
+        self.directory = np.frombuffer(self.mm, dtype='<u8', count=n_blocks * field_count + 1, offset=directory)
+
+    def __len__(self):
+        return self.doc_count
+
+    def close(self):
+        """Unmap the store, every ordinal reads as missing afterwards"""
+        if self.mm is not None:
+            # the directory is a view of the mmap, which cannot close while one exists
+            self.directory = None
+            self.doc_count = 0
+            self.mm.close()
+            self.mm = None
+
+    def __columns(self, block, fields):
+        """Decoded columns of a block, decompressing only the fields not cached yet"""
+        columns = docstore_cache.get(block)
+        if columns is not None and all(field in columns for field in fields):
+            return columns
+        columns = dict(columns or {})
+        for field in fields:
+            if field not in columns:
+                i = block * len(DISPLAY_FIELDS) + DISPLAY_FIELDS.index(field)
+                start, end = int(self.directory[i]), int(self.directory[i + 1])
+                columns[field] = json.loads(zlib.decompress(self.mm[start:end]))
+        docstore_cache.put(block, columns)
+        return columns
+
+    def get(self, ordinals, fields=DISPLAY_FIELDS):
+        """Requested fields of each ordinal, or None for ordinals the store does not hold"""
+        results = [None] * len(ordinals)
+        by_block = defaultdict(list)
+        for i, ordinal in enumerate(ordinals):
+            if 0 <= ordinal < self.doc_count:
+                by_block[ordinal // self.block_size].append(i)
+
+        # each block is fetched once, however many hits share it
+        for block, hits in by_block.items():
+            columns = self.__columns(block, fields)
+            for i in hits:
+                row = ordinals[i] - block * self.block_size
+                record = {field: columns[field][row] for field in fields}
+                # ordinals without a row were written as nulls
+                if None not in record.values():
+                    results[i] = record
+        return results
+
+    @classmethod
+    def write(cls, records, doc_count):
+        """
+        Write display field dicts given in ordinal order. Ordinals without a
+        record, passed as None, are stored as nulls and read back as None.
+        """
+        directory = []
+        with open(cls.path + '.tmp', 'wb') as f:
+            f.write(b"\0" * DOCSTORE_HEADER.size)
+            block = []
+
+            def flush():
+                for field in DISPLAY_FIELDS:
+                    directory.append(f.tell())
+                    f.write(zlib.compress(json.dumps([None if record is None else record.get(field, '')
+                                                      for record in block]).encode()))
+                block.clear()
+
+            written = 0
+            for record in records:
+                block.append(record)
+                written += 1
+                if len(block) == DOCSTORE_BLOCK_SIZE:
+                    flush()
+            if written != doc_count:
+                raise ValueError(f"Expected {doc_count} docstore records, got {written}")
+            if block:
+                flush()
+
+            directory.append(f.tell())
+            np.array(directory, dtype='<u8').tofile(f)
+            f.seek(0)
+            f.write(DOCSTORE_HEADER.pack(DOCSTORE_MAGIC, doc_count, DOCSTORE_BLOCK_SIZE,
+                                         len(DISPLAY_FIELDS), directory[-1]))
+        # swap in the new store, a live mmap of the old one must not be truncated
+        os.replace(cls.path + '.tmp', cls.path)
+        docstore_cache.clear()
@@ -3,6 +3,41 @@ import pandas as pd
 import json
 from collections import defaultdict
 from server.entities.lexicon import Lexicon
+from server.entities.docmap import DocMap
+
+def index_document(title, abstract, keywords, word_ids):
+    """Forward index entry of a preprocessed document: per word section frequencies and positions"""
+    # computing the total length of the document
+    total_length = len(title.split()) + len(abstract.split())
+
+    # subdivide the words into three sections
+    sections = [
+        (title.split(), 0),
+        (abstract.split(), 1),
+        (keywords.split(), 2)
+    ]
+
+    # information for each word
+    word_dict = defaultdict(lambda: {'frequency': [0, 0, 0], 'positions': []})
+
+    base_position = 0
+
+    for words, section_index in sections:
+        # iterate through the words in the section
+        for current_position, word in enumerate(words):
+            word_id = word_ids.get(word)
+            if word_id is not None:
+                word_dict[word_id]['positions'].append(current_position + base_position)
+                # increment the frequency of the word in that section
+                word_dict[word_id]['frequency'][section_index] += 1
+        # update the base position
+        base_position += len(words)
+
+    return {
+        "word_data": dict(word_dict),
+        "length": total_length
+    }
+
 
 class ForwardIndex:
     def __init__(self, load=True):
@@ -22,47 +57,21 @@ class ForwardIndex:
 
     def build(self):
         input_file = "server/data/preprocessed_test_100k.csv"
-        lexiconObj = Lexicon()
-        lexicon = lexiconObj.lexicon
-        df = pd.read_csv(input_file)
+        # one dict lookup per token instead of a search of the binary lexicon
+        word_ids = Lexicon().ids()
+        df = pd.read_csv(input_file, dtype={'id': str})
         df.fillna({'title': '', 'abstract': '', 'keywords': ''}, inplace=True)
         forward_index = {}
 
+        # documents are numbered 0..N-1 in dataset order, the doc map keeps their external ids
+        DocMap.build(df['id'])
+
         total_doc_length = 0
 
-        for _, row in df.iterrows():
-            doc_id = row['id']
-            # computing the total length of the document
-            total_length = len(row['title'].split()) + len(row['abstract'].split())
-
-            # subdivide the words into three sections
-            sections = [
-                (row['title'].split(), 0),
-                (row['abstract'].split(), 1),
-                (row['keywords'].split(), 2)
-            ]
-            
-            # information for each word
-            word_dict = defaultdict(lambda: {'frequency': [0, 0, 0], 'positions': []})
-
-            base_position = 0
-            
-            for words, section_index in sections:
-                # iterate through the words in the section
-                for current_position, word in enumerate(words):
-                    if word in lexicon:
-                        word_id = lexiconObj.get_word_id(word)
-                        word_dict[word_id]['positions'].append(current_position + base_position)
-                        # increment the frequency of the word in that section
-                        word_dict[word_id]['frequency'][section_index] += 1
-                # update the base position
-                base_position += len(words)
-            
-            # set the word_dict and total length to the doc_id
-            forward_index[doc_id] = {
-                "word_data": dict(word_dict),
-                "length": total_length
-            }
+        for ordinal, (title, abstract, keywords) in enumerate(zip(df['title'], df['abstract'], df['keywords'])):
+            # set the word data and total length to the doc ordinal
+            forward_index[ordinal] = index_document(title, abstract, keywords, word_ids)
+            total_length = forward_index[ordinal]["length"]
 
             # Update total_doc_length
             total_doc_length += total_length
@@ -91,8 +100,8 @@ class ForwardIndex:
         :para new_doc: Dictionary containing 'id', 'title', 'abstract', and 'keywords'.
         """
         lexiconObj = Lexicon()
-        lexicon = lexiconObj.lexicon
         doc_id = new_doc['id']
+        ordinal = DocMap().append(doc_id)
 
         total_length = len(new_doc['title'].split()) + len(new_doc['abstract'].split())
 
@@ -109,14 +118,14 @@ class ForwardIndex:
         # Iterate through each section of the document
         for words, section_index in sections:
             for current_position, word in enumerate(words):
-                if word in lexicon:
-                    word_id = lexiconObj.get_word_id(word)
+                word_id = lexiconObj.get_word_id(word)
+                if word_id is not None:
                     word_dict[word_id]['positions'].append(current_position + base_position)
                     word_dict[word_id]['frequency'][section_index] += 1
             base_position += len(words)
 
         # Append the new document to the forward index
-        self.data[doc_id] = {
+        self.data[str(ordinal)] = {
             "word_data": dict(word_dict),
             "length": total_length  # Add total length
         }
@@ -135,7 +144,7 @@ class ForwardIndex:
         with open("server/data/metadata.json", "w") as meta_file:
             json.dump(metadata, meta_file, indent=1)
 
-        print(f"New document with ID {doc_id} added to the forward index.")
+        print(f"New document with ID {doc_id} added to the forward index as ordinal {ordinal}.")
         print(f"Metadata updated in server/data/metadata.json.")
 
 if __name__ == "__main__":
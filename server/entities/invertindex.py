@@ -1,7 +1,57 @@
 from collections import defaultdict
+from itertools import groupby
+import heapq
+import ijson
 import json
+import os
+import pickle
+import tempfile
 import time
 from server.entities.forwardindex import ForwardIndex
+from server.entities.barrels import Barrels
+from server.lib.codec import BLOCK_SIZE
+
+# memory budget of the postings held before they are spilled to a sorted run
+INVERSION_RAM_BYTES = 256 * 1024 * 1024
+
+
+def posting_size(posting):
+    """Rough in-memory size of a posting dict, its lists and ints"""
+    return 400 + 36 * len(posting["positions"])
+
+
+def write_run(path, inverted_index):
+    """
+    Write postings lists to a run file sorted by word id, in chunks of a block
+    so the merge never holds more than a block of a list from each run
+    """
+    with open(path, 'wb') as f:
+        for word_id in sorted(inverted_index, key=int):
+            postings = inverted_index[word_id]
+            for start in range(0, len(postings), BLOCK_SIZE):
+                pickle.dump((int(word_id), postings[start:start + BLOCK_SIZE]), f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def read_run(path):
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def merge_runs(run_paths):
+    """
+    k-way merge run files by word id, yielding every word id with an iterator
+    over the chunks of its postings, to be consumed before the next word.
+    Ties keep the order of the runs, so runs written in doc order merge into
+    postings sorted by doc ordinal.
+    """
+    merged = heapq.merge(*(read_run(path) for path in run_paths), key=lambda run: run[0])
+    for word_id, runs in groupby(merged, key=lambda run: run[0]):
+        yield word_id, (postings for _, postings in runs)
+
 
 class InvertedIndex:
     inverted_index_file = "server/data/inverted_index.json"
@@ -25,13 +75,13 @@ class InvertedIndex:
 
         # Build the inverted index
         inverted_index = defaultdict(list)
-        for doc_id, word_data in forward_index.items():
+        for ordinal, word_data in forward_index.items():
             doc_length = word_data.get("length", 0)  # Get the document length
             # Iterate over the word data
             for word_id, metadata in word_data.get("word_data", {}).items():  # Access the "word_data" key
-                # Append document information for each word
+                # Append document information for each word, doc_id holds the doc ordinal
                 inverted_index[word_id].append({
-                    "doc_id": doc_id,
+                    "doc_id": int(ordinal),
                     "frequency": metadata["frequency"],
                     "positions": metadata["positions"],
                     "doc_length": doc_length  # Store the document length
@@ -44,6 +94,53 @@ class InvertedIndex:
         print(f"Inverted index saved to {self.inverted_index_file}")
         return inverted_index
 
+    def build_barrels(self, ram_bytes=INVERSION_RAM_BYTES):
+        """
+        Bounded-memory inversion straight into binary barrels: stream the forward
+        index, spilling postings to sorted runs whenever they outgrow ram_bytes,
+        then merge the runs. inverted_index.json is not written.
+        """
+        forward_index_path = ForwardIndex(load=False).path
+        with tempfile.TemporaryDirectory(dir="server/data") as tmp_dir:
+            run_paths = []
+            inverted_index = defaultdict(list)
+            size = 0
+            total_doc_length = 0
+            doc_count = 0
+
+            def spill():
+                path = os.path.join(tmp_dir, f"run_{len(run_paths)}.pkl")
+                write_run(path, inverted_index)
+                run_paths.append(path)
+                inverted_index.clear()
+
+            with open(forward_index_path, 'rb') as f:
+                for ordinal, word_data in ijson.kvitems(f, ''):
+                    doc_length = word_data.get("length", 0)
+                    total_doc_length += doc_length
+                    doc_count += 1
+                    for word_id, metadata in word_data.get("word_data", {}).items():
+                        posting = {
+                            "doc_id": int(ordinal),
+                            "frequency": metadata["frequency"],
+                            "positions": metadata["positions"],
+                            "doc_length": doc_length
+                        }
+                        inverted_index[word_id].append(posting)
+                        size += posting_size(posting)
+                    if size >= ram_bytes:
+                        spill()
+                        size = 0
+            if inverted_index:
+                spill()
+
+            avg_doc_length = total_doc_length / doc_count if doc_count else 0.0
+            barrels = Barrels.write_binary_barrels(merge_runs(run_paths), tmp_dir, "barrel", avg_doc_length)
+            Barrels().install_binary_barrels(barrels)
+
+        print(f"Barrels built from {len(run_paths)} runs of the forward index")
+        return len(barrels)
+
     def update_inverted_index(self):
         # Ensure the inverted index is loaded
         if not hasattr(self, 'data'):
@@ -56,7 +153,7 @@ class InvertedIndex:
         inverted_index = self.data
 
         # Update the inverted index with new data from the forward index
-        for doc_id, word_data in forward_index.items():
+        for ordinal, word_data in forward_index.items():
             doc_length = word_data.get("length", 0)  # Get the document length
             for word_id, metadata in word_data.get("word_data", {}).items():
                 # Skip 'length' field as it's not a word entry
@@ -68,7 +165,7 @@ class InvertedIndex:
                 
                 # Append new document information for each word
                 inverted_index[word_id].append({
-                    "doc_id": doc_id,
+                    "doc_id": int(ordinal),
                     "frequency": metadata["frequency"],
                     "positions": metadata["positions"],
                     "length": doc_length  # Store the document length
@@ -1,95 +1,335 @@
 import pandas as pd
 import json
-import os 
+import mmap
+import os
+import struct
+import threading
 import time
+import numpy as np
+from server.lib.fileio import dump_json
+
+# Binary lexicon layout (little-endian):
+#   header       magic, term_count, blob_size
+#   offsets      u4[term_count + 1]    byte range of each term in the blob
+#   ids          u4[term_count]
+#   frequencies  u4[term_count]        collection frequency
+#   dfs          u4[term_count]        document frequency
+#   blob         utf-8 terms, sorted, so lookups are a binary search over the mmap
+# Words added after the build live in a small JSON overlay next to it, with the
+# last doc ordinal whose words it has counted.
+LEXICON_MAGIC = b"LEX1"
+LEXICON_HEADER = struct.Struct("<4sII")
+
+
+def count_terms(df):
+    """
+    Lexicon entries of the words in a frame of preprocessed documents, ids
+    numbered in order of first occurrence, title column first.
+    """
+    lexicon = {}
+
+    for column in ['title', 'abstract', 'keywords']:
+        for token in df[column]:  
+            # convert the token to a string for safety purposes
+            token = str(token)
+            try:
+                # derive token list from the string token using space as delimiter
+                token_list = token.split(" ")
+                for word in token_list:
+                    # check if the word already exists in the lexicon
+                    if word not in lexicon:
+                        # default frequency is 1
+                        lexicon[word] = {"frequency": 1, "id": len(lexicon), "df": 0}
+                    else:
+                        # increment frequency by 1 if it already exists
+                        lexicon[word]["frequency"] += 1
+            # print the error if occurs at a certain token, specifying the token as well
+            except Exception as e:
+                print(f"Error: {e} Token: {token} | Token type: {type(token)} | Column: {column}")
+
+                continue
+
+    # document frequency, counting each word once per document
+    for row in zip(*(df[column].astype(str) for column in ['title', 'abstract', 'keywords'])):
+        for word in set(" ".join(row).split(" ")):
+            if word in lexicon:
+                lexicon[word]["df"] += 1
+
+    return lexicon
+
 
 class Lexicon:
-    path = 'server/data/lexicon.json'
+    path = 'server/data/lexicon.bin'
+    added_path = 'server/data/lexicon_added.json'
+    # previous format, converted on first load
+    json_path = 'server/data/lexicon.json'
+    preprocessed_path = 'server/data/preprocessed_test_100k.csv'
+
+    # the mmap and the overlay are shared by every instance in the process
+    _table = None
+    _added = None
+    _lock = threading.Lock()
+
     def __init__(self, load=True):
         # load the lexicon on constructor call
         if load:
-            self.lexicon = self.__load()
-        
+            self.__load()
+
     # private property to load the lexicon
     def __load(self):
+        if Lexicon._table is not None:
+            return
         # check if the path exists
-        if os.path.exists(self.path):
-            with open(self.path, 'r', encoding="utf-8-sig") as json_file:
-                return json.load(json_file)
-        # if does not exists, then build the lexicon and return it
-        else:
-            print(f"Lexicon file not found! Creating one in {self.path}!")
-            return self.build()
-        
+        if not os.path.exists(self.path):
+            if os.path.exists(self.json_path):
+                print(f"Converting {self.json_path} to {self.path}")
+                self.write(self.__read_legacy())
+            # if does not exists, then build the lexicon and return it
+            else:
+                print(f"Lexicon file not found! Creating one in {self.path}!")
+                self.build()
+                return
+
+        with open(self.path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, term_count, blob_size = LEXICON_HEADER.unpack_from(mm, 0)
+        if magic != LEXICON_MAGIC:
+            raise ValueError(f"{self.path} is not a binary lexicon")
+        offset = LEXICON_HEADER.size
+        columns = {}
+        for name, count in [("offsets", term_count + 1), ("ids", term_count),
+                            ("frequencies", term_count), ("dfs", term_count)]:
+            columns[name] = np.frombuffer(mm, dtype='<u4', count=count, offset=offset)
+            offset += columns[name].nbytes
+        columns["mm"] = mm
+        columns["blob_start"] = offset
+        columns["term_count"] = term_count
+
+        added = {}
+        counted_through = -1
+        if os.path.exists(self.added_path):
+            with open(self.added_path, 'r') as f:
+                added = json.load(f)
+            # overlays saved before counted_through are the bare word dict
+            if isinstance(added.get("counted_through"), int):
+                added, counted_through = added["words"], added["counted_through"]
+        ids = [entry["id"] for entry in added.values()]
+        columns["next_id"] = max([int(columns["ids"].max()) if term_count else -1] + ids) + 1
+        columns["counted_through"] = counted_through
+
+        Lexicon._added = added
+        Lexicon._table = columns
+
+    def __read_legacy(self):
+        """Entries of the previous lexicon.json, with the document frequencies it lacks counted"""
+        with open(self.json_path, 'r', encoding="utf-8-sig") as json_file:
+            lexicon = json.load(json_file)
+        if not os.path.exists(self.preprocessed_path):
+            raise Exception(f"{self.json_path} has no document frequencies and {self.preprocessed_path} "
+                            f"is not there to count them, rebuild the lexicon")
+        counted = count_terms(pd.read_csv(self.preprocessed_path))
+        for word, entry in lexicon.items():
+            # words added after the build are not in the preprocessed CSV; a word is in no
+            # more documents than it has occurrences, so it does not pass for a rare one
+            entry["df"] = counted[word]["df"] if word in counted else entry["frequency"]
+        return lexicon
+
+    def __table(self):
+        # write() drops the shared table, the next access loads the new file
+        if Lexicon._table is None:
+            self.__load()
+        return Lexicon._table
+
+    def __added(self):
+        if Lexicon._added is None:
+            self.__load()
+        return Lexicon._added
+
+    def __term(self, i):
+        table = self.__table()
+        start = table["blob_start"]
+        return table["mm"][start + int(table["offsets"][i]):start + int(table["offsets"][i + 1])]
+
+    def __bisect(self, key):
+        """Index of the first of the sorted terms not below key"""
+        lo, hi = 0, self.__table()["term_count"]
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.__term(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __find(self, word):
+        """Index of word in the sorted terms, or None"""
+        key = word.encode()
+        lo = self.__bisect(key)
+        if lo < self.__table()["term_count"] and self.__term(lo) == key:
+            return lo
+        return None
+
+    def get(self, word):
+        """Entry of a word as {"id", "frequency", "df"}, or None if the word is unknown"""
+        if word in self.__added():
+            return self.__added()[word]
+        i = self.__find(word)
+        if i is None:
+            return None
+        table = self.__table()
+        return {"id": int(table["ids"][i]), "frequency": int(table["frequencies"][i]), "df": int(table["dfs"][i])}
+
+    def __contains__(self, word):
+        return self.get(word) is not None
+
+    def __getitem__(self, word):
+        entry = self.get(word)
+        if entry is None:
+            raise KeyError(word)
+        return entry
+
+    def __iter__(self):
+        return iter(self.words())
+
+    def __len__(self):
+        return self.__table()["next_id"]
+
+    def words(self):
+        """All words of the lexicon, decoded from the blob"""
+        table = self.__table()
+        blob = table["mm"][table["blob_start"]:]
+        offsets = table["offsets"].tolist()
+        words = [blob[offsets[i]:offsets[i + 1]].decode() for i in range(table["term_count"])]
+        return words + self.added_words()
+
+    def added_words(self):
+        """Words added since the build that are not in the binary lexicon, the last ones of words()"""
+        return [word for word in self.__added() if self.__find(word) is None]
+
+    def frequencies(self):
+        """Collection frequency of every word, in the order of words()"""
+        table = self.__table()
+        frequencies = table["frequencies"].tolist()
+        for word, entry in self.__added().items():
+            i = self.__find(word)
+            if i is None:
+                frequencies.append(entry["frequency"])
+            else:
+                frequencies[i] = entry["frequency"]
+        return frequencies
+
+    def built_count(self):
+        """Number of words in the binary lexicon, the first ones of words()"""
+        return self.__table()["term_count"]
+
+    def built_word(self, i):
+        """The i-th word of the binary lexicon, in sorted order"""
+        return self.__term(i).decode()
+
+    def built_frequencies(self):
+        """Collection frequencies of the words of the binary lexicon in sorted order, read from the mmap"""
+        return self.__table()["frequencies"]
+
+    def prefix_range(self, prefix):
+        """Range [lo, hi) of the words of the binary lexicon that start with prefix"""
+        key = prefix.encode()
+        # no UTF-8 byte is 0xff, so every word starting with the prefix sorts below this
+        return self.__bisect(key), self.__bisect(key + b"\xff")
+
+    def ids(self):
+        """{word: id} dict of the whole lexicon, for bulk lookups while building indexes"""
+        table = self.__table()
+        ids = dict(zip(self.words()[:table["term_count"]], table["ids"].tolist()))
+        ids.update((word, entry["id"]) for word, entry in self.__added().items())
+        return ids
+
     def get_word_id(self, word):
-        if word in self.lexicon:
-            return self.lexicon[word]["id"]
+        entry = self.get(word)
+        if entry is not None:
+            return entry["id"]
         else:
             return None
-        
-    
+
+    def add_word(self, word, frequency=1, documents=0):
+        """Add a word or count more occurrences of it, returning its id. Call save() to persist."""
+        with Lexicon._lock:
+            entry = self.get(word)
+            if entry is None:
+                entry = {"id": self.__table()["next_id"], "frequency": 0, "df": 0}
+                self.__table()["next_id"] += 1
+            entry = dict(entry, frequency=entry["frequency"] + frequency, df=entry["df"] + documents)
+            self.__added()[word] = entry
+            return entry["id"]
+
+    def counted_through(self):
+        """Last doc ordinal whose words the saved overlay counts, -1 if none"""
+        return self.__table()["counted_through"]
+
+    def save(self, counted_through=None):
+        """Persist the words added since the build, counting the words of the documents up to counted_through"""
+        with Lexicon._lock:
+            table = self.__table()
+            if counted_through is not None:
+                table["counted_through"] = max(table["counted_through"], counted_through)
+            dump_json({"counted_through": table["counted_through"], "words": self.__added()}, self.added_path)
+
+    @classmethod
+    def write(cls, lexicon):
+        """Write a {word: {"id", "frequency", "df"}} dict as a binary lexicon"""
+        terms = sorted(lexicon.items(), key=lambda item: item[0].encode())
+        encoded = [word.encode() for word, _ in terms]
+        offsets = np.concatenate(([0], np.cumsum([len(word) for word in encoded], dtype=np.int64)))
+        # write next to the old file and swap, a live mmap of the old one must not be truncated
+        with open(cls.path + '.tmp', 'wb') as f:
+            f.write(LEXICON_HEADER.pack(LEXICON_MAGIC, len(terms), int(offsets[-1])))
+            offsets.astype('<u4').tofile(f)
+            for field in ["id", "frequency", "df"]:
+                np.array([entry.get(field, 0) for _, entry in terms], dtype='<u4').tofile(f)
+            f.write(b"".join(encoded))
+        os.replace(cls.path + '.tmp', cls.path)
+        # a rebuilt lexicon starts without added words, and instances load it again on next use
+        if os.path.exists(cls.added_path):
+            os.remove(cls.added_path)
+        Lexicon._table = None
+        Lexicon._added = None
+
     def build(self):
-        df = pd.read_csv('server/data/preprocessed_test_100k.csv')
-        lexicon = {}
-        
-        for column in ['title', 'abstract', 'keywords']:  
-            for token in df[column]:  
-                # convert the token to a string for safety purposes
-                token = str(token) 
-                try:
-                    # derive token list from the string token using space as delimiter
-                    token_list = token.split(" ") 
-                    for word in token_list: 
-                        # check if the word already exists in the lexicon
-                        if word not in lexicon:
-                            # default frequency is 1
-                            lexicon[word] = {"frequency": 1, "id":len(lexicon)} 
-                        else:
-                            # increment frequency by 1 if it already exists
-                            lexicon[word]["frequency"] += 1
-                # print the error if occurs at a certain token, specifying the token as well
-                except Exception as e:
-                    print(f"Error: {e} Token: {token} | Token type: {type(token)} | Column: {column}")
-                    
-                    continue
+        df = pd.read_csv(self.preprocessed_path)
+        lexicon = count_terms(df)
+
         # save the lexicon to the path specified in the class privately
-        with open(self.path, 'w') as json_file:
-            json.dump(lexicon, json_file, indent=4)
+        self.write(lexicon)
+        self.__load()
 
         return lexicon
+
     def update_lexicon(self,new_doc):
         """
         Update the existing lexicon with a new document.
         :param new_doc: Dictionary containing 'title', 'abstract', and 'keywords'.
         """
+        seen = set()
         for column in ['title', 'abstract', 'keywords']:
             if column in new_doc:
                 # Process the text into tokens
                 token_list = str(new_doc[column]).split(" ")
-                for word in token_list: 
-                    # check if the word already exists in the lexicon
-                    if word not in self.lexicon:
-                        # default frequency is 1
-                        self.lexicon[word] = {"frequency": 1, "id":len(self.lexicon)} 
-                    else:
-                        # increment frequency by 1 if it already exists
-                        self.lexicon[word]["frequency"] += 1
-        
-    
-        # save the lexicon to the path specified in the class privately
-        with open(self.path, 'w') as json_file:
-            json.dump(self.lexicon, json_file, indent=4)
+                for word in token_list:
+                    self.add_word(word, documents=int(word not in seen))
+                    seen.add(word)
+
+        # save the added words next to the lexicon
+        self.save()
+
+        print(f"Lexicon updated and saved to {self.added_path}")
 
-        print(f"Lexicon updated and saved to {self.path}")
 
-        
 if __name__ == "__main__":
-    lexicon = Lexicon()
+    lexicon = Lexicon(load=False)
     start = time.time()
-    lexicon.build()
+    entries = lexicon.build()
 
     # rank all words by frequency
-    sorted_lexicon = sorted(lexicon.lexicon.items(), key=lambda x: x[1]["frequency"], reverse=True)
+    sorted_lexicon = sorted(entries.items(), key=lambda x: x[1]["frequency"], reverse=True)
     print("Top 10 words by frequency:")
     for i in range(50):
         print(sorted_lexicon[i])
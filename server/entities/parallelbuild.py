@@ -0,0 +1,205 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from server.entities.lexicon import Lexicon, count_terms
+from server.entities.forwardindex import index_document
+from server.entities.docmap import DocMap
+from server.entities.invertindex import merge_runs, write_run
+from server.entities.barrels import Barrels
+from server.lib.pool import ordered_map
+
+# documents handed to a worker at a time
+SHARD_ROWS = 20000
+
+TEXT_COLUMNS = ['title', 'abstract', 'keywords']
+# text columns stay strings in every chunk, whatever pandas would infer from it
+CSV_DTYPES = {'id': str, 'title': str, 'abstract': str, 'keywords': str}
+
+# word ids of the lexicon, loaded once per indexing worker
+_word_ids = None
+
+
+def _count_shard(df):
+    """Term counts of a shard, with the distinct words of each column in order of first occurrence"""
+    columns = [list(dict.fromkeys(word for token in df[column] for word in str(token).split(" ")))
+               for column in TEXT_COLUMNS]
+    return count_terms(df), columns
+
+
+def _load_word_ids():
+    global _word_ids
+    _word_ids = Lexicon().ids()
+
+
+def _invert_shard(shard, start, df, tmp_dir, partitions, vocab_size):
+    """
+    Forward index a shard of documents numbered from start, writing its
+    forward index entries and one run of postings per term partition.
+    """
+    forward_index = {}
+    inverted_index = defaultdict(list)
+    total_doc_length = 0
+
+    for ordinal, (title, abstract, keywords) in enumerate(zip(df['title'], df['abstract'], df['keywords']), start):
+        entry = forward_index[ordinal] = index_document(title, abstract, keywords, _word_ids)
+        total_doc_length += entry["length"]
+        for word_id, data in entry["word_data"].items():
+            inverted_index[word_id].append({
+                "doc_id": ordinal,
+                "frequency": data["frequency"],
+                "positions": data["positions"],
+                "doc_length": entry["length"]
+            })
+
+    # the members of the forward index object, without its braces
+    fragment_path = os.path.join(tmp_dir, f"forward_{shard}.json")
+    with open(fragment_path, 'w') as f:
+        f.write(json.dumps(forward_index)[1:-1])
+
+    # runs are sorted by word id so the partitions can be merged without loading them
+    partitioned = [{} for _ in range(partitions)]
+    for word_id, postings in inverted_index.items():
+        partitioned[min(word_id * partitions // vocab_size, partitions - 1)][word_id] = postings
+    run_paths = [os.path.join(tmp_dir, f"run_{shard}_{p}.pkl") for p in range(partitions)]
+    for path, postings_by_word in zip(run_paths, partitioned):
+        write_run(path, postings_by_word)
+
+    return fragment_path, run_paths, total_doc_length, len(df)
+
+
+def _merge_partition(partition, run_paths, tmp_dir, avg_doc_length):
+    """Merge the runs of a term partition, in shard order, into binary barrels"""
+    return Barrels.write_binary_barrels(merge_runs(run_paths), tmp_dir, f"barrel_{partition}", avg_doc_length)
+
+
+class ParallelIndexBuilder:
+    """
+    Sharded build of the lexicon, doc map, forward index and binary barrels,
+    spreading the preprocessed CSV over a process pool.
+    """
+
+    def __init__(self, workers=None, shard_rows=SHARD_ROWS):
+        self.input_file = "server/data/preprocessed_test_100k.csv"
+        self.forward_index_path = "server/data/forward_index.json"
+        self.metadata_path = "server/data/metadata.json"
+        self.workers = workers or os.cpu_count()
+        self.shard_rows = shard_rows
+
+    def __shards(self):
+        return pd.read_csv(self.input_file, usecols=['id'] + TEXT_COLUMNS, dtype=CSV_DTYPES,
+                           chunksize=self.shard_rows)
+
+    def __map(self, executor, fn, jobs):
+        """Results of fn over the jobs in order, with at most two shards per worker in flight"""
+        return ordered_map(executor, fn, jobs, 2 * self.workers)
+
+    def build_lexicon(self):
+        """
+        Count the terms of every shard and merge them into the lexicon and doc
+        map. Ids are given as the sequential build does, by first occurrence in
+        every title, then every abstract, then every keyword list.
+        """
+        counts = {}
+        columns = [[] for _ in TEXT_COLUMNS]
+        doc_ids = []
+
+        def jobs():
+            for df in self.__shards():
+                doc_ids.extend(df['id'])
+                yield (df[TEXT_COLUMNS],)
+
+        with ProcessPoolExecutor(self.workers) as executor:
+            for terms, words in self.__map(executor, _count_shard, jobs()):
+                for word, entry in terms.items():
+                    merged = counts.get(word)
+                    if merged is None:
+                        counts[word] = {"frequency": entry["frequency"], "df": entry["df"]}
+                    else:
+                        merged["frequency"] += entry["frequency"]
+                        merged["df"] += entry["df"]
+                for column, column_words in zip(columns, words):
+                    column.append(column_words)
+
+        # a shard's ids only hold within the shard, so they are given once all are counted
+        lexicon = {}
+        for column in columns:
+            for column_words in column:
+                for word in column_words:
+                    if word not in lexicon:
+                        lexicon[word] = {"frequency": counts[word]["frequency"], "id": len(lexicon),
+                                         "df": counts[word]["df"]}
+
+        Lexicon.write(lexicon)
+        # documents are numbered 0..N-1 in dataset order, the doc map keeps their external ids
+        DocMap.build(doc_ids)
+        return lexicon
+
+    def build_indexes(self, tmp_dir, vocab_size):
+        """Forward index the shards in parallel, then merge their postings into barrels a partition per worker"""
+        partitions = self.workers
+
+        def jobs():
+            start = 0
+            for shard, df in enumerate(self.__shards()):
+                df = df.fillna({'title': '', 'abstract': '', 'keywords': ''})
+                yield shard, start, df[TEXT_COLUMNS], tmp_dir, partitions, max(vocab_size, 1)
+                start += len(df)
+
+        with ProcessPoolExecutor(self.workers, initializer=_load_word_ids) as executor:
+            shards = list(self.__map(executor, _invert_shard, jobs()))
+
+        # the forward index is the shard fragments joined into one object
+        with open(self.forward_index_path, 'w') as f:
+            f.write('{')
+            first = True
+            for fragment_path, _, _, _ in shards:
+                if os.path.getsize(fragment_path) == 0:
+                    continue
+                if not first:
+                    f.write(',')
+                first = False
+                with open(fragment_path, 'r') as fragment:
+                    shutil.copyfileobj(fragment, f)
+            f.write('}')
+
+        metadata = {
+            "total_doc_length": sum(shard[2] for shard in shards),
+            "forward_index_length": sum(shard[3] for shard in shards)
+        }
+        with open(self.metadata_path, "w") as meta_file:
+            json.dump(metadata, meta_file, indent=1)
+
+        avg_doc_length = metadata["total_doc_length"] / metadata["forward_index_length"] if shards else 0.0
+        with ProcessPoolExecutor(self.workers) as executor:
+            futures = [executor.submit(_merge_partition, p, [shard[1][p] for shard in shards], tmp_dir, avg_doc_length)
+                       for p in range(partitions)]
+            barrels = [barrel for future in futures for barrel in future.result()]
+
+        Barrels().install_binary_barrels(barrels)
+        return metadata
+
+    def build(self):
+        start = time.time()
+        lexicon = self.build_lexicon()
+        end = time.time()
+        print(f"lexicon built in {end-start}")
+
+        start = time.time()
+        # runs and barrels are staged next to the data so they can be moved into place
+        with tempfile.TemporaryDirectory(dir="server/data") as tmp_dir:
+            metadata = self.build_indexes(tmp_dir, len(lexicon))
+        end = time.time()
+        print(f"forward index and barrels built in {end-start} with {self.workers} workers")
+        return metadata
+
+
+if __name__ == "__main__":
+    start = time.time()
+    ParallelIndexBuilder().build()
+    end = time.time()
+    print(f"Indexes built in {end - start} seconds")
@@ -1,9 +1,27 @@
 import os
 import time
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 from server.lib.utils import preprocess_text
+from server.lib.pool import ordered_map
 
-def preprocess_dataset(file_path, output_path):
+# rows handed to a preprocessing worker at a time
+PREPROCESS_CHUNK_ROWS = 5000
+
+
+def preprocess_chunk(df):
+    """Preprocess the title, abstract and keywords of a chunk of the dataset"""
+    # preprocess title and abstract
+    for column in ['title', 'abstract']:
+        df[column] = df[column].apply(lambda x: preprocess_text(x) if isinstance(x, str) else [])
+
+    # preprocess keywords i.e it is an array of strings, concatenate them into a single string
+    if 'keywords' in df.columns:
+        df['keywords'] = df['keywords'].apply(lambda x: ' '.join([word.lower() for word in eval(x)]) if isinstance(x, str) else '').apply(lambda x: preprocess_text(x) if isinstance(x, str) else [])
+
+    return df
+
+def preprocess_dataset(file_path, output_path, workers=None, chunk_rows=PREPROCESS_CHUNK_ROWS):
     """
     We toke the following preprocessing steps:  
     -> Handling contractions
@@ -11,27 +29,28 @@ def preprocess_dataset(file_path, output_path):
     -> Normalization
     -> Removing stop words
     -> Lemmatization
+
+    Chunks of the csv are preprocessed in a process pool and written to the
+    output in their original order.
     """
 
     start_time = time.time()
+    workers = workers or os.cpu_count()
+    rows = 0
 
-    # load csv file
-    df = pd.read_csv(file_path)
-
-    # preprocess title and abstract
-    for column in ['title', 'abstract']:
-        df[column] = df[column].apply(lambda x: preprocess_text(x) if isinstance(x, str) else [])
-
-    # preprocess keywords i.e it is an array of strings, concatenate them into a single string
-    if 'keywords' in df.columns:
-        df['keywords'] = df['keywords'].apply(lambda x: ' '.join([word.lower() for word in eval(x)]) if isinstance(x, str) else '').apply(lambda x: preprocess_text(x) if isinstance(x, str) else [])
+    # every column is read as text, so ids and numbers are written back unchanged whatever the chunk holds
+    chunks = ((df,) for df in pd.read_csv(file_path, dtype=str, chunksize=chunk_rows))
 
-    # save the preprocessed data to the new file
-    df.to_csv(output_path, index=False)
+    with ProcessPoolExecutor(workers) as executor:
+        for df in ordered_map(executor, preprocess_chunk, chunks, 2 * workers):
+            # save the preprocessed data to the new file, the header with the first chunk
+            df.to_csv(output_path, mode='w' if rows == 0 else 'a', header=rows == 0, index=False)
+            rows += len(df)
+            print(f"{rows} rows processed, {rows / (time.time() - start_time):.0f} rows/s")
   
     end_time = time.time()
-    print(f"{len(df)} rows processed.")
-    print(f"Preprocessing completed in {end_time - start_time:.2f} seconds.")
+    print(f"{rows} rows processed.")
+    print(f"Preprocessing completed in {end_time - start_time:.2f} seconds with {workers} workers.")
     print(f"Processed file saved to: {output_path}")
 
 if __name__ == "__main__":
@@ -0,0 +1,253 @@
+import json
+import os
+import threading
+import time
+from server.entities.lexicon import Lexicon
+from server.entities.docmap import DocMap
+from server.entities.docindex import DocumentIndex
+from server.entities.barrels import Barrels
+from server.entities.segments import SegmentIndex
+from server.functions.autosuggest import open_autosuggestion
+from server.functions.spelling import SpellingIndex
+from server.lib.fileio import dump_json, fsync_path
+
+METADATA_PATH = "server/data/metadata.json"
+BARREL_METADATA_PATH = "server/data/barrel_metadata.json"
+
+# seconds between checks for an in-memory segment due a flush, so one older than
+# SEGMENT_FLUSH_SECONDS is checkpointed even when no add arrives to notice
+CHECKPOINT_CHECK_SECONDS = 30
+
+# artifacts every search touches, opened when the server starts
+SEARCH_ARTIFACTS = ["lexicon", "metadata", "barrel_metadata", "doc_map", "documents", "segments", "spelling"]
+
+
+class SearchIndex:
+    """
+    Every index artifact the server reads, each opened once on first use and
+    shared by all routes, calculate_bm25 and AddContent.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # serialises writers such as AddContent, which update the shared metadata in place
+        self.write_lock = threading.RLock()
+        # adds reserve their ordinals and CSV offsets under write_lock, then write their
+        # files outside it, each waiting here for the adds reserved before it
+        self.applied = threading.Condition()
+        self.next_ordinal = None
+        self.next_offset = None
+        self.applied_through = None
+        self.timings = {}
+        self._lexicon = None
+        self._doc_map = None
+        self._documents = None
+        self._barrels = None
+        self._segments = None
+        self._metadata = None
+        self._barrel_metadata = None
+        self._words = None
+        self._autosuggest = None
+        self._spelling = None
+
+    def __load(self, name, loader):
+        value = getattr(self, f"_{name}")
+        if value is None:
+            with self.lock:
+                value = getattr(self, f"_{name}")
+                if value is None:
+                    start = time.time()
+                    value = loader()
+                    self.timings[name] = time.time() - start
+                    setattr(self, f"_{name}", value)
+        return value
+
+    @staticmethod
+    def __read_json(path):
+        try:
+            with open(path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            raise Exception(f"Required {path} file not found")
+
+    @property
+    def lexicon(self):
+        return self.__load("lexicon", Lexicon)
+
+    @property
+    def doc_map(self):
+        return self.__load("doc_map", DocMap)
+
+    @property
+    def documents(self):
+        """DocumentIndex with its CSV file kept open until close()"""
+        return self.__load("documents", lambda: DocumentIndex().__enter__())
+
+    @property
+    def barrels(self):
+        return self.__load("barrels", Barrels)
+
+    @property
+    def segments(self):
+        """Documents added since the build, replayed from their log on first use"""
+        return self.__load("segments", self.__open_segments)
+
+    def __open_segments(self):
+        segments = SegmentIndex(self.lexicon, lambda: self.avg_doc_length)
+        # a crash may have cut an add short after its log record, redo the rest of it
+        self.apply_documents(segments.replayed)
+        segments.replayed = []
+        threading.Thread(target=self.__checkpoint_loop, daemon=True).start()
+        return segments
+
+    def __checkpoint_loop(self):
+        while True:
+            time.sleep(CHECKPOINT_CHECK_SECONDS)
+            try:
+                if self.segments.needs_flush():
+                    self.checkpoint()
+            except Exception as e:
+                print(f"Error checkpointing added documents: {e}")
+
+    @property
+    def metadata(self):
+        return self.__load("metadata", lambda: self.__read_json(METADATA_PATH))
+
+    @property
+    def barrel_metadata(self):
+        return self.__load("barrel_metadata", lambda: self.__read_json(BARREL_METADATA_PATH))
+
+    @property
+    def words(self):
+        return self.__load("words", self.lexicon.words)
+
+    @property
+    def autosuggest(self):
+        return self.__load("autosuggest", lambda: open_autosuggestion(self.lexicon))
+
+    @property
+    def spelling(self):
+        """Typo corrections from the lexicon, built on first use and saved for the next start"""
+        return self.__load("spelling", lambda: SpellingIndex(self.lexicon))
+
+    @property
+    def document_count(self):
+        return self.metadata["forward_index_length"]
+
+    @property
+    def avg_doc_length(self):
+        return self.metadata["total_doc_length"] / self.metadata["forward_index_length"]
+
+    def barrel_of(self, word_id):
+        """Barrel of a word, None for words only in documents added since the build"""
+        return self.barrel_metadata.get(word_id)
+
+    def postings(self, word_id):
+        """Postings blocks of a word, from its barrel and then from the segments"""
+        word_id = str(word_id)
+        blocks = []
+        barrel_id = self.barrel_of(word_id)
+        if barrel_id is not None:
+            blocks.extend(self.barrels.get_postings(barrel_id, word_id))
+        return blocks + self.segments.postings(word_id)
+
+    def reserve(self, rows):
+        """
+        First ordinal and CSV offset of an add with the given rows, reserving
+        them for it. Called under write_lock.
+        """
+        if self.next_ordinal is None:
+            self.segments  # replays the log, the files cover every logged add after it
+            self.next_ordinal = self.applied_through = len(self.doc_map)
+            self.next_offset = os.path.getsize(self.documents.csv_path)
+        first, offset = self.next_ordinal, self.next_offset
+        self.next_ordinal += len(rows)
+        self.next_offset += sum(len(row) for row in rows)
+        return first, offset
+
+    def unreserve(self, first, offset):
+        """Give back the last reservation, for an add that failed before logging it"""
+        self.next_ordinal, self.next_offset = first, offset
+
+    def apply_in_order(self, first, records, position):
+        """
+        Wait for the log to be on disk up to position, then apply the add
+        reserved from first once every add reserved before it has applied:
+        its files, then its postings, so a search never finds an ordinal the
+        doc map lacks. A failed add passes its turn on too.
+        """
+        error = None
+        try:
+            # the log record goes to disk before any file it would redo
+            self.segments.commit(position)
+        except Exception as e:
+            error = e
+        with self.applied:
+            while self.applied_through != first:
+                self.applied.wait()
+        try:
+            if error is not None:
+                raise error
+            self.apply_documents(records)
+            self.segments.add_documents(records)
+        finally:
+            with self.applied:
+                self.applied_through = first + len(records)
+                self.applied.notify_all()
+
+    def apply_documents(self, records):
+        """
+        Write logged adds to the doc map, the CSV, the document index and the
+        metadata counts, skipping whatever of them is already there. Adds call
+        it one at a time, in ordinal order, through apply_in_order.
+        """
+        new = [record for record in records if record["ordinal"] >= len(self.doc_map)]
+        if new:
+            if new[0]["ordinal"] != len(self.doc_map):
+                # an earlier add failed part way; its log record is replayed on restart
+                raise Exception(f"Documents before ordinal {new[0]['ordinal']} were not applied")
+            self.doc_map.extend([record["doc_id"] for record in new])
+        unwritten = [record for record in records if not self.documents.has_row(record["ordinal"])]
+        if unwritten:
+            self.documents.append_rows(unwritten[0]["ordinal"], unwritten[0]["offset"],
+                                       [record["row"].encode() for record in unwritten])
+        # the counts cover the ordinals below forward_index_length
+        uncounted = [record for record in records if record["ordinal"] >= self.metadata["forward_index_length"]]
+        self.metadata["forward_index_length"] += len(uncounted)
+        self.metadata["total_doc_length"] += sum(record["length"] for record in uncounted)
+
+    def checkpoint(self):
+        """
+        Put the adds applied so far on disk for good, the metadata included, then
+        flush the in-memory segment, which drops their log.
+        """
+        with self.write_lock:
+            # no add reserves meanwhile; those reserved must be in the files before their log goes
+            with self.applied:
+                while self.applied_through != self.next_ordinal:
+                    self.applied.wait()
+            for path in (DocMap.path, self.documents.csv_path, self.documents.index_path):
+                fsync_path(path)
+            dump_json(self.metadata, METADATA_PATH)
+            self.segments.flush()
+
+    def open(self, names=SEARCH_ARTIFACTS):
+        """Open the given artifacts now rather than on first use"""
+        for name in names:
+            getattr(self, name)
+        return self
+
+    def report(self):
+        """Print how long each artifact took to open"""
+        for name, seconds in self.timings.items():
+            print(f"{name} loaded in {seconds:.4f} seconds")
+        print(f"index opened in {sum(self.timings.values()):.4f} seconds")
+        return dict(self.timings)
+
+    def close(self):
+        if self._documents is not None:
+            self._documents.__exit__(None, None, None)
+            self._documents = None
+
+
+search_index = SearchIndex()
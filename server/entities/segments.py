@@ -0,0 +1,238 @@
+import json
+import math
+import os
+import shutil
+import threading
+import time
+from collections import defaultdict
+import numpy as np
+from server.entities.barrels import BarrelPostings, BinaryBarrel
+from server.entities.wal import WriteAheadLog
+from server.lib.fileio import dump_json, fsync_path
+
+SEGMENTS_DIR = "server/data/segments"
+
+# documents buffered in the in-memory segment before it is flushed to disk
+SEGMENT_FLUSH_DOCS = 1000
+# or once its oldest document has waited this many seconds
+SEGMENT_FLUSH_SECONDS = 300
+# segments of the same size tier merged into one at a time
+SEGMENT_MERGE_FACTOR = 8
+
+
+class SegmentIndex:
+    """
+    Postings of the documents added since the barrels were built. New documents
+    go to an in-memory segment, logged to the pending.jsonl write-ahead log so a
+    restart can replay them, and are flushed every SEGMENT_FLUSH_DOCS documents
+    or SEGMENT_FLUSH_SECONDS as an immutable binary segment in the barrel
+    format. A background thread merges SEGMENT_MERGE_FACTOR segments of a size
+    tier into one.
+    """
+
+    def __init__(self, lexicon, avg_doc_length, directory=SEGMENTS_DIR):
+        self.lexicon = lexicon
+        # the average document length is read when a segment is written
+        self.avg_doc_length = avg_doc_length
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "segments.json")
+        self.log_path = os.path.join(directory, "pending.jsonl")
+        self.lock = threading.RLock()
+        self.merging = False
+        os.makedirs(directory, exist_ok=True)
+
+        manifest = {"generation": 0, "flushed_through": -1, "segments": []}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        self.generation = manifest["generation"]
+        self.flushed_through = manifest["flushed_through"]
+        self.segments = [dict(segment, barrel=BinaryBarrel(os.path.join(directory, segment["name"])))
+                         for segment in manifest["segments"]]
+
+        self.memory = defaultdict(list)
+        self.memory_docs = 0
+        self.memory_ordinals = []
+        self.memory_since = None
+        self.log = WriteAheadLog(self.log_path)
+        # the records replayed, for the owner of the other files an add writes to redo them
+        self.replayed = self.__replay()
+
+    def __replay(self):
+        """Rebuild the in-memory segment from the documents logged since the last flush"""
+        replayed = [record for record in self.log.replay() if record["ordinal"] > self.flushed_through]
+        # a crash between saving the lexicon and the manifest leaves records whose words it counted
+        counted_through = self.lexicon.counted_through()
+        for record in replayed:
+            terms = {}
+            for word, (frequency, positions) in record["terms"].items():
+                if record["ordinal"] <= counted_through:
+                    word_id = self.lexicon[word]["id"]
+                else:
+                    word_id = self.lexicon.add_word(word, frequency=sum(frequency), documents=1)
+                terms[word_id] = (frequency, positions)
+            self.__apply(record["ordinal"], record["length"], terms)
+        print(f"Replayed {self.memory_docs} added documents from {self.log_path}")
+        return replayed
+
+    def __apply(self, ordinal, length, terms):
+        for word_id, (frequency, positions) in terms.items():
+            self.memory[str(word_id)].append({
+                "doc_id": ordinal,
+                "frequency": frequency,
+                "positions": positions,
+                "doc_length": length
+            })
+        self.memory_docs += 1
+        self.memory_ordinals.append(ordinal)
+        if self.memory_since is None:
+            self.memory_since = time.time()
+
+    def log_documents(self, records):
+        """
+        Log documents with a single write, returning the log position to commit()
+        before anything else the adds write. Each record has the document's
+        ordinal, length and terms, a map of its words to their (section
+        frequencies, positions); any other field is logged with them for replay.
+        """
+        return self.log.append(records)
+
+    def add_documents(self, records):
+        """Index logged documents, whose words are already in the lexicon, in the in-memory segment"""
+        with self.lock:
+            for record in records:
+                self.__apply(record["ordinal"], record["length"],
+                             {self.lexicon[word]["id"]: posting for word, posting in record["terms"].items()})
+
+    def commit(self, position):
+        """Wait until the documents logged up to position are on disk"""
+        self.log.sync(position)
+
+    def needs_flush(self):
+        """Whether the in-memory segment is due to be flushed"""
+        with self.lock:
+            return self.memory_docs >= SEGMENT_FLUSH_DOCS or (
+                self.memory_since is not None and time.time() - self.memory_since >= SEGMENT_FLUSH_SECONDS)
+
+    def postings(self, word_id):
+        """Postings blocks of a word in every segment, the in-memory one last"""
+        word_id = str(word_id)
+        with self.lock:
+            segments = list(self.segments)
+            memory = list(self.memory.get(word_id, []))
+        blocks = [postings for postings in (segment["barrel"].get(word_id) for segment in segments)
+                  if postings is not None]
+        if memory:
+            blocks.append(BarrelPostings.from_json(memory))
+        return blocks
+
+    def __write_segment(self, terms, docs):
+        """Write (word_id, postings) pairs as the next segment file, returning its manifest entry"""
+        avg_doc_length = self.avg_doc_length()
+        encoded = []
+        for word_id, postings in terms:
+            df, max_score, data = BinaryBarrel.encode(postings, avg_doc_length)
+            encoded.append((word_id, df, max_score, data))
+        with self.lock:
+            name = f"segment_{self.generation}.bin"
+            self.generation += 1
+        BinaryBarrel.write(os.path.join(self.directory, name), encoded, avg_doc_length)
+        fsync_path(os.path.join(self.directory, name))
+        return {"name": name, "docs": docs, "barrel": BinaryBarrel(os.path.join(self.directory, name))}
+
+    def __save_manifest(self):
+        manifest = {
+            "generation": self.generation,
+            "flushed_through": self.flushed_through,
+            "segments": [{"name": segment["name"], "docs": segment["docs"]} for segment in self.segments]
+        }
+        dump_json(manifest, self.manifest_path, indent=1)
+
+    def flush(self):
+        """
+        Write the in-memory segment to disk and start a new one, dropping the log.
+        Whatever else the logged adds wrote must be on disk already.
+        """
+        with self.lock:
+            if not self.memory_docs:
+                return
+            segment = self.__write_segment(sorted(self.memory.items(), key=lambda term: int(term[0])), self.memory_docs)
+            flushed_through = max(self.flushed_through, max(self.memory_ordinals))
+            # the words of the flushed documents must outlive the log that could replay them
+            self.lexicon.save(counted_through=flushed_through)
+            self.segments.append(segment)
+            self.flushed_through = flushed_through
+            self.__save_manifest()
+            self.log.truncate()
+            self.memory = defaultdict(list)
+            self.memory_docs = 0
+            self.memory_ordinals = []
+            self.memory_since = None
+            print(f"Flushed {segment['docs']} documents to {segment['name']}")
+
+            if self.__merge_candidates() and not self.merging:
+                self.merging = True
+                threading.Thread(target=self.__merge_loop, daemon=True).start()
+
+    def __merge_candidates(self):
+        """Oldest SEGMENT_MERGE_FACTOR segments of the first size tier that has that many"""
+        tiers = defaultdict(list)
+        for segment in self.segments:
+            tier = int(math.log(max(segment["docs"] / SEGMENT_FLUSH_DOCS, 1), SEGMENT_MERGE_FACTOR))
+            tiers[tier].append(segment)
+        for tier in sorted(tiers):
+            if len(tiers[tier]) >= SEGMENT_MERGE_FACTOR:
+                return tiers[tier][:SEGMENT_MERGE_FACTOR]
+        return None
+
+    def __merge_loop(self):
+        try:
+            while True:
+                with self.lock:
+                    segments = self.__merge_candidates()
+                    if not segments:
+                        self.merging = False
+                        return
+                self.merge(segments)
+        except Exception as e:
+            print(f"Error merging segments: {e}")
+            with self.lock:
+                self.merging = False
+
+    def merge(self, segments):
+        """Merge segments into one, replacing them where the first of them was"""
+        word_ids = np.unique(np.concatenate([segment["barrel"].word_ids for segment in segments]))
+        terms = []
+        for word_id in word_ids.tolist():
+            postings = []
+            for segment in segments:
+                block = segment["barrel"].get(word_id)
+                if block is not None:
+                    postings.extend(block.to_json())
+            terms.append((word_id, postings))
+        merged = self.__write_segment(terms, sum(segment["docs"] for segment in segments))
+
+        with self.lock:
+            names = {segment["name"] for segment in segments}
+            position = min(i for i, segment in enumerate(self.segments) if segment["name"] in names)
+            self.segments = [segment for segment in self.segments if segment["name"] not in names]
+            self.segments.insert(position, merged)
+            self.__save_manifest()
+        # readers still holding a merged segment keep its mapping after the unlink
+        for name in names:
+            os.remove(os.path.join(self.directory, name))
+        print(f"Merged {len(segments)} segments into {merged['name']}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                "segments": len(self.segments),
+                "segment_docs": [segment["docs"] for segment in self.segments],
+                "memory_docs": self.memory_docs,
+                "merging": self.merging
+            }
+
+    @staticmethod
+    def reset(directory=SEGMENTS_DIR):
+        """Drop every segment, for a rebuild from the dataset"""
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import time
+
+# seconds between background fsyncs of the log; 0 fsyncs before every add is
+# acknowledged, one fsync shared by the adds waiting at the same time
+WAL_SYNC_INTERVAL = 0
+
+
+class WriteAheadLog:
+    """
+    Append-only log of JSON records, one per line. Writers append and then wait
+    in sync() until an fsync covers their records; whoever fsyncs covers every
+    record written before it, so concurrent writers share one fsync (group
+    commit). With a sync_interval a background thread fsyncs instead and sync()
+    returns at once, risking up to sync_interval seconds of acknowledged adds.
+    Positions are bytes ever appended, so they keep growing across truncate().
+    """
+
+    def __init__(self, path, sync_interval=WAL_SYNC_INTERVAL):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.lock = threading.Lock()
+        self.synced = threading.Condition()
+        self.syncing = False
+        self.file = open(path, 'ab')
+        self.written = self.synced_through = 0
+        if sync_interval:
+            threading.Thread(target=self.__sync_loop, daemon=True).start()
+
+    def replay(self):
+        """Records of the log, dropping a last record cut short by a crash"""
+        records = []
+        end = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # nothing after it was acknowledged
+                    break
+                end += len(line)
+        with self.lock:
+            self.file.truncate(end)
+        return records
+
+    def append(self, records):
+        """Write records to the log, returning the position sync() must reach to make them durable"""
+        data = b"".join(json.dumps(record).encode() + b"\n" for record in records)
+        with self.lock:
+            self.file.write(data)
+            self.file.flush()
+            self.written += len(data)
+            return self.written
+
+    def sync(self, position):
+        """Wait until the log is on disk up to position"""
+        if self.sync_interval:
+            return
+        with self.synced:
+            while self.synced_through < position:
+                if not self.syncing:
+                    break
+                self.synced.wait()
+            else:
+                return
+            self.syncing = True
+        self.__fsync()
+
+    def __fsync(self):
+        # everything counted in written was flushed to the OS before the fsync starts
+        target = self.written
+        try:
+            os.fsync(self.file.fileno())
+        finally:
+            with self.synced:
+                self.syncing = False
+                self.synced_through = max(self.synced_through, target)
+                self.synced.notify_all()
+
+    def __sync_loop(self):
+        while True:
+            time.sleep(self.sync_interval)
+            if self.synced_through < self.written:
+                self.__fsync()
+
+    def truncate(self):
+        """Drop every record, once what they describe is durable elsewhere"""
+        with self.lock:
+            self.file.truncate(0)
+            with self.synced:
+                self.synced_through = self.written
+                self.synced.notify_all()
@@ -1,13 +1,32 @@
+import csv
+import io
 import json
 import os
-import pandas as pd
 import uuid
-from server.entities.barrels import Barrels
+from concurrent.futures.process import BrokenProcessPool
+from server.entities.searchindex import search_index
+from server.lib.pool import discard_process_pool, process_pool
 from server.lib.utils import preprocess_text
 
+# batches smaller than this are preprocessed in-process, a pool costs more than it saves
+BULK_PARALLEL_MIN_DOCS = 256
+BULK_WORKERS = os.cpu_count()
+
+
+def preprocess_sections(doc):
+    """Preprocessed title, abstract and keywords of a document"""
+    keywords = ' '.join(doc['keywords']) if isinstance(doc['keywords'], list) else doc['keywords']
+    return [preprocess_text(doc['title']), preprocess_text(doc['abstract']), preprocess_text(keywords)]
+
+
+def start_bulk_pool():
+    """Fork the workers large adds preprocess in, where there is more than one core"""
+    if BULK_WORKERS > 1:
+        process_pool(BULK_WORKERS)
+
+
 class AddContent:
-    def __init__(self):
-        self.lexicon_path = "server/data/lexicon.json"
+    def __init__(self, index=search_index):
         self.forward_index_path = "server/data/forward_index.json"
         self.barrel_dir = "server/data/barrels"
         self.dataset_path = "server/data/test_100k.csv"
@@ -16,25 +35,15 @@ class AddContent:
         # Initialize files first
         self._initialize_files()
         
-        # Load lexicon and initialize counts
-        self.lexicon = self._load_lexicon()
+        # Share the lexicon, barrels and metadata with the search side
+        self.index = index
+        self.lexicon = index.lexicon
         self.words_count = len(self.lexicon)
-        self.barrels = Barrels()
-
-    def _load_lexicon(self):
-        """Load lexicon from file"""
-        try:
-            with open(self.lexicon_path, 'r') as f:
-                return json.load(f)
-        except (FileNotFoundError, json.JSONDecodeError):
-            return {}
+        self.barrels = index.barrels
+        self.doc_map = index.doc_map
 
     def _initialize_files(self):
         """Initialize empty files if they don't exist"""
-        if not os.path.exists(self.lexicon_path):
-            with open(self.lexicon_path, 'w') as f:
-                json.dump({}, f)
-        
         if not os.path.exists(self.forward_index_path):
             with open(self.forward_index_path, 'w') as f:
                 json.dump({}, f)
@@ -42,30 +51,11 @@ class AddContent:
         if not os.path.exists(self.barrel_dir):
             os.makedirs(self.barrel_dir)
 
-    def update_lexicon(self, word):
-        """Add new word to lexicon if it does not exist"""
-        with open(self.lexicon_path, 'r+') as f:
-            try:
-                lexicon = json.load(f)
-                if word not in lexicon:
-                    new_id = len(lexicon)
-                    lexicon[word] = {"frequency": 1, "id": new_id}
-                    print("term", word, new_id)
-                else:
-                    lexicon[word]["frequency"] += 1
-                    new_id = lexicon[word]["id"]
-                
-                f.seek(0)
-                json.dump(lexicon, f, indent=4)
-                f.truncate()
-                return new_id
-                
-            except json.JSONDecodeError:
-                lexicon = {word: {"frequency": 1, "id": 0}}
-                f.seek(0)
-                json.dump(lexicon, f, indent=4)
-                f.truncate()
-                return 0
+    def update_lexicon(self, word, first_in_doc):
+        """Add new word to lexicon if it does not exist, counting one more occurrence"""
+        if word not in self.lexicon:
+            print("term", word, len(self.lexicon))
+        return self.lexicon.add_word(word, documents=int(first_in_doc))
 
     def append_forward_index(self, doc_id, word_freqs):
         """Append document to forward index"""
@@ -134,141 +124,131 @@ class AddContent:
             print(f"Error updating barrel: {e}")
             return False
 
-    def append_document_index(self, doc_id, score):
-        """Append document entry to document index"""
-        doc_index_path = "server/data/document_index.json"
-        
-        if not os.path.exists(doc_index_path):
-            with open(doc_index_path, 'w') as f:
-                json.dump({}, f)
-        
-        with open(doc_index_path, 'r+') as f:
-            try:
-                data = json.load(f)
-                data[doc_id] = score
-                f.seek(0)
-                json.dump(data, f, indent=4)
-                f.truncate()
-            except json.JSONDecodeError:
-                f.seek(0)
-                json.dump({doc_id: score}, f, indent=4)
-                f.truncate()
+    def append_document_index(self, ordinal, offset, length):
+        """Record the byte range of a document's CSV row in the document index"""
+        self.index.documents.append(ordinal, offset, length)
 
     def _generate_doc_id(self):
         """Generate unique document ID using UUID"""
         return f"doc_{str(uuid.uuid4())}"
     
     def document_exists(self, doc_id):
-        """Check if document already exists efficiently"""
+        """Check if document already exists, in the doc map that holds every row of the CSV"""
+        return doc_id in self.doc_map
+
+    def _new_doc_ids(self, count):
+        """Generate count document IDs used by no existing document"""
+        doc_ids = {}
+        while len(doc_ids) < count:
+            doc_id = self._generate_doc_id()
+            if self.document_exists(doc_id) or doc_id in doc_ids:
+                print(f"Document {doc_id} already exists. Generating new ID...")
+                continue
+            doc_ids[doc_id] = None
+        return list(doc_ids)
+
+    def _index_terms(self, sections):
+        """Add the words of a document's preprocessed sections to the lexicon, returning its terms"""
+        terms = {}
+        # positions run on across the sections, as index_document numbers them at build time
+        base_position = 0
+        for section_id, tokens in enumerate(sections):
+            words = tokens.split()
+            for pos, word in enumerate(words, base_position):
+                self.update_lexicon(word, first_in_doc=word not in terms)
+                if word not in terms:
+                    terms[word] = ([0, 0, 0], [])
+
+                terms[word][0][section_id] += 1
+                terms[word][1].append(pos)
+            base_position += len(words)
+        return terms
+
+    @staticmethod
+    def _csv_row(doc_id, doc):
+        """A document's row in the dataset CSV, quoted the way pandas writes it"""
+        row = io.StringIO()
+        csv.writer(row, lineterminator='\n').writerow([
+            doc_id,
+            doc["title"],
+            str(doc["keywords"]),
+            str(doc["venue"]),
+            doc["year"],
+            doc.get("n_citation", ""),
+            str(doc.get("url", "")),
+            doc["abstract"],
+            str(doc.get("authors", "")),
+            doc.get("doc_type", ""),
+            str(doc.get("references", ""))
+        ])
+        return row.getvalue()
+
+    def _preprocess(self, documents):
+        """Preprocessed sections of each document, in the shared process pool for large batches"""
+        if len(documents) < BULK_PARALLEL_MIN_DOCS or BULK_WORKERS < 2:
+            return [preprocess_sections(doc) for doc in documents]
+        chunksize = max(len(documents) // (4 * BULK_WORKERS), 1)
         try:
-            # Check CSV first using pandas read with specific columns
-            df = pd.read_csv(self.dataset_path, usecols=['id'])
-            if doc_id in df['id'].values:
-                return True
-                
-            # Check document index without loading full file
-            doc_index_path = "server/data/document_index.json"
-            if os.path.exists(doc_index_path):
-                with open(doc_index_path, 'r') as f:
-                    for line in f:
-                        if doc_id in line:
-                            return True
-            return False
-            
-        except Exception as e:
-            print(f"Error checking document existence: {e}")
-            return False
- 
+            return list(process_pool(BULK_WORKERS).map(preprocess_sections, documents, chunksize=chunksize))
+        except BrokenProcessPool:
+            discard_process_pool(BULK_WORKERS)
+            raise
+
     def add_document(self, doc):
         """Process and add new document"""
-        try:
-            # Generate unique doc_id first
-            doc_id = self._generate_doc_id()
-            print(f"Generated document ID: {doc_id}")
-            if self.document_exists(doc_id):
-             print(f"Document {doc_id} already exists. Generating new ID...")
-             return self.add_document(doc)  # Retry with new ID
-            
-            word_freqs = {}
-            positions_dict = {}
-            
-            sections = [
-                (doc['title'], 0),
-                (doc['abstract'], 1),
-                (' '.join(doc['keywords']) if isinstance(doc['keywords'], list) else doc['keywords'], 2)
-            ]
-            
-            for text, section_id in sections:
-                tokens = preprocess_text(text)
-                for pos, word in enumerate(tokens.split()):
-                    term_id = self.update_lexicon(word)
-                    if term_id not in word_freqs:
-                        word_freqs[term_id] = [0, 0, 0]
-                        positions_dict[term_id] = []
-                    
-                    word_freqs[term_id][section_id] += 1
-                    positions_dict[term_id].append(pos)
-            
-            # self.append_forward_index(doc_id, word_freqs)
-            
-            with open("server/data/barrel_metadata.json", 'r') as f:
-                barrel_metadata = json.load(f)
-                # last_barrel = barrel_metadata["last_barrel"]
+        return self.add_documents([doc]) == 1
 
-            with open("server/data/metadata.json", 'r') as f:
-                metadata = json.load(f)
+    def add_documents(self, documents):
+        """Add a batch of documents with one write per file, returning how many were added"""
+        if not documents:
+            return 0
+        try:
+            # the CPU-heavy part runs outside the write lock, and a bad document
+            # fails the batch here, before anything is written
+            sections = self._preprocess(documents)
+            doc_ids = self._new_doc_ids(len(documents))
+            rows = [self._csv_row(doc_id, doc) for doc_id, doc in zip(doc_ids, documents)]
+            print(f"Generated {len(doc_ids)} document IDs")
 
-            for term_id in word_freqs:
-                barrels.add_word_to_barrel(term_id, doc_id, word_freqs[term_id], positions_dict[term_id], barrel_metadata, metadata)
-            
+            # one writer at a time for the ordinals, the lexicon and the log
+            with self.index.write_lock:
+                first, records, position = self._log_documents(documents, sections, doc_ids, rows)
+            # once the log is on disk, one fsync for every add waiting: the doc map, the CSV,
+            # the document index, the metadata searches read and the in-memory postings
+            self.index.apply_in_order(first, records, position)
+            if self.index.segments.needs_flush():
+                self.index.checkpoint()
+        except Exception as e:
+            print(f"Error adding documents: {e}")
+            return 0
+        print(f"{len(documents)} documents added")
+        return len(documents)
 
-            # Convert document to DataFrame row
-            new_row = pd.DataFrame([{
-                 'id': doc_id,
-                'title': doc["title"],
-                'keywords': str(doc["keywords"]),
-                'venue': str(doc["venue"]),
-                'year': doc["year"],
-                'n_citation': doc["n_citation"],
-                'url': str(doc["url"]),
-                'abstract': doc["abstract"],
-                'authors': str(doc["authors"]),
-                'doc_type': doc["doc_type"],
-                'references': str(doc["references"])
-            }])
-            
-            # Append to CSV without writing headers
-            new_row.to_csv(self.dataset_path, mode='a', header=False, index=False)
-            self.append_document_index(doc_id, doc.get('score', 0))
-            
-    
+    def _log_documents(self, documents, sections, doc_ids, rows):
+        """Give the documents their ordinals and terms and log them, returning the first ordinal, the records and the log position"""
+        # the index refers to the documents by their ordinals from here on
+        first, start = self.index.reserve([row.encode() for row in rows])
+        offset = start
+        try:
+            # one lexicon pass in document order, so term ids are those of adding them one by one
+            records = []
+            for ordinal, doc_id, doc, doc_sections, row in zip(range(first, first + len(documents)), doc_ids,
+                                                               documents, sections, rows):
+                terms = self._index_terms(doc_sections)
+                doc_length = len(doc["title"].split()) + len(doc["abstract"].split())
+                records.append({"ordinal": ordinal, "length": doc_length, "terms": terms,
+                                "doc_id": doc_id, "offset": offset, "row": row})
+                offset += len(row.encode())
 
-            with open(self.metadata_path, 'r+') as f:
-                metadata = json.load(f)
-                metadata["forward_index_length"] += 1
-                metadata["total_doc_length"] += len(doc["title"].split()) + len(doc["abstract"].split())
-               
-                f.seek(0)
-                json.dump(metadata, f)
-                f.truncate()
-            print("metadata updated")
-            return True
-        except Exception as e:
-            print(f"Error adding document: {e}")
-            return False
-    
-          
-            
-        
+            # self.append_forward_index(doc_id, word_freqs)
 
-    def add_documents(self, documents):
-        """Add multiple documents"""
-        for doc in documents:
-            success = self.add_document(doc)
-            if success:
-                print(f"Added document {doc.get('doc_id', 'unknown')}")
-            else:
-                print(f"Failed to add document {doc.get('doc_id', 'unknown')}")
+            # the adds are logged before any file is touched, a restart redoes what a crash cut short;
+            # their postings go to the in-memory segment later, no barrel is rewritten
+            position = self.index.segments.log_documents(records)
+        except Exception:
+            self.index.unreserve(first, start)
+            raise
+        return first, records, position
 
 if __name__ == "__main__":
     test_doc = {
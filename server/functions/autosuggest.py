@@ -1,25 +1,80 @@
+import bisect
+import gc
+import heapq
+import os
+import pickle
+from contextlib import contextmanager
+import numpy as np
 from server.entities.lexicon import Lexicon
 
+# completions precomputed at every trie node, the most a lookup returns without a walk
+AUTOSUGGEST_TOP_K = 10
+AUTOSUGGEST_PATH = "server/data/autosuggest.pkl"
+# "sorted" ranks ranges of the mapped binary lexicon and builds nothing, "trie" loads the ranked trie
+AUTOSUGGEST_BACKEND = "sorted"
+
+@contextmanager
+def gc_paused():
+    """Pause the garbage collector, which would walk every node again and again while a trie is made"""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
 class TrieNode:
+    __slots__ = ("children", "is_end_of_word", "frequency", "top")
+
     def __init__(self):
         self.children = {}
         self.is_end_of_word = False
-        self.frequency = 0  # Can be used to rank suggestions
+        self.frequency = 0  # collection frequency of the word ending here
+        self.top = []  # (-frequency, word) of the best completions, best first
 
 class Trie:
     def __init__(self):
         self.root = TrieNode()
-    
-    def insert(self, word):
-        """Insert a word into the trie."""
+
+    def insert(self, word, frequency=1):
+        """Insert a word into the trie. Call rank() once every word is in."""
         node = self.root
         for char in word:
             if char not in node.children:
                 node.children[char] = TrieNode()
             node = node.children[char]
         node.is_end_of_word = True
-        node.frequency += 1
-    
+        node.frequency += frequency
+        return node
+
+    def add(self, word, frequency=1, k=AUTOSUGGEST_TOP_K):
+        """Insert a word into a ranked trie, updating the completions of its prefixes"""
+        self.insert(word, frequency)
+        node = self.root
+        path = [node]
+        for char in word:
+            node = node.children[char]
+            path.append(node)
+        ranked = (-node.frequency, word)
+        for node in path:
+            node.top = heapq.nsmallest(k, [entry for entry in node.top if entry[1] != word] + [ranked])
+
+    def rank(self, k=AUTOSUGGEST_TOP_K):
+        """Precompute the k most frequent completions of every node, ties alphabetically"""
+        # post-order without recursion, words can be longer than the recursion limit
+        stack = [(self.root, "", False)]
+        while stack:
+            node, prefix, children_ranked = stack.pop()
+            if not children_ranked:
+                stack.append((node, prefix, True))
+                stack.extend((child, prefix + char, False) for char, child in node.children.items())
+                continue
+            candidates = [(-node.frequency, prefix)] if node.is_end_of_word else []
+            for child in node.children.values():
+                candidates.extend(child.top)
+            node.top = heapq.nsmallest(k, candidates)
+
     def _find_prefix_node(self, prefix):
         """Helper function to find the node corresponding to a prefix."""
         node = self.root
@@ -28,27 +83,57 @@ class Trie:
                 return None
             node = node.children[char]
         return node
-    
-    def _collect_suggestions(self, node, prefix, suggestions, max_suggestions=5):
-        """Recursively collect word suggestions starting from a node."""
-        if len(suggestions) >= max_suggestions:
-            return
-        
-        if node.is_end_of_word:
-            suggestions.append(prefix)
-            
-        for char, child_node in sorted(node.children.items()):
-            self._collect_suggestions(child_node, prefix + char, suggestions, max_suggestions)
-    
+
+    def _collect_suggestions(self, node, prefix, suggestions):
+        """Collect (-frequency, word) of every word below a node."""
+        stack = [(node, prefix)]
+        while stack:
+            node, prefix = stack.pop()
+            if node.is_end_of_word:
+                suggestions.append((-node.frequency, prefix))
+            stack.extend((child, prefix + char) for char, child in node.children.items())
+
     def get_suggestions(self, prefix, max_suggestions=5):
-        """Get autocomplete suggestions for a given prefix."""
+        """Get the most frequent completions of a prefix."""
         node = self._find_prefix_node(prefix)
         if not node:
             return []
-            
+
+        # the precomputed completions hold every word below the node or at least max_suggestions
+        if max_suggestions <= AUTOSUGGEST_TOP_K or len(node.top) < AUTOSUGGEST_TOP_K:
+            return [word for _, word in node.top[:max_suggestions]]
         suggestions = []
-        self._collect_suggestions(node, prefix, suggestions, max_suggestions)
-        return suggestions
+        self._collect_suggestions(node, prefix, suggestions)
+        return [word for _, word in heapq.nsmallest(max_suggestions, suggestions)]
+
+    def to_list(self):
+        """The nodes in preorder as (char, child count, is_end_of_word, frequency, top), to pickle flat"""
+        nodes = []
+        stack = [("", self.root)]
+        while stack:
+            char, node = stack.pop()
+            nodes.append((char, len(node.children), node.is_end_of_word, node.frequency, node.top))
+            stack.extend(node.children.items())
+        return nodes
+
+    @classmethod
+    def from_list(cls, nodes):
+        """Trie of the nodes listed by to_list()"""
+        trie = cls()
+        # parents still waiting for children, with how many they wait for
+        stack = []
+        for i, (char, child_count, is_end_of_word, frequency, top) in enumerate(nodes):
+            node = trie.root if i == 0 else TrieNode()
+            node.is_end_of_word, node.frequency, node.top = is_end_of_word, frequency, top
+            if stack:
+                parent = stack[-1]
+                parent[0].children[char] = node
+                parent[1] -= 1
+                if parent[1] == 0:
+                    stack.pop()
+            if child_count:
+                stack.append([node, child_count])
+        return trie
 
 
 def get_suggestions(word_list, prefix, max_suggestions=5):
@@ -57,28 +142,105 @@ def get_suggestions(word_list, prefix, max_suggestions=5):
     return auto.suggest(prefix, max_suggestions)
 
 class Autosuggestion:
-    def __init__(self, word_list):
-        """Initialize autosuggestion with a list of words."""
+    def __init__(self, word_list, frequencies=None):
+        """Initialize autosuggestion with a list of words, ranked by their frequencies when given."""
         self.trie = Trie()
-        for word in word_list:
-            self.trie.insert(word.lower())
-    
+        with gc_paused():
+            for word, frequency in zip(word_list, frequencies or [1] * len(word_list)):
+                self.trie.insert(word.lower(), frequency)
+            self.trie.rank()
+
     def suggest(self, prefix, max_suggestions=5):
         """Get suggestions for a given prefix."""
         return self.trie.get_suggestions(prefix.lower(), max_suggestions)
 
+    @classmethod
+    def load(cls, lexicon, path=AUTOSUGGEST_PATH):
+        """
+        Autosuggestion over the lexicon ranked by collection frequency. The trie of
+        the built words is read from path unless the lexicon was rebuilt since it
+        was saved, and the words added since the build are inserted into it.
+        """
+        words = lexicon.words()
+        frequencies = lexicon.frequencies()
+        built = lexicon.built_count()
+        stat = os.stat(Lexicon.path)
+        signature = [stat.st_size, stat.st_mtime_ns, built, AUTOSUGGEST_TOP_K]
+
+        saved = None
+        if os.path.exists(path):
+            with gc_paused(), open(path, 'rb') as f:
+                saved = pickle.load(f)
+        if saved is not None and saved["signature"] == signature:
+            auto = cls.__new__(cls)
+            with gc_paused():
+                auto.trie = Trie.from_list(saved["nodes"])
+        else:
+            auto = cls(words[:built], frequencies[:built])
+            with gc_paused(), open(path + '.tmp', 'wb') as f:
+                pickle.dump({"signature": signature, "nodes": auto.trie.to_list()}, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(path + '.tmp', path)
+
+        for word, frequency in zip(words[built:], frequencies[built:]):
+            auto.trie.add(word.lower(), frequency)
+        return auto
+
+class SortedAutosuggestion:
+    """
+    Autosuggestion straight over the binary lexicon. Its words are sorted, so the
+    completions of a prefix are a range found by bisection, ranked with the
+    frequency column stored beside them. Nothing is built or copied: workers
+    forked from the server share the lexicon's mapping.
+    """
+
+    def __init__(self, lexicon):
+        self.lexicon = lexicon
+        self.frequencies = lexicon.built_frequencies()
+        # the few words added since the build, sorted for the same range lookups
+        self.added = sorted((word.lower(), lexicon[word]["frequency"]) for word in lexicon.added_words())
+        self.added_words = [word for word, _ in self.added]
+
+    def suggest(self, prefix, max_suggestions=5):
+        """Get the most frequent completions of a prefix, ties alphabetically."""
+        prefix = prefix.lower()
+        if max_suggestions <= 0:
+            return []
+        lo, hi = self.lexicon.prefix_range(prefix)
+        frequencies = self.frequencies[lo:hi]
+        if hi - lo > max_suggestions:
+            # every word at least as frequent as the k-th most frequent, ties resolved below
+            kth = np.partition(frequencies, hi - lo - max_suggestions)[hi - lo - max_suggestions]
+            candidates = np.flatnonzero(frequencies >= kth)
+        else:
+            candidates = np.arange(hi - lo)
+        # the index breaks ties alphabetically, the words are sorted
+        best = candidates[np.lexsort((candidates, -frequencies[candidates].astype(np.int64)))][:max_suggestions]
+        ranked = [(-int(frequencies[i]), self.lexicon.built_word(lo + i)) for i in best.tolist()]
+
+        start = bisect.bisect_left(self.added_words, prefix)
+        end = bisect.bisect_left(self.added_words, prefix + "\U0010ffff")
+        ranked.extend((-frequency, word) for word, frequency in self.added[start:end])
+        return [word for _, word in heapq.nsmallest(max_suggestions, ranked)]
+
+
+def open_autosuggestion(lexicon, backend=AUTOSUGGEST_BACKEND):
+    """Autosuggestion over the lexicon with the given backend"""
+    if backend == "trie":
+        return Autosuggestion.load(lexicon)
+    return SortedAutosuggestion(lexicon)
+
 # Example usage
 def main():
     # Sample lexicon
-    
-    words_list = list(Lexicon().lexicon.keys())
-    
+
+    lexicon = Lexicon()
+
     # Initialize autosuggestion
-    auto = Autosuggestion(words_list)
-    
+    auto = Autosuggestion(lexicon.words(), lexicon.frequencies())
+
     # Test cases
     test_prefixes = ["resear", "resea", "neur"]
-    
+
     for prefix in test_prefixes:
         suggestions = auto.suggest(prefix)
         print(f"\nSuggestions for '{prefix}':")
@@ -86,4 +248,4 @@ def main():
             print(f"  - {suggestion}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,76 +1,243 @@
-import json
+from bisect import bisect_left
 from collections import defaultdict
+import heapq
 import math
 import time
-from server.entities.lexicon import Lexicon
-from server.entities.barrels import Barrels
+import numpy as np
+from server.entities.searchindex import search_index
+from server.lib.cache import postings_cache
+from server.lib.bm25 import tf_scores
 # from server.entities.docindex import DocumentIndex
 
-# BM25 parameters
-k1 = 1.5  # Term frequency saturation parameter
-b = 0.8   # Length normalization parameter
-
-# Section and proximity weights
+# Proximity weights
 PROXIMITY_BOOST = 2.0
 TITLE_PROXIMITY_BOOST = 3.0
 SAFE_DISTANCE_BASE = 5
 MAX_SAFE_DISTANCE = 20
-TITLE_WEIGHT = 1.1
-KEYWORDS_WEIGHT = 0.25
-ABSTRACT_WEIGHT = 0.2
-
-# Load lexicon
-start = time.time()
-lexicon = Lexicon().lexicon
-end = time.time()
-print("time for loading lexicon: ", end - start)
-
-def load_document_metadata():
-    try:
-        with open("server/data/metadata.json", "r") as f:
-            return json.load(f)
-    except FileNotFoundError:
-        raise Exception("Required metadata.json file not found")
-
-# Initialize metadata
-metadata = load_document_metadata()
-#doc_lengths = metadata["doc_lengths"]
-total_doc_length = metadata["total_doc_length"]
-forward_index_length = metadata["forward_index_length"]
-avg_doc_length = total_doc_length / forward_index_length
+
+# number of best BM25 documents that get the proximity boost
+PROXIMITY_CANDIDATES = 200
 
 def calculate_safe_distance(doc_length):
     """Calculate safe distance based on document length"""
     return min(SAFE_DISTANCE_BASE + (doc_length // 1000), MAX_SAFE_DISTANCE)
 
-def calculate_proximity_score(positions1, positions2, safe_distance):
-    """Calculate proximity score between two terms"""
+def min_position_distance(positions1, positions2, end1=None, end2=None):
+    """
+    Smallest distance between two sorted position lists, found with a linear
+    two-pointer merge over positions1[:end1] and positions2[:end2]
+    """
+    end1 = len(positions1) if end1 is None else end1
+    end2 = len(positions2) if end2 is None else end2
     min_distance = float('inf')
-    for pos1 in positions1:
-        for pos2 in positions2:
-            distance = abs(pos1 - pos2)
+    i = j = 0
+    while i < end1 and j < end2:
+        distance = positions1[i] - positions2[j]
+        if distance < 0:
+            min_distance = min(min_distance, -distance)
+            i += 1
+        elif distance > 0:
             min_distance = min(min_distance, distance)
+            j += 1
+        else:
+            return 0
+    return min_distance
+
+def calculate_proximity_score(positions1, positions2, safe_distance, end1=None, end2=None):
+    """Calculate proximity score between two terms from their sorted positions"""
+    min_distance = min_position_distance(positions1, positions2, end1, end2)
     
     if min_distance <= safe_distance:
         return 1.0 - (min_distance / safe_distance)
     return 0.0
 
-start = time.time()
-with open("server/data/barrel_metadata.json", "r") as f:
-    barrels_metadata = json.load(f)
-end = time.time()
-print(f"Time taken to load barrel metadata: {end - start:.4} seconds")
+def collect_positions(term_blocks, ordinals):
+    """
+    Gather the sorted positions of every query term and the length of each of the
+    given documents, looking the documents up in each postings block
+    """
+    term_positions = defaultdict(lambda: defaultdict(list))
+    doc_lengths = {}
+    avg_doc_length = search_index.avg_doc_length
+    wanted = np.sort(np.fromiter(ordinals, dtype=np.int64))
+    for term, docs in term_blocks:
+        found, rows, _, lengths = docs.lookup(wanted)
+        for ordinal, row, length in zip(wanted[found].tolist(), rows.tolist(), lengths.tolist()):
+            term_positions[ordinal][term].extend(docs.get_positions(row))
+            doc_lengths[ordinal] = int(length) or avg_doc_length
+
+    # positions from separate blocks or repeated query terms may interleave
+    for positions in term_positions.values():
+        for term in positions:
+            positions[term].sort()
+    return term_positions, doc_lengths
+
+def apply_proximity_boost(bm25_scores, ordinals, term_positions, doc_lengths, query_terms):
+    """Boost the score of the given documents when query terms appear close together"""
+    avg_doc_length = search_index.avg_doc_length
+    for ordinal in ordinals:
+        doc_length = doc_lengths.get(ordinal, avg_doc_length)
+        safe_distance = calculate_safe_distance(doc_length)
+        
+        proximity_boost = 0
+        for i, term1 in enumerate(query_terms[:-1]):
+            for term2 in query_terms[i+1:]:
+                if term1 in term_positions[ordinal] and term2 in term_positions[ordinal]:
+                    pos1 = term_positions[ordinal][term1]
+                    pos2 = term_positions[ordinal][term2]
+                    
+                    prox_score = calculate_proximity_score(pos1, pos2, safe_distance)
+                    
+                    # positions are sorted, so the title positions are a prefix
+                    title_end1 = bisect_left(pos1, 100)
+                    title_end2 = bisect_left(pos2, 100)
+                    
+                    if title_end1 and title_end2:
+                        title_prox = calculate_proximity_score(
+                            pos1, pos2, safe_distance, title_end1, title_end2)
+                        proximity_boost += title_prox * TITLE_PROXIMITY_BOOST
+                    
+                    proximity_boost += prox_score * PROXIMITY_BOOST
+        
+        bm25_scores[ordinal] *= (1 + proximity_boost)
+
+
+class TermScores:
+    """BM25 scores of the postings blocks of a query term"""
+
+    def __init__(self, term, blocks, idf):
+        self.term = term
+        self.idf = idf
+        self.blocks = blocks
+        self.avg_doc_length = search_index.avg_doc_length
+        # idf only goes negative when df exceeds N, where the term can only lower a score
+        self.upper_bound = max(idf, 0.0) * max(block.upper_bound(self.avg_doc_length) for block in blocks)
+
+    def scores(self):
+        """Doc ordinals of every posting of the term and their scores"""
+        ordinals = np.concatenate([block.ordinals for block in self.blocks])
+        scores = np.concatenate([self.idf * tf_scores(block.frequencies, block.lengths, self.avg_doc_length)
+                                 for block in self.blocks])
+        return ordinals, scores
+
+    def scores_at(self, ordinals):
+        """Scores of the term in the documents of the given sorted ordinals, 0 where it does not occur"""
+        scores = np.zeros(len(ordinals))
+        for block in self.blocks:
+            found, _, frequencies, lengths = block.lookup(ordinals)
+            scores[found] += self.idf * tf_scores(frequencies, lengths, self.avg_doc_length)
+        return scores
+
+
+def best_scores(ordinals, scores, k):
+    """The k best (ordinal, score) pairs, best first and ties by ordinal"""
+    if len(scores) > k:
+        kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+        keep = np.flatnonzero(scores >= kth)
+        ordinals, scores = ordinals[keep], scores[keep]
+    order = np.lexsort((ordinals, -scores))[:k]
+    return list(zip(ordinals[order].tolist(), scores[order].tolist()))
+
+
+def max_score_top_k(terms, k):
+    """
+    MaxScore retrieval of the k best BM25 documents, a whole posting list at a
+    time. The k-th best score of any one term bounds the k-th best document
+    score from below, so terms whose summed upper bounds stay under it are
+    non-essential: they bring no candidates and are only looked up, through
+    their skip tables, in the candidates that can still make the top k.
+    """
+    terms = sorted(terms, key=lambda term: term.upper_bound)
+    prefix_bounds = np.cumsum([term.upper_bound for term in terms])
+    # the bound needs scores that never go negative
+    prune = all(term.idf >= 0 for term in terms)
+    threshold = 0.0
+
+    posting_ordinals = []
+    posting_scores = []
+    first_essential = len(terms)
+    while first_essential and not (prune and prefix_bounds[first_essential - 1] < threshold):
+        first_essential -= 1
+        ordinals, scores = terms[first_essential].scores()
+        posting_ordinals.append(ordinals)
+        posting_scores.append(scores)
+        if prune and len(scores) >= k:
+            threshold = max(threshold, np.partition(scores, len(scores) - k)[len(scores) - k])
+
+    candidates, inverse = np.unique(np.concatenate(posting_ordinals), return_inverse=True)
+    totals = np.bincount(inverse, weights=np.concatenate(posting_scores), minlength=len(candidates))
+
+    for i in range(first_essential - 1, -1, -1):
+        if prune and len(totals) > k:
+            kth = np.partition(totals, len(totals) - k)[len(totals) - k]
+            # candidates that cannot reach the k-th best even with every term left
+            keep = totals + prefix_bounds[i] >= kth
+            candidates, totals = candidates[keep], totals[keep]
+        totals += terms[i].scores_at(candidates)
+
+    return best_scores(candidates, totals, k)
+
+
+def calculate_top_k_bm25(query_terms, k):
+    """Top-k variant of calculate_bm25 that skips documents which cannot make the top k"""
+    timing_logs = []
+    total_start = time.time()
+
+    N = search_index.document_count
+    lexicon = search_index.lexicon
+
+    terms = []
+    for term in query_terms:
+        if term not in lexicon:
+            continue
+        blocks = search_index.postings(lexicon[term]["id"])
+        if not blocks:
+            continue
+        df = sum(len(docs) for docs in blocks)
+        idf = math.log((N - df + 0.5) / (df + 0.5) + 1)
+        terms.append(TermScores(term, blocks, idf))
+
+    if not terms:
+        return [], timing_logs
+
+    # proximity may reorder documents, so gather a wider pool of candidates for it
+    pool = k if len(query_terms) < 2 else max(k, PROXIMITY_CANDIDATES)
+    ordinals = np.array(sorted(ordinal for ordinal, _ in max_score_top_k(terms, pool)), dtype=np.int64)
+    # summed again in query term order, as the exhaustive ranking sums them, so the scores agree to the bit
+    totals = np.zeros(len(ordinals))
+    for term in terms:
+        totals += term.scores_at(ordinals)
+    # in ordinal order, which breaks ties among the boosted scores as the exhaustive ranking does
+    bm25_scores = dict(zip(ordinals.tolist(), totals.tolist()))
+    timing_logs.append(f"Top-k BM25 calculation: {time.time() - total_start:.4f} seconds")
+
+    if len(query_terms) >= 2:
+        proximity_start = time.time()
+        term_blocks = [(term.term, block) for term in terms for block in term.blocks]
+        term_positions, doc_lengths = collect_positions(term_blocks, bm25_scores.keys())
+        apply_proximity_boost(bm25_scores, bm25_scores.keys(), term_positions, doc_lengths, query_terms)
+        timing_logs.append(f"Proximity calculation: {time.time() - proximity_start:.4f} seconds")
+
+    sorted_scores = sorted(bm25_scores.items(), key=lambda x: x[1], reverse=True)[:k]
+    timing_logs.append(f"Total calculation time: {time.time() - total_start:.4f} seconds")
+    return sorted_scores, timing_logs
+
+
+def calculate_bm25(query_terms, words_count, top_k=None):
+    """Rank documents for the query, returning (doc ordinal, score) pairs best first"""
+    if top_k:
+        return calculate_top_k_bm25(query_terms, top_k)
 
-def calculate_bm25(query_terms, words_count):
     timing_logs = []
     total_start = time.time()
     
-    N = forward_index_length
-    bm25_scores = defaultdict(float)
-    term_positions = defaultdict(lambda: defaultdict(list))
-    doc_lengths = {}  # Store doc lengths from barrel entries
-    
-    barrels_obj = Barrels(words_count)
+    N = search_index.document_count
+    avg_doc_length = search_index.avg_doc_length
+    lexicon = search_index.lexicon
+    # columns of every scored posting, summed per document after the first pass
+    posting_ordinals = []
+    posting_scores = []
+    term_blocks = []
 
     # First pass: Basic BM25 calculation and position collection
     barrels_loading_time = 0
@@ -81,46 +248,41 @@ def calculate_bm25(query_terms, words_count):
             continue
             
         word_id = str(lexicon[term]["id"])
-        barrel_id = barrels_metadata[word_id]
         barrel_start = time.time()
 
-        docs = barrels_obj.get_barrel(barrel_id)[word_id]
-        print(f"loading barrel for word with id {barrel_id} {term}: {time.time() - barrel_start:.4f} seconds")
+        # the barrel of the word, then the segments of documents added since the build
+        blocks = search_index.postings(word_id)
+        print(f"loading postings for word with id {word_id} {term}: {time.time() - barrel_start:.4f} seconds")
         barrel_end = time.time()
 
-        # print(docs)
-
         barrels_loading_time += (barrel_end - barrel_start)
         
 
-        if not docs:
+        if not blocks:
             continue
 
         bm25_start = time.time()
-        df = len(docs)
+        df = sum(len(docs) for docs in blocks)
         print("term: ", term, "df: ", df)
         idf = math.log((N - df + 0.5) / (df + 0.5) + 1)
 
-        for doc in docs:
-            doc_id = doc["doc_id"]
-            term_positions[doc_id][term].extend(doc.get("positions", []))
-            doc_lengths[doc_id] = doc.get("length", avg_doc_length)  # Get doc length from barrel
-            
-            # Calculate section-weighted frequency
-            f = (
-                doc["frequency"][0] * TITLE_WEIGHT +
-                doc["frequency"][1] * ABSTRACT_WEIGHT +
-                doc["frequency"][2] * KEYWORDS_WEIGHT
-            )
-            
-            numerator = f * (k1 + 1)
-            denominator = f + k1 * (1 - b + b * (doc_lengths[doc_id] / avg_doc_length))
-            bm25_scores[doc_id] += idf * (numerator / denominator)
+        for docs in blocks:
+            # score the whole posting list at once
+            posting_ordinals.append(docs.ordinals)
+            posting_scores.append(idf * tf_scores(docs.frequencies, docs.lengths, avg_doc_length))
+            term_blocks.append((term, docs))
         bm25_calc_time += time.time() - bm25_start
 
+    # accumulate the per-posting scores of every term into one score per document
+    bm25_scores = {}
+    if posting_ordinals:
+        ordinals, inverse = np.unique(np.concatenate(posting_ordinals), return_inverse=True)
+        scores = np.bincount(inverse, weights=np.concatenate(posting_scores), minlength=len(ordinals))
+        bm25_scores = dict(zip(ordinals.tolist(), scores.tolist()))
 
     timing_logs.append(f"BM25 calculation: {bm25_calc_time} seconds")
     timing_logs.append(f"Barrels loading: {barrels_loading_time} seconds")
+    timing_logs.append(f"Postings cache: {postings_cache.stats()}")
 
     # Second pass: Proximity boost calculation
     if len(query_terms) < 2:
@@ -128,30 +290,10 @@ def calculate_bm25(query_terms, words_count):
         timing_logs.append(f"Total calculation time: {time.time() - total_start:.4f} seconds")
         return sorted_scores, timing_logs
     proximity_start = time.time()
-    for doc_id in bm25_scores.keys():
-        doc_length = doc_lengths.get(doc_id, avg_doc_length)
-        safe_distance = calculate_safe_distance(doc_length)
-        
-        proximity_boost = 0
-        for i, term1 in enumerate(query_terms[:-1]):
-            for term2 in query_terms[i+1:]:
-                if term1 in term_positions[doc_id] and term2 in term_positions[doc_id]:
-                    pos1 = term_positions[doc_id][term1]
-                    pos2 = term_positions[doc_id][term2]
-                    
-                    prox_score = calculate_proximity_score(pos1, pos2, safe_distance)
-                    
-                    title_positions1 = [p for p in pos1 if p < 100]
-                    title_positions2 = [p for p in pos2 if p < 100]
-                    
-                    if title_positions1 and title_positions2:
-                        title_prox = calculate_proximity_score(
-                            title_positions1, title_positions2, safe_distance)
-                        proximity_boost += title_prox * TITLE_PROXIMITY_BOOST
-                    
-                    proximity_boost += prox_score * PROXIMITY_BOOST
-        
-        bm25_scores[doc_id] *= (1 + proximity_boost)
+    # boosts only multiply scores, so the best BM25 documents stay ahead of the rest
+    candidates = heapq.nlargest(PROXIMITY_CANDIDATES, bm25_scores, key=bm25_scores.get)
+    term_positions, doc_lengths = collect_positions(term_blocks, candidates)
+    apply_proximity_boost(bm25_scores, candidates, term_positions, doc_lengths, query_terms)
     
     timing_logs.append(f"Proximity calculation: {time.time() - proximity_start:.4f} seconds")
     
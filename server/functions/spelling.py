@@ -0,0 +1,203 @@
+import mmap
+import os
+import struct
+import zlib
+from collections import defaultdict
+import numpy as np
+from server.entities.lexicon import Lexicon
+
+# Symmetric delete spelling correction (SymSpell). Every string made by deleting
+# up to SPELLING_MAX_DISTANCE characters from the first SPELLING_PREFIX_LENGTH
+# characters of a word is indexed; a query generates its own deletes, and the
+# words sharing one are the only candidates whose edit distance is computed.
+SPELLING_MAX_DISTANCE = 2
+SPELLING_PREFIX_LENGTH = 7
+# rarer words are most often typos themselves and are never suggested
+SPELLING_MIN_FREQUENCY = 3
+SPELLING_PATH = "server/data/spelling.bin"
+# query terms in at most this many documents are checked for a misspelling
+SPELLING_REWRITE_MAX_DF = 1
+# a known term is only replaced by a word this many times more frequent
+SPELLING_REWRITE_RATIO = 100
+# terms this short are only corrected by one edit, two could turn them into almost anything
+SPELLING_SHORT_TERM = 4
+
+# Spelling index layout (little-endian): header (magic, then the size and mtime
+# of the lexicon.bin it was built from and the settings above, then count), then
+#   hashes  u4[count]   crc32 of each delete, sorted
+#   words   u4[count]   index in the binary lexicon of the word of each delete
+SPELLING_MAGIC = b"SPL1"
+SPELLING_HEADER = struct.Struct("<4sQQIIIII")
+
+
+def deletes(word, max_distance=SPELLING_MAX_DISTANCE, prefix_length=SPELLING_PREFIX_LENGTH):
+    """The word's prefix and every string made by deleting up to max_distance of its characters"""
+    frontier = {word[:prefix_length]}
+    result = set(frontier)
+    for _ in range(max_distance):
+        frontier = {text[:i] + text[i + 1:] for text in frontier for i in range(len(text))}
+        result |= frontier
+    return result
+
+
+def delete_hash(text):
+    # 32 bits are enough, a collision only adds a candidate that fails the distance check
+    return zlib.crc32(text.encode())
+
+
+def edit_distance(a, b, max_distance):
+    """
+    Optimal string alignment distance of a and b (insertions, deletions,
+    substitutions and adjacent transpositions), or max_distance + 1 as soon as
+    it is certain to be larger than max_distance.
+    """
+    if abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    # a shared prefix or suffix costs nothing, and a typo leaves most of a word as it was
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a, b = a[start:len(a) - end], b[start:len(b) - end]
+    if not a or not b:
+        return min(len(a) + len(b), max_distance + 1)
+    before = None
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        row_min = i
+        for j, char_b in enumerate(b, 1):
+            value = previous[j - 1] + (char_a != char_b)
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if i > 1 and j > 1 and char_a == b[j - 2] and a[i - 2] == char_b and before[j - 2] + 1 < value:
+                value = before[j - 2] + 1
+            current.append(value)
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return max_distance + 1
+        before, previous = previous, current
+    return min(previous[-1], max_distance + 1)
+
+
+class SpellingIndex:
+    """
+    Corrections of a word from the lexicon, ranked by edit distance and then by
+    collection frequency. The deletes of the built words are kept as a sorted
+    array of their hashes with the lexicon index of their word, saved to
+    SPELLING_PATH and mapped on load; words added since the build get a small
+    in-memory index of the same kind.
+    """
+
+    def __init__(self, lexicon, path=SPELLING_PATH):
+        self.lexicon = lexicon
+        self.frequencies = lexicon.built_frequencies()
+        stat = os.stat(Lexicon.path)
+        signature = (stat.st_size, stat.st_mtime_ns, lexicon.built_count(), SPELLING_MAX_DISTANCE,
+                     SPELLING_PREFIX_LENGTH, SPELLING_MIN_FREQUENCY)
+        if not self.__map(path, signature):
+            hashes, words = self.__build()
+            # written next to the old file and swapped, a live mmap of the old one must not be truncated
+            with open(path + '.tmp', 'wb') as f:
+                f.write(SPELLING_HEADER.pack(SPELLING_MAGIC, *signature, len(hashes)))
+                hashes.astype('<u4').tofile(f)
+                words.astype('<u4').tofile(f)
+            os.replace(path + '.tmp', path)
+            self.__map(path, signature)
+
+        self.added = defaultdict(list)
+        self.added_frequencies = {}
+        for word in lexicon.added_words():
+            frequency = lexicon[word]["frequency"]
+            if frequency >= SPELLING_MIN_FREQUENCY:
+                self.added_frequencies[word] = frequency
+                for text in deletes(word):
+                    self.added[text].append(word)
+
+    def __map(self, path, signature):
+        """Map the index saved at path if it was built from the same lexicon and settings"""
+        if not os.path.exists(path) or os.path.getsize(path) < SPELLING_HEADER.size:
+            return False
+        with open(path, 'rb') as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, *saved, count = SPELLING_HEADER.unpack_from(mm, 0)
+        if magic != SPELLING_MAGIC or tuple(saved) != signature:
+            mm.close()
+            return False
+        self.hashes = np.frombuffer(mm, dtype='<u4', count=count, offset=SPELLING_HEADER.size)
+        self.words = np.frombuffer(mm, dtype='<u4', count=count, offset=SPELLING_HEADER.size + 4 * count)
+        return True
+
+    def __build(self):
+        """Hashes of the deletes of every frequent enough built word, sorted, and the index of their word"""
+        hashes = []
+        words = []
+        for i in np.flatnonzero(self.frequencies >= SPELLING_MIN_FREQUENCY).tolist():
+            word_hashes = {delete_hash(text) for text in deletes(self.lexicon.built_word(i))}
+            hashes.extend(word_hashes)
+            words.extend([i] * len(word_hashes))
+        hashes = np.array(hashes, dtype=np.uint32)
+        order = np.argsort(hashes, kind='stable')
+        return hashes[order], np.array(words, dtype=np.uint32)[order]
+
+    def corrections(self, word, max_corrections=5, max_distance=SPELLING_MAX_DISTANCE):
+        """(word, distance, frequency) of the closest frequent words, the word itself included if it is one"""
+        word = word.lower()
+        max_distance = min(max_distance, SPELLING_MAX_DISTANCE)
+        query_deletes = deletes(word, max_distance)
+
+        keys = np.array([delete_hash(text) for text in query_deletes], dtype=np.uint32)
+        starts = np.searchsorted(self.hashes, keys, side='left')
+        ends = np.searchsorted(self.hashes, keys, side='right')
+        candidates = {}
+        if (ends > starts).any():
+            indexes = np.unique(np.concatenate([self.words[start:end] for start, end in zip(starts, ends)]))
+            for i in indexes.tolist():
+                candidates[self.lexicon.built_word(i)] = int(self.frequencies[i])
+        for text in query_deletes:
+            for candidate in self.added.get(text, []):
+                candidates[candidate] = self.added_frequencies[candidate]
+
+        ranked = []
+        for candidate, frequency in candidates.items():
+            distance = edit_distance(word, candidate, max_distance)
+            if distance <= max_distance:
+                ranked.append((distance, -frequency, candidate))
+                # with enough corrections this close, farther candidates need not be measured
+                if len(ranked) >= max_corrections:
+                    ranked.sort()
+                    del ranked[max_corrections:]
+                    max_distance = ranked[-1][0]
+        ranked.sort()
+        return [(candidate, distance, -frequency) for distance, frequency, candidate in ranked[:max_corrections]]
+
+    def suggest(self, word, max_suggestions=5):
+        """The closest frequent words to a word, best first"""
+        return [candidate for candidate, _, _ in self.corrections(word, max_suggestions)]
+
+    def rewrite(self, terms):
+        """
+        Query terms with the unknown and rare ones replaced by their best
+        correction, and the (term, correction) pairs replaced. A rare term may be
+        the word meant, so it is only replaced by a far more frequent one.
+        """
+        rewritten = []
+        replaced = []
+        for term in terms:
+            entry = self.lexicon.get(term) if term else None
+            if term and (entry is None or entry["df"] <= SPELLING_REWRITE_MAX_DF):
+                frequency = entry["frequency"] if entry else 0
+                max_distance = 1 if len(term) <= SPELLING_SHORT_TERM else SPELLING_MAX_DISTANCE
+                # the term itself comes first when it is frequent enough to be suggested
+                for word, distance, word_frequency in self.corrections(term, 2, max_distance):
+                    if distance and word_frequency >= max(frequency * SPELLING_REWRITE_RATIO, 1):
+                        replaced.append((term, word))
+                        term = word
+                        break
+            rewritten.append(term)
+        return rewritten, replaced
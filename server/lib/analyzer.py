@@ -0,0 +1,30 @@
+import re
+from functools import lru_cache
+from nltk.tokenize.destructive import NLTKWordTokenizer
+from server.lib.utils import lemmatize, stop_words
+
+# distinct raw tokens whose terms are remembered
+QUERY_TERM_CACHE_SIZE = 100000
+
+NON_WORD = re.compile(r'\W+')
+# once punctuation is gone the only rules of word_tokenize left to apply are its
+# contraction splits, e.g. "cannot" -> "can not", which never cross a space
+CONTRACTIONS = NLTKWordTokenizer.CONTRACTIONS2 + NLTKWordTokenizer.CONTRACTIONS3
+
+
+@lru_cache(maxsize=QUERY_TERM_CACHE_SIZE)
+def analyze_token(token):
+    """Index terms of a lowercased token, after the stopword and length filters and lemmatization"""
+    text = f" {token} "
+    for regexp in CONTRACTIONS:
+        text = regexp.sub(r" \1 \2 ", text)
+    return tuple(lemmatize(word) for word in text.split() if word not in stop_words and len(word) > 2)
+
+
+def analyze_query(text):
+    """
+    Same result as preprocess_text, without Punkt and the Treebank tokenizer:
+    the text is split on non-word characters and each token is analyzed once.
+    """
+    text = NON_WORD.sub(' ', NON_WORD.sub(' ', text).lower())
+    return " ".join(term for token in text.split() for term in analyze_token(token))
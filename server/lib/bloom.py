@@ -0,0 +1,67 @@
+import hashlib
+import struct
+import numpy as np
+
+# Bloom filter file layout (little-endian): header (magic, key_count, hashes,
+# bit_count) then the bit array, bit i of the filter in byte i // 8.
+BLOOM_MAGIC = b"BLM1"
+BLOOM_HEADER = struct.Struct("<4sIIQ")
+# 10 bits and 7 hashes a key give about 1% false positives
+BLOOM_BITS_PER_KEY = 10
+BLOOM_HASHES = 7
+
+
+def key_hash(key):
+    """64-bit hash of a byte string, the same in every process"""
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), 'little')
+
+
+class BloomFilter:
+    """
+    Set of byte strings answering "maybe present" or "certainly absent". The
+    bits of a key come from double hashing its 64-bit hash.
+    """
+
+    def __init__(self, bits, key_count, hashes=BLOOM_HASHES):
+        self.bits = bits
+        self.bit_count = len(bits) * 8
+        self.key_count = key_count
+        self.hashes = hashes
+
+    def __positions(self, hashes):
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        h1 = hashes & np.uint64(0xFFFFFFFF)
+        h2 = (hashes >> np.uint64(32)) | np.uint64(1)
+        return np.stack([(h1 + np.uint64(i) * h2) % np.uint64(self.bit_count) for i in range(self.hashes)])
+
+    @classmethod
+    def build(cls, keys, bits_per_key=BLOOM_BITS_PER_KEY, hashes=BLOOM_HASHES):
+        hashed = np.fromiter((key_hash(key) for key in keys), dtype=np.uint64)
+        bloom = cls(np.zeros(max(len(hashed) * bits_per_key // 8, 8), dtype=np.uint8), len(hashed), hashes)
+        positions = bloom.__positions(hashed).ravel()
+        np.bitwise_or.at(bloom.bits, positions >> np.uint64(3),
+                         np.left_shift(1, positions & np.uint64(7)).astype(np.uint8))
+        return bloom
+
+    def __contains__(self, key):
+        h = key_hash(key)
+        h1, h2 = h & 0xFFFFFFFF, (h >> 32) | 1
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % self.bit_count
+            if not self.bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def write(self, path):
+        with open(path, 'wb') as f:
+            f.write(BLOOM_HEADER.pack(BLOOM_MAGIC, self.key_count, self.hashes, self.bit_count))
+            self.bits.tofile(f)
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            magic, key_count, hashes, bit_count = BLOOM_HEADER.unpack(f.read(BLOOM_HEADER.size))
+            if magic != BLOOM_MAGIC:
+                raise ValueError(f"{path} is not a Bloom filter")
+            bits = np.fromfile(f, dtype=np.uint8, count=bit_count // 8)
+        return cls(bits, key_count, hashes)
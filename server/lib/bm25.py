@@ -0,0 +1,48 @@
+import numpy as np
+
+# BM25 parameters
+k1 = 1.5  # Term frequency saturation parameter
+b = 0.8   # Length normalization parameter
+
+# Section weights
+TITLE_WEIGHT = 1.1
+KEYWORDS_WEIGHT = 0.25
+ABSTRACT_WEIGHT = 0.2
+
+
+def weighted_frequency(frequency):
+    """Section-weighted term frequency of a [title, abstract, keywords] triple"""
+    return (
+        frequency[0] * TITLE_WEIGHT +
+        frequency[1] * ABSTRACT_WEIGHT +
+        frequency[2] * KEYWORDS_WEIGHT
+    )
+
+
+def tf_score(f, doc_length, avg_doc_length):
+    """BM25 term frequency component, to be multiplied by the idf"""
+    numerator = f * (k1 + 1)
+    denominator = f + k1 * (1 - b + b * (doc_length / avg_doc_length))
+    return numerator / denominator
+
+
+def max_tf_score(frequencies, lengths, avg_doc_length):
+    """Upper bound of tf_score over a posting list, used to prune top-k retrieval"""
+    if not avg_doc_length:
+        # tf_score never reaches k1 + 1
+        return k1 + 1
+    return max((tf_score(weighted_frequency(frequency), length or avg_doc_length, avg_doc_length)
+                for frequency, length in zip(frequencies, lengths)), default=0.0)
+
+
+def tf_scores(frequencies, lengths, avg_doc_length):
+    """Vectorised tf_score over a (n, 3) frequency array and its document lengths"""
+    frequencies = frequencies.astype(np.float64)
+    f = (
+        frequencies[:, 0] * TITLE_WEIGHT +
+        frequencies[:, 1] * ABSTRACT_WEIGHT +
+        frequencies[:, 2] * KEYWORDS_WEIGHT
+    )
+    # a missing length (0) falls back to the average like the scalar path
+    lengths = np.where(lengths > 0, lengths, avg_doc_length).astype(np.float64)
+    return f * (k1 + 1) / (f + k1 * (1 - b + b * (lengths / avg_doc_length)))
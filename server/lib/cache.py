@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+
+# default memory budget of the postings cache
+POSTINGS_CACHE_BYTES = 64 * 1024 * 1024
+
+
+class PostingsCache:
+    """LRU cache of postings blocks keyed by word id, bounded by a byte budget."""
+
+    def __init__(self, max_bytes=POSTINGS_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def entry_size(blocks):
+        return sum(block.nbytes for block in blocks)
+
+    def get(self, word_id):
+        """Return the cached blocks of a term, or None on a miss."""
+        word_id = str(word_id)
+        with self.lock:
+            entry = self.entries.get(word_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(word_id)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, word_id, blocks):
+        """Cache the blocks of a term, evicting the least recently used terms to stay in budget."""
+        word_id = str(word_id)
+        size = self.entry_size(blocks)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if word_id in self.entries:
+                self.size -= self.entries.pop(word_id)[1]
+            while self.entries and self.size + size > self.max_bytes:
+                _, (_, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+            self.entries[word_id] = (blocks, size)
+            self.size += size
+
+    def invalidate(self, word_id):
+        with self.lock:
+            entry = self.entries.pop(str(word_id), None)
+            if entry is not None:
+                self.size -= entry[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes
+            }
+
+
+# shared by every Barrels instance in the process
+postings_cache = PostingsCache()
+
+
+# default memory budget of the docstore block cache
+DOCSTORE_CACHE_BYTES = 16 * 1024 * 1024
+
+
+class DocstoreCache(PostingsCache):
+    """LRU cache of the decoded columns of docstore blocks keyed by block, bounded by a byte budget."""
+
+    def __init__(self, max_bytes=DOCSTORE_CACHE_BYTES):
+        super().__init__(max_bytes)
+
+    @staticmethod
+    def entry_size(columns):
+        # ordinals without a row are nulls
+        return sum(len(value) for values in columns.values() for value in values if value is not None)
+
+
+# shared by every DocStore instance in the process
+docstore_cache = DocstoreCache()
+
+
+# default memory budget of the decoded position blocks
+POSITIONS_CACHE_BYTES = 16 * 1024 * 1024
+
+
+class PositionsCache(PostingsCache):
+    """
+    LRU cache of the position counts and decoded positions of binary postings
+    blocks, bounded by a byte budget of its own; the postings cache charges a
+    term a fixed size, so nothing decoded later may live in its entries.
+    """
+
+    def __init__(self, max_bytes=POSITIONS_CACHE_BYTES):
+        super().__init__(max_bytes)
+
+    @staticmethod
+    def entry_size(arrays):
+        return sum(array.nbytes for array in arrays)
+
+
+# shared by every CompressedPostings in the process
+positions_cache = PositionsCache()
@@ -0,0 +1,197 @@
+import numpy as np
+
+# Compressed posting lists
+#
+# A posting list is cut into blocks of BLOCK_SIZE postings and stored as
+#   skips      u4[n_blocks, 3]   last ordinal, end of meta bytes, end of position bytes
+#   meta       per block: doc ordinal deltas, frequencies (3 per posting), lengths, position counts
+#   positions  per block: positions of each posting, the first absolute and the rest as deltas
+# Every value in meta and positions is variable-byte encoded: 7 bits per byte,
+# low bits first, with the high bit set on the last byte of a value.
+# The skip table lets a reader find the blocks that may hold given ordinals and
+# decode only their meta and positions, or decode the meta of the whole list in
+# one pass. The last ordinal of a block is also the base of the next block's deltas.
+BLOCK_SIZE = 128
+SKIP_FIELDS = 3
+
+
+def encode_varbyte(values):
+    """Variable-byte encode a sequence of non-negative integers"""
+    values = np.asarray(values, dtype=np.int64)
+    counts = np.ones(len(values), dtype=np.int64)
+    rest = values >> 7
+    while rest.any():
+        counts += rest > 0
+        rest >>= 7
+
+    out = np.zeros(int(counts.sum()), dtype=np.uint8)
+    starts = np.cumsum(counts) - counts
+    for k in range(int(counts.max(initial=0))):
+        mask = counts > k
+        out[starts[mask] + k] = (values[mask] >> (7 * k)) & 0x7F
+    out[starts + counts - 1] |= 0x80
+    return out.tobytes()
+
+
+def decode_varbyte(data):
+    """Decode a buffer of variable-byte encoded integers into an int64 array"""
+    data = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(data & 0x80)
+    if len(ends) == 0:
+        return np.zeros(0, dtype=np.int64)
+    starts = np.empty_like(ends)
+    starts[0] = 0
+    starts[1:] = ends[:-1] + 1
+    group = np.repeat(np.arange(len(ends)), ends - starts + 1)
+    shifts = (np.arange(len(data)) - starts[group]) * 7
+    return np.add.reduceat((data & 0x7F).astype(np.int64) << shifts, starts)
+
+
+def segmented_cumsum(values, counts):
+    """Prefix sums that restart at every segment, segment sizes given by counts"""
+    if len(values) == 0:
+        return values
+    totals = np.cumsum(values)
+    ends = np.cumsum(counts)
+    starts = ends - counts
+    # subtract the running total reached before each segment begins
+    before = np.where(starts > 0, totals[np.maximum(starts - 1, 0)], 0)
+    return totals - np.repeat(before, counts)
+
+
+class PostingsEncoder:
+    """
+    Encode one posting list a block at a time, so a list too large to hold
+    decoded can be fed in chunks. Postings must come in increasing ordinal order.
+    """
+
+    def __init__(self):
+        self.df = 0
+        self.last_ordinal = 0
+        self.skips, self.meta, self.position_data = [], [], []
+        self.meta_size = self.position_size = 0
+        # postings waiting for a full block
+        self.pending = ([], [], [], [])
+
+    def add(self, ordinals, frequencies, lengths, positions):
+        """Add postings: ordinals, [title, abstract, keywords] triples, lengths and position lists"""
+        for column, values in zip(self.pending, (ordinals, frequencies, lengths, positions)):
+            column.extend(values)
+        while len(self.pending[0]) >= BLOCK_SIZE:
+            self.__encode_block(BLOCK_SIZE)
+
+    def finish(self):
+        """Encoded bytes of the whole list"""
+        if self.pending[0]:
+            self.__encode_block(len(self.pending[0]))
+        return (np.array(self.skips, dtype='<u4').tobytes() + b"".join(self.meta) + b"".join(self.position_data))
+
+    def __encode_block(self, n):
+        ordinals, frequencies, lengths, positions = (column[:n] for column in self.pending)
+        for column in self.pending:
+            del column[:n]
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        deltas = np.diff(ordinals, prepend=self.last_ordinal)
+        if (deltas < 0).any():
+            raise ValueError("postings must be added in increasing ordinal order")
+        block_positions = [sorted(p) for p in positions]
+        counts = [len(p) for p in block_positions]
+
+        block_meta = encode_varbyte(np.concatenate([
+            deltas,
+            np.asarray(frequencies, dtype=np.int64).reshape(-1),
+            np.asarray(lengths, dtype=np.int64),
+            np.asarray(counts, dtype=np.int64),
+        ]))
+        block_position_data = encode_varbyte(np.concatenate(
+            [np.diff(p, prepend=0) for p in block_positions] + [np.zeros(0, dtype=np.int64)]))
+
+        self.meta.append(block_meta)
+        self.position_data.append(block_position_data)
+        self.meta_size += len(block_meta)
+        self.position_size += len(block_position_data)
+        self.last_ordinal = int(ordinals[-1])
+        self.df += n
+        self.skips.append((self.last_ordinal, self.meta_size, self.position_size))
+
+
+def encode_postings(ordinals, frequencies, lengths, positions):
+    """
+    Encode one posting list. ordinals must be sorted, frequencies is a list of
+    [title, abstract, keywords] triples and positions a list of position lists.
+    """
+    encoder = PostingsEncoder()
+    encoder.add(np.asarray(ordinals, dtype=np.int64).tolist(), frequencies, lengths, positions)
+    return encoder.finish()
+
+
+class EncodedPostings:
+    """Reader over one encoded posting list"""
+
+    def __init__(self, data, df):
+        self.data = data
+        self.df = df
+        self.n_blocks = (df + BLOCK_SIZE - 1) // BLOCK_SIZE
+        skip_size = self.n_blocks * SKIP_FIELDS * 4
+        self.skips = np.frombuffer(data, dtype='<u4', count=self.n_blocks * SKIP_FIELDS).reshape(-1, SKIP_FIELDS)
+        meta_end = int(self.skips[-1, 1]) if self.n_blocks else 0
+        self.meta = data[skip_size:skip_size + meta_end]
+        self.position_data = data[skip_size + meta_end:]
+
+    def block_bounds(self, block):
+        return block * BLOCK_SIZE, min((block + 1) * BLOCK_SIZE, self.df)
+
+    def decode_meta(self):
+        """Decode doc ordinals, frequencies, lengths and position counts of the whole list"""
+        values = decode_varbyte(self.meta)
+        deltas, frequencies, lengths, counts = [], [], [], []
+        offset = 0
+        for block in range(self.n_blocks):
+            start, end = self.block_bounds(block)
+            n = end - start
+            deltas.append(values[offset:offset + n])
+            frequencies.append(values[offset + n:offset + 4 * n])
+            lengths.append(values[offset + 4 * n:offset + 5 * n])
+            counts.append(values[offset + 5 * n:offset + 6 * n])
+            offset += 6 * n
+        if not self.n_blocks:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty.reshape(-1, 3), empty, empty
+        return (np.cumsum(np.concatenate(deltas)),
+                np.concatenate(frequencies).reshape(-1, 3),
+                np.concatenate(lengths),
+                np.concatenate(counts))
+
+    def decode_blocks(self, blocks):
+        """Decode doc ordinals, frequencies, lengths and position counts of the given sorted blocks"""
+        blocks = np.asarray(blocks, dtype=np.int64)
+        meta_ends = self.skips[:, 1].astype(np.int64)
+        meta_starts = np.concatenate(([0], meta_ends[:-1]))
+        values = decode_varbyte(b"".join(self.meta[meta_starts[block]:meta_ends[block]] for block in blocks.tolist()))
+        sizes = np.minimum((blocks + 1) * BLOCK_SIZE, self.df) - blocks * BLOCK_SIZE
+        deltas, frequencies, lengths, counts = [], [], [], []
+        offset = 0
+        for n in sizes.tolist():
+            deltas.append(values[offset:offset + n])
+            frequencies.append(values[offset + n:offset + 4 * n])
+            lengths.append(values[offset + 4 * n:offset + 5 * n])
+            counts.append(values[offset + 5 * n:offset + 6 * n])
+            offset += 6 * n
+        if not len(blocks):
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty.reshape(-1, 3), empty, empty
+        bases = np.where(blocks > 0, self.skips[np.maximum(blocks - 1, 0), 0].astype(np.int64), 0)
+        ordinals = segmented_cumsum(np.concatenate(deltas), sizes) + np.repeat(bases, sizes)
+        return ordinals, np.concatenate(frequencies).reshape(-1, 3), np.concatenate(lengths), np.concatenate(counts)
+
+    def decode_positions(self, block, counts):
+        """Decode the positions of one block, given the position counts of its postings"""
+        start = int(self.skips[block - 1, 2]) if block else 0
+        end = int(self.skips[block, 2])
+        values = decode_varbyte(self.position_data[start:end])
+        return segmented_cumsum(values, counts)
+
+    def find_blocks(self, ordinals):
+        """Sorted indexes of the blocks that may hold any of the given ordinals, using the skip table"""
+        blocks = np.unique(np.searchsorted(self.skips[:, 0], ordinals))
+        return blocks[blocks < self.n_blocks]
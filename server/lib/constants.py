@@ -4,7 +4,7 @@ LEXICON_PATH = 'server/data/lexicon.json'
 INVERTED_INDEX_PATH = 'server/data/inverted_index.json'
 FORWARD_INDEX_PATH = 'server/data/forward_index.json'
 METADATA_PATH='server/data/metadata.json'
-DOCUMENT_INDEX_PATH='server/data/document_index.json'
+DOCUMENT_INDEX_PATH='server/data/document_index.bin'
 
 # dataset path
 DATASET_PATH = 'server/data/preprocessed_test_100k.csv'
@@ -0,0 +1,17 @@
+import json
+import os
+
+
+def fsync_path(path):
+    """Flush what was written to a file out to disk"""
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def dump_json(data, path, **kwargs):
+    """Write JSON next to path and swap it in once on disk, so a crash leaves the old file or the new one"""
+    with open(path + '.tmp', 'w') as f:
+        json.dump(data, f, **kwargs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
@@ -0,0 +1,45 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+_process_pools = {}
+_process_pools_lock = threading.Lock()
+
+
+def ordered_map(executor, fn, jobs, window):
+    """
+    Results of fn(*args) for the argument tuples in jobs, in order, submitting
+    to the executor lazily so at most window jobs are in flight.
+    """
+    pending = deque()
+    for args in jobs:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def process_pool(workers):
+    """
+    A process pool of the given size, kept for the life of the process. Its
+    workers all fork when it is first asked for, so ask at startup, before the
+    server has request threads; spawned workers would import the whole app.
+    """
+    with _process_pools_lock:
+        pool = _process_pools.get(workers)
+        if pool is None:
+            pool = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+            # a fork pool starts every worker on its first job
+            pool.submit(int).result()
+            _process_pools[workers] = pool
+        return pool
+
+
+def discard_process_pool(workers):
+    """Drop a pool left broken by a dead worker, the next process_pool makes a new one"""
+    with _process_pools_lock:
+        pool = _process_pools.pop(workers, None)
+    if pool is not None:
+        pool.shutdown(wait=False)
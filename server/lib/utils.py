@@ -2,6 +2,7 @@ import pandas as pd
 from nltk.corpus import stopwords
 from nltk.stem import PorterStemmer, WordNetLemmatizer
 import re
+from functools import lru_cache
 import nltk
 from nltk.tokenize import word_tokenize
 from contractions import fix 
@@ -15,6 +16,9 @@ stop_words = set(stopwords.words('english'))
 stemmer = PorterStemmer()
 lemmatizer = WordNetLemmatizer()
 
+# distinct tokens remembered by the lemmatizer cache, per process
+LEMMA_CACHE_SIZE = 500000
+
 def handle_contractions(text):
     return fix(text)  # Expands contractions like "don't" -> "do not"
 
@@ -41,8 +45,13 @@ def remove_stopwords(tokens):
 def correct_spelling(tokens):
     return [spell(word) for word in tokens]  # Correct spelling of each word
 
+@lru_cache(maxsize=LEMMA_CACHE_SIZE)
+def lemmatize(word):
+    # the corpus repeats a few hundred thousand distinct tokens, so WordNet is asked once for each
+    return lemmatizer.lemmatize(word)
+
 def lemmatize_tokens(tokens):
-    return [lemmatizer.lemmatize(word) for word in tokens]  # Apply lemmatization to tokens
+    return [lemmatize(word) for word in tokens]  # Apply lemmatization to tokens
 
 def preprocess_text(text):
     # Clean text first
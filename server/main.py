@@ -1,44 +1,79 @@
-import pandas as pd 
+import time
+import pandas as pd
 import numpy as np
 
+# rows cleaned at a time, so the whole dump never has to fit in memory
+CLEAN_CHUNK_ROWS = 50000
+
+
+class SeenIds:
+    """
+    Ids seen so far, kept as a sorted array of their 64-bit hashes: about 8 bytes
+    an id, and exact unless two distinct ids collide, which for 5M ids is a
+    chance of about one in a million.
+    """
+
+    def __init__(self):
+        self.hashes = np.zeros(0, dtype=np.uint64)
+
+    def add(self, ids):
+        """Add a series of ids, returning a mask of the ones not seen before, first occurrences only"""
+        hashes = pd.util.hash_pandas_object(ids, index=False).to_numpy()
+        first = ~pd.Series(hashes).duplicated().to_numpy()
+        positions = np.searchsorted(self.hashes, hashes)
+        seen = positions < len(self.hashes)
+        seen[seen] = self.hashes[positions[seen]] == hashes[seen]
+        new = first & ~seen
+
+        added = np.sort(hashes[new])
+        self.hashes = np.insert(self.hashes, np.searchsorted(self.hashes, added), added)
+        return new
+
+
 # This is a test which file contains the code for cleaning the ENTIRE dataset
 # It reads the large CSV file, extracts the relevant columns, and saves the cleaned data to a new CSV file
-def process_dataset(file_path, output_csv, nrows=None):
+def process_dataset(file_path, output_csv, nrows=None, chunksize=CLEAN_CHUNK_ROWS):
     try:
-        # specify the columns to extract
+        start = time.time()
+        rows_read = 0
+        rows_written = 0
+        seen_ids = SeenIds()
+
+        # specify the columns to extract, as text so every chunk is written back the same way
         columns_to_extract = ['id', 'title', 'abstract','venue', 'keywords', 'year', 'n_citation', 'url']
-        df = pd.read_csv(file_path, sep='|', usecols=columns_to_extract, nrows=nrows)
+        chunks = pd.read_csv(file_path, sep='|', usecols=columns_to_extract, nrows=nrows, dtype=str, chunksize=chunksize)
+
+        for chunk_number, df in enumerate(chunks):
+            rows_read += len(df)
 
-        # drop rows with duplicate ids
-        df = df.drop_duplicates(subset=['id'])
+            # drop rows with duplicate ids, in this chunk or any earlier one
+            df = df[seen_ids.add(df['id'])]
 
-        df = df[df['abstract'].str.len() > 100]
+            df = df[df['abstract'].str.len() > 100]
 
-        # convert empty arrays in 'keywords' to NaN (or another method of handling empty arrays)
-        df['keywords'] = df['keywords'].apply(lambda x: np.nan if x == '[]' else x)
-        df["url"] = df["url"].apply(lambda x: np.nan if x == '[]' else x)
+            # convert empty arrays in 'keywords' to NaN (or another method of handling empty arrays)
+            df = df.replace({'keywords': {'[]': np.nan}, 'url': {'[]': np.nan}, 'venue': {'{}': np.nan}})
 
-        df['venue'] = df['venue'].apply(lambda x: np.nan if x == '{}' else x)
+            # drop rows with any null values in the specified columns
+            df_cleaned = df.dropna()
 
-        # drop rows with any null values in the specified columns
-        df_cleaned = df.dropna()
+            # Ensure each document is on a single line
+            df_cleaned = df_cleaned.replace(r'[\r\n]', ' ', regex=True)
 
-        # Ensure each document is on a single line
-        df_cleaned = df_cleaned.applymap(lambda x: str(x).replace('\r', ' ').replace('\n', ' '))
+            # append the cleaned chunk to the new CSV file, the header with the first chunk
+            df_cleaned.to_csv(output_csv, mode='w' if chunk_number == 0 else 'a', header=chunk_number == 0, index=False)
+            rows_written += len(df_cleaned)
 
-        # display the first few rows of the cleaned data to verify
-        print(df_cleaned.head())
-        
-        # save the cleaned data to a new CSV file
-        df_cleaned.to_csv(output_csv, index=False)
+            elapsed = time.time() - start
+            print(f"{rows_read} rows read, {rows_written} kept, {rows_read / elapsed:.0f} rows/s")
 
         print(f"Extracted data saved to {output_csv}")
-        print(f"Number of rows extracted: {len(df_cleaned)}")
+        print(f"Number of rows extracted: {rows_written} of {rows_read} in {time.time() - start:.2f} seconds")
     except Exception as e:
         print(f"An error occurred: {e}")
 
 # Specify paths in a variable
 if __name__ == "__main__":
-    input_file = "data/dblp-citation-network-v14.csv"  
-    output_file = "data/test_100k.csv"     
+    input_file = "data/dblp-citation-network-v14.csv"
+    output_file = "data/test_100k.csv"
     process_dataset(input_file, output_file, 250000)
@@ -5,6 +5,10 @@ from server.entities.lexicon import Lexicon
 from server.entities.forwardindex import ForwardIndex
 from server.entities.invertindex import InvertedIndex
 from server.entities.barrels import Barrels
+from server.entities.docindex import DocumentIndex
+from server.entities.parallelbuild import ParallelIndexBuilder
+from server.entities.segments import SegmentIndex
+import sys
 import time
 
 # Specify paths in a variable
@@ -17,28 +21,52 @@ import time
 # end = time.time()
 # print(f"data processed i {end-start}")
 
-start = time.time()
-lexicon = Lexicon()
-lexicon.build()
-end = time.time()
-print(f"lexicon built in {end-start}")
+# worker processes import this module, so the build only runs when it is executed
+if __name__ == "__main__":
+    # documents added since the last build are dropped with the doc map they were numbered in
+    SegmentIndex.reset()
 
-start = time.time()
-forward_index = ForwardIndex(load=False)
-forward_index.build()
-end = time.time()
-print(f"forward index built in {end-start}")
+    if "--parallel" in sys.argv:
+        # sharded build of everything but the document index, on every core
+        start = time.time()
+        ParallelIndexBuilder().build()
+        end = time.time()
+        print(f"indexes built in {end-start}")
+    else:
+        start = time.time()
+        lexicon = Lexicon()
+        lexicon.build()
+        end = time.time()
+        print(f"lexicon built in {end-start}")
 
-start = time.time()
-inverted_index = InvertedIndex(load=False)
-inverted_index.build()
-end = time.time()
-print(f"invert index built in {end-start}")
+        start = time.time()
+        forward_index = ForwardIndex(load=False)
+        forward_index.build()
+        end = time.time()
+        print(f"forward index built in {end-start}")
 
-start = time.time()
-barrels = Barrels()
-barrels.build()
-end = time.time()
-print(f"barrels built in {end-start}")
+        if "--external" in sys.argv:
+            # spill sorted runs within a memory budget, without writing inverted_index.json
+            start = time.time()
+            InvertedIndex(load=False).build_barrels()
+            end = time.time()
+            print(f"barrels built in {end-start}")
+        else:
+            start = time.time()
+            inverted_index = InvertedIndex(load=False)
+            inverted_index.build()
+            end = time.time()
+            print(f"invert index built in {end-start}")
 
+            start = time.time()
+            barrels = Barrels()
+            barrels.build_barrels(binary=True)
+            end = time.time()
+            print(f"barrels built in {end-start}")
 
+    # the document index is keyed by the doc ordinals assigned by the forward index
+    start = time.time()
+    with DocumentIndex() as document_index:
+        document_index.build_index()
+    end = time.time()
+    print(f"document index built in {end-start}")
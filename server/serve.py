@@ -0,0 +1,53 @@
+import json
+import threading
+from server.app import app
+
+# Production serving: the Flask app behind a threaded WSGI server, waitress when
+# it is installed and Werkzeug's threaded server otherwise. Every artifact is
+# opened when server.app is imported and every read path is safe to share
+# between threads. Run with: python -m server.serve
+SERVE_HOST = "0.0.0.0"
+SERVE_PORT = 5000
+SERVE_THREADS = 16
+
+# requests handled at once, the rest wait up to REQUEST_QUEUE_SECONDS and then get a 503
+MAX_CONCURRENT_REQUESTS = 32
+REQUEST_QUEUE_SECONDS = 5
+
+
+class ConcurrencyLimit:
+    """WSGI middleware letting at most limit requests into the app at a time"""
+
+    def __init__(self, app, limit=MAX_CONCURRENT_REQUESTS, queue_seconds=REQUEST_QUEUE_SECONDS):
+        self.app = app
+        self.slots = threading.BoundedSemaphore(limit)
+        self.queue_seconds = queue_seconds
+
+    def __call__(self, environ, start_response):
+        if not self.slots.acquire(timeout=self.queue_seconds):
+            body = json.dumps({"error": "Server busy, try again"}).encode()
+            start_response("503 Service Unavailable", [("Content-Type", "application/json"),
+                                                       ("Content-Length", str(len(body))),
+                                                       ("Retry-After", "1")])
+            return [body]
+        try:
+            # every route returns a complete JSON body, so the slot is held until it is built
+            response = self.app(environ, start_response)
+            try:
+                return [b"".join(response)]
+            finally:
+                if hasattr(response, "close"):
+                    response.close()
+        finally:
+            self.slots.release()
+
+
+if __name__ == "__main__":
+    wsgi_app = ConcurrencyLimit(app)
+    try:
+        from waitress import serve
+        serve(wsgi_app, host=SERVE_HOST, port=SERVE_PORT, threads=SERVE_THREADS)
+    except ImportError:
+        from werkzeug.serving import run_simple
+        print("waitress is not installed, serving with Werkzeug's threaded server")
+        run_simple(SERVE_HOST, SERVE_PORT, wsgi_app, threaded=True)
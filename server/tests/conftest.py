@@ -0,0 +1,129 @@
+import csv
+import io
+import os
+import random
+import shutil
+import uuid
+import pytest
+from server.entities.barrels import Barrels
+from server.entities.docindex import FIELDNAMES, DocumentIndex
+from server.entities.forwardindex import ForwardIndex
+from server.entities.invertindex import InvertedIndex
+from server.entities.lexicon import Lexicon
+from server.entities.searchindex import SearchIndex
+from server.lib.cache import docstore_cache, positions_cache, postings_cache
+
+CORPUS_DOCS = 300
+VOCAB_SIZE = 400
+# every DUPLICATE_EVERY-th document repeats the one before it, so scores tie
+DUPLICATE_EVERY = 20
+
+
+def corpus_words(rng, count):
+    # Zipf-like, so a few terms are in most documents and many in one or two
+    return " ".join(rng.choices([f"term{i}" for i in range(VOCAB_SIZE)],
+                                [1 / (i + 1) for i in range(VOCAB_SIZE)], k=count))
+
+
+def write_corpus(doc_count=CORPUS_DOCS, seed=0):
+    """Write test_100k.csv and its preprocessed twin under server/data of the working directory"""
+    rng = random.Random(seed)
+    rows = []
+    for i in range(doc_count):
+        if i % DUPLICATE_EVERY == 1:
+            text = {field: rows[-1][field] for field in ['title', 'abstract', 'keywords']}
+        else:
+            text = {"title": corpus_words(rng, rng.randint(3, 8)), "abstract": corpus_words(rng, rng.randint(20, 60)),
+                    "keywords": corpus_words(rng, 3)}
+        rows.append(dict(text, id=f"doc_{i:05d}", venue="{'raw': 'X'}", year=2000 + i % 20, n_citation=i % 7,
+                         url="[]", authors="[]", doc_type="Conference", references="[]"))
+    os.makedirs("server/data", exist_ok=True)
+    for path in ["server/data/test_100k.csv", "server/data/preprocessed_test_100k.csv"]:
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+def reset_shared_state(monkeypatch):
+    """Drop what the index classes share across instances, so the next ones open the working directory's files"""
+    monkeypatch.setattr(Lexicon, "_table", None)
+    monkeypatch.setattr(Lexicon, "_added", None)
+    monkeypatch.setattr(Barrels, "_binary_barrels", {})
+    for cache in (postings_cache, positions_cache, docstore_cache):
+        cache.clear()
+
+
+@pytest.fixture(scope="session")
+def built_index(tmp_path_factory):
+    """A small corpus built into binary barrels once per session"""
+    directory = tmp_path_factory.mktemp("index")
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.chdir(directory)
+        reset_shared_state(monkeypatch)
+        write_corpus()
+        Lexicon(load=False).build()
+        ForwardIndex(load=False).build()
+        InvertedIndex(load=False).build_barrels()
+        with DocumentIndex() as document_index:
+            document_index.build_index()
+    return directory
+
+
+def open_index(monkeypatch):
+    """A SearchIndex of the working directory's files, installed where the functions look for it"""
+    reset_shared_state(monkeypatch)
+    search_index = SearchIndex()
+    monkeypatch.setattr("server.entities.searchindex.search_index", search_index)
+    monkeypatch.setattr("server.functions.rank.search_index", search_index)
+    # replays the add log before anything reads the metadata, as opening the server does
+    return search_index.open(["segments"])
+
+
+@pytest.fixture
+def index(built_index, tmp_path, monkeypatch):
+    """A SearchIndex over a fresh copy of the built index"""
+    shutil.copytree(built_index / "server", tmp_path / "server")
+    monkeypatch.chdir(tmp_path)
+    search_index = open_index(monkeypatch)
+    yield search_index
+    search_index.close()
+
+
+def add_documents(index, texts):
+    """
+    Add documents given as preprocessed (title, abstract, keywords) text the
+    way AddContent does, without its NLTK pass, returning their ordinals.
+    """
+    doc_ids = [f"doc_{uuid.uuid4()}" for _ in texts]
+    rows = []
+    for doc_id, (title, abstract, keywords) in zip(doc_ids, texts):
+        row = io.StringIO()
+        csv.writer(row, lineterminator='\n').writerow([doc_id, title, keywords, "", 2024, "", "", abstract, "", "", ""])
+        rows.append(row.getvalue())
+    with index.write_lock:
+        first, offset = index.reserve([row.encode() for row in rows])
+        records = []
+        for ordinal, doc_id, sections, row in zip(range(first, first + len(texts)), doc_ids, texts, rows):
+            terms = {}
+            base_position = 0
+            for section_id, text in enumerate(sections):
+                for pos, word in enumerate(text.split(), base_position):
+                    index.lexicon.add_word(word, documents=int(word not in terms))
+                    terms.setdefault(word, ([0, 0, 0], []))
+                    terms[word][0][section_id] += 1
+                    terms[word][1].append(pos)
+                base_position += len(text.split())
+            records.append({"ordinal": ordinal, "length": len(sections[0].split()) + len(sections[1].split()),
+                            "terms": terms, "doc_id": doc_id, "offset": offset, "row": row})
+            offset += len(row.encode())
+        position = index.segments.log_documents(records)
+    index.apply_in_order(first, records, position)
+    return list(range(first, first + len(texts)))
+
+
+def corpus_texts(count, seed):
+    """Preprocessed texts for add_documents, words of the corpus and one new word each"""
+    rng = random.Random(seed)
+    return [(corpus_words(rng, 5) + f" fresh{seed}x{i}", corpus_words(rng, 30), corpus_words(rng, 2))
+            for i in range(count)]
@@ -0,0 +1,35 @@
+import os
+import pytest
+
+try:
+    from server.lib.analyzer import analyze_query
+    from server.lib.utils import preprocess_text
+except LookupError:
+    # the stopwords, Punkt and WordNet data are downloaded separately
+    pytest.skip("NLTK data is not installed", allow_module_level=True)
+
+DATASET_PATH = "server/data/test_100k.csv"
+DATASET_SAMPLE_ROWS = 5000
+
+SAMPLES = [
+    "", "   ", "This is a test", "Deep Learning for Natural Language Processing",
+    "We cannot, gonna/gotta wanna lemme gimme CANNOT.", "wanna", "d'ye more'n 'tis 'twas",
+    "Graph-based semi_supervised learning (GNNs) -- a survey!", "U.S.A. e.g. i.e. Dr. Smith's model",
+    "naïve Bayes, Schrödinger's équations, İstanbul, straße", "x² ½ 3.14 1,000 2nd-order",
+    "don't won't can't shouldn't y'all", "\"quoted\" `ticks` «guillemets» “curly” ‘single’",
+    "tabs\tand\nnewlines\r\nhere...", "a an the of in on at by", "networks' models’ users'",
+]
+
+
+@pytest.mark.parametrize("text", SAMPLES)
+def test_analyze_query_matches_preprocess_text(text):
+    assert analyze_query(text) == preprocess_text(text)
+
+
+@pytest.mark.skipif(not os.path.exists(DATASET_PATH), reason="no dataset")
+def test_analyze_query_matches_preprocess_text_on_dataset():
+    import pandas as pd
+    df = pd.read_csv(DATASET_PATH, usecols=['title', 'abstract'], nrows=DATASET_SAMPLE_ROWS)
+    texts = [text for column in ['title', 'abstract'] for text in df[column] if isinstance(text, str)]
+    mismatches = [text for text in texts if analyze_query(text) != preprocess_text(text)]
+    assert mismatches == []
@@ -0,0 +1,39 @@
+import random
+import numpy as np
+from server.functions.rank import calculate_bm25
+from server.lib.cache import positions_cache, postings_cache
+
+
+def held_bytes(value, seen=None):
+    """Bytes of the arrays reachable from value, each buffer counted once however many views share it"""
+    seen = set() if seen is None else seen
+    if isinstance(value, np.ndarray):
+        while isinstance(value.base, np.ndarray):
+            value = value.base
+        if id(value) in seen:
+            return 0
+        seen.add(id(value))
+        return value.nbytes
+    if isinstance(value, dict):
+        return sum(held_bytes(item, seen) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(held_bytes(item, seen) for item in value)
+    if hasattr(value, "__dict__"):
+        return held_bytes(vars(value), seen)
+    return 0
+
+
+def test_postings_cache_holds_its_budget_after_position_decoding(index, monkeypatch):
+    monkeypatch.setattr(postings_cache, "max_bytes", 48 * 1024)
+    monkeypatch.setattr(positions_cache, "max_bytes", 16 * 1024)
+    rng = random.Random(0)
+    terms = [f"term{i}" for i in range(40)]
+    for _ in range(200):
+        calculate_bm25(rng.sample(terms, rng.randint(1, 3)), 0, top_k=rng.choice([None, 10]))
+
+    # the proximity boost decoded positions, none of them into the cached postings
+    assert positions_cache.size > 0
+    assert postings_cache.size <= postings_cache.max_bytes
+    assert positions_cache.size <= positions_cache.max_bytes
+    for blocks, size in postings_cache.entries.values():
+        assert held_bytes(blocks) <= size
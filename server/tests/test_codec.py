@@ -0,0 +1,86 @@
+import numpy as np
+import pytest
+from server.entities.barrels import BinaryBarrel, CompressedPostings
+from server.lib.codec import BLOCK_SIZE, EncodedPostings, PostingsEncoder, decode_varbyte, encode_postings, encode_varbyte
+
+
+def random_postings(df, seed=0):
+    rng = np.random.default_rng(seed)
+    ordinals = np.sort(rng.choice(50 * df + 10, size=df, replace=False))
+    frequencies = rng.integers(0, 300, size=(df, 3))
+    lengths = rng.integers(0, 5000, size=df)
+    positions = [sorted(rng.choice(2000, size=rng.integers(0, 12), replace=False).tolist()) for _ in range(df)]
+    return ordinals, frequencies, lengths, positions
+
+
+def encoded(df, seed=0):
+    ordinals, frequencies, lengths, positions = random_postings(df, seed)
+    data = np.frombuffer(encode_postings(ordinals, frequencies.tolist(), lengths, positions), dtype=np.uint8)
+    return EncodedPostings(data, df), (ordinals, frequencies, lengths, positions)
+
+
+@pytest.mark.parametrize("values", [[], [0], [127, 128, 16383, 16384], [2 ** 32 - 1, 0, 1, 2 ** 40]])
+def test_varbyte_round_trip(values):
+    assert decode_varbyte(encode_varbyte(values)).tolist() == values
+
+
+@pytest.mark.parametrize("df", [0, 1, BLOCK_SIZE - 1, BLOCK_SIZE, BLOCK_SIZE + 1, 5 * BLOCK_SIZE + 17])
+def test_postings_round_trip(df):
+    postings, (ordinals, frequencies, lengths, positions) = encoded(df)
+    decoded_ordinals, decoded_frequencies, decoded_lengths, counts = postings.decode_meta()
+    assert decoded_ordinals.tolist() == ordinals.tolist()
+    assert decoded_frequencies.tolist() == frequencies.tolist()
+    assert decoded_lengths.tolist() == lengths.tolist()
+    assert counts.tolist() == [len(p) for p in positions]
+    for block in range(postings.n_blocks):
+        start, end = postings.block_bounds(block)
+        assert postings.decode_positions(block, counts[start:end]).tolist() == sum(positions[start:end], [])
+
+
+@pytest.mark.parametrize("blocks", [[], [0], [3], [1, 2, 5], [0, 1, 2, 3, 4, 5]])
+def test_decode_blocks_matches_whole_list(blocks):
+    postings, _ = encoded(5 * BLOCK_SIZE + 17)
+    whole = postings.decode_meta()
+    rows = np.concatenate([np.arange(*postings.block_bounds(block)) for block in blocks] + [np.zeros(0, dtype=int)])
+    for part, column in zip(postings.decode_blocks(blocks), whole):
+        assert part.tolist() == column[rows].tolist()
+
+
+def test_find_blocks_uses_skip_table():
+    postings, (ordinals, *_) = encoded(5 * BLOCK_SIZE + 17)
+    wanted = ordinals[[0, BLOCK_SIZE - 1, BLOCK_SIZE, 4 * BLOCK_SIZE + 3]]
+    assert postings.find_blocks(wanted).tolist() == [0, 1, 4]
+    assert postings.find_blocks([ordinals[-1] + 1]).tolist() == []
+
+
+def test_lazy_lookup_matches_decoded_lookup():
+    postings, (ordinals, _, _, positions) = encoded(5 * BLOCK_SIZE + 17, seed=1)
+    wanted = np.sort(np.concatenate([ordinals[::37], ordinals[::53] + 1]))
+    lazy = CompressedPostings(postings)
+    found, rows, frequencies, lengths = lazy.lookup(wanted)
+    assert lazy.meta is None
+    assert [positions[row] for row in rows.tolist()] == [lazy.get_positions(row) for row in rows.tolist()]
+    assert lazy.meta is None
+    expected = CompressedPostings(postings, postings.decode_meta()).lookup(wanted)
+    for value, expected_value in zip((found, rows, frequencies, lengths), expected):
+        assert value.tolist() == expected_value.tolist()
+    assert ordinals[rows].tolist() == wanted[found].tolist()
+
+
+def test_chunked_encoding_matches_whole_list():
+    ordinals, frequencies, lengths, positions = random_postings(3 * BLOCK_SIZE + 44, seed=2)
+    postings = [{"doc_id": o, "frequency": f, "positions": p, "doc_length": l}
+                for o, f, p, l in zip(ordinals.tolist(), frequencies.tolist(), positions, lengths.tolist())]
+    whole = BinaryBarrel.encode(postings, 100.0)
+    for size in (1, 50, BLOCK_SIZE, 1000):
+        chunks = [postings[start:start + size] for start in range(0, len(postings), size)]
+        assert BinaryBarrel.encode_chunks(chunks, 100.0) == whole
+    assert whole[0] == len(postings)
+    assert whole[2] == encode_postings(ordinals, frequencies.tolist(), lengths, positions)
+
+
+def test_encoder_rejects_unsorted_postings():
+    encoder = PostingsEncoder()
+    encoder.add([5, 3], [[1, 0, 0]] * 2, [10, 10], [[0], [0]])
+    with pytest.raises(ValueError):
+        encoder.finish()
@@ -0,0 +1,32 @@
+import pytest
+from server.entities.docmap import DocMap
+
+
+@pytest.fixture
+def doc_map_paths(tmp_path, monkeypatch):
+    monkeypatch.setattr(DocMap, "path", str(tmp_path / "doc_map.bin"))
+    monkeypatch.setattr(DocMap, "bloom_path", str(tmp_path / "doc_map_bloom.bin"))
+
+
+def test_extend_matches_reload(doc_map_paths):
+    DocMap.build([f"doc_{i}" for i in (5, 3, 9, 1)])
+    doc_map = DocMap()
+    assert doc_map.extend(["doc_new_a", "doc_new_b"]) == 4
+    assert doc_map.append("doc_new_c") == 6
+
+    reloaded = DocMap()
+    assert len(doc_map) == len(reloaded) == 7
+    assert doc_map.appended == reloaded.appended
+    assert doc_map.doc_ids(range(7)) == reloaded.doc_ids(range(7))
+    for ordinal, doc_id in enumerate(reloaded.doc_ids(range(7))):
+        assert doc_map.ordinal(doc_id) == ordinal
+    assert "doc_unknown" not in doc_map
+
+
+def test_extend_after_another_instance(doc_map_paths):
+    DocMap.build(["doc_a"])
+    first, second = DocMap(), DocMap()
+    first.extend(["doc_b"])
+    assert second.extend(["doc_c"]) == 2
+    assert second.doc_ids([0, 1, 2]) == ["doc_a", "doc_b", "doc_c"]
+    assert second.ordinal("doc_b") == 1
@@ -0,0 +1,29 @@
+import pytest
+from server.entities.docstore import DISPLAY_FIELDS, DOCSTORE_BLOCK_SIZE, DocStore
+
+
+@pytest.fixture
+def docstore_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(DocStore, "path", str(tmp_path / "docstore.bin"))
+
+
+def record(i):
+    return {field: f"{field} {i}" for field in DISPLAY_FIELDS}
+
+
+def test_missing_rows_read_as_none(docstore_path):
+    doc_count = DOCSTORE_BLOCK_SIZE + 3
+    records = [None if i in (1, DOCSTORE_BLOCK_SIZE) else record(i) for i in range(doc_count)]
+    DocStore.write(iter(records), doc_count)
+    store = DocStore()
+    assert store.get(list(range(doc_count)) + [doc_count], ["title", "year"]) == [
+        None if r is None else {"title": r["title"], "year": r["year"]} for r in records] + [None]
+
+
+def test_close_unmaps(docstore_path):
+    DocStore.write(iter([record(0)]), 1)
+    store = DocStore()
+    assert store.get([0], ["title"]) == [{"title": "title 0"}]
+    store.close()
+    assert store.mm is None
+    assert store.get([0], ["title"]) == [None]
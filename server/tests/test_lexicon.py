@@ -0,0 +1,61 @@
+import json
+import pandas as pd
+import pytest
+from server.entities.lexicon import Lexicon
+
+
+@pytest.fixture
+def lexicon_paths(tmp_path, monkeypatch):
+    for name in ["path", "added_path", "json_path", "preprocessed_path"]:
+        monkeypatch.setattr(Lexicon, name, str(tmp_path / getattr(Lexicon, name).rsplit("/", 1)[1]))
+    monkeypatch.setattr(Lexicon, "_table", None)
+    monkeypatch.setattr(Lexicon, "_added", None)
+    pd.DataFrame({"title": ["deep learning", "deep sea"], "abstract": ["learning learning", "fish"],
+                  "keywords": ["nets", "ocean"]}).to_csv(Lexicon.preprocessed_path, index=False)
+    return tmp_path
+
+
+def test_write_reloads_on_next_access(lexicon_paths):
+    Lexicon.write({"alpha": {"id": 0, "frequency": 3, "df": 2}})
+    lexicon = Lexicon()
+    Lexicon.write({"alpha": {"id": 0, "frequency": 3, "df": 2}, "beta": {"id": 1, "frequency": 1, "df": 1}})
+    assert lexicon["beta"] == {"id": 1, "frequency": 1, "df": 1}
+    assert len(lexicon) == 2
+
+
+def test_legacy_conversion_counts_df(lexicon_paths):
+    legacy = {"deep": {"id": 0, "frequency": 2}, "learning": {"id": 1, "frequency": 3},
+              "fish": {"id": 2, "frequency": 1}, "added": {"id": 3, "frequency": 4}}
+    with open(Lexicon.json_path, "w") as f:
+        json.dump(legacy, f)
+    lexicon = Lexicon()
+    assert lexicon["deep"] == {"id": 0, "frequency": 2, "df": 2}
+    assert lexicon["learning"] == {"id": 1, "frequency": 3, "df": 1}
+    assert lexicon["fish"]["df"] == 1
+    # not in the preprocessed documents, bounded by its occurrences
+    assert lexicon["added"]["df"] == 4
+
+
+def test_legacy_conversion_needs_the_documents(lexicon_paths):
+    with open(Lexicon.json_path, "w") as f:
+        json.dump({"deep": {"id": 0, "frequency": 2}}, f)
+    (lexicon_paths / "preprocessed_test_100k.csv").unlink()
+    with pytest.raises(Exception, match="rebuild the lexicon"):
+        Lexicon()
+
+
+def test_overlay_keeps_counted_through(lexicon_paths):
+    Lexicon.write({"alpha": {"id": 0, "frequency": 3, "df": 2}})
+    # an overlay saved before counted_through existed is the bare word dict
+    with open(Lexicon.added_path, "w") as f:
+        json.dump({"beta": {"id": 1, "frequency": 2, "df": 1}}, f)
+    lexicon = Lexicon()
+    assert lexicon["beta"]["id"] == 1
+    assert lexicon.counted_through() == -1
+
+    lexicon.add_word("gamma", documents=1)
+    lexicon.save(counted_through=7)
+    lexicon.save()
+    Lexicon._table = Lexicon._added = None
+    assert lexicon.counted_through() == 7
+    assert lexicon["gamma"] == {"id": 2, "frequency": 1, "df": 1}
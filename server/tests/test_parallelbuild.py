@@ -0,0 +1,43 @@
+import json
+import shutil
+import pytest
+from server.entities.lexicon import Lexicon
+from server.entities.parallelbuild import ParallelIndexBuilder
+from server.tests.conftest import open_index, reset_shared_state, write_corpus
+
+
+def read_index(monkeypatch):
+    """The lexicon file, forward index, metadata and every postings list of the working directory's index"""
+    with open(Lexicon.path, "rb") as f:
+        lexicon = f.read()
+    with open("server/data/forward_index.json") as f:
+        forward_index = json.load(f)
+    with open("server/data/metadata.json") as f:
+        metadata = json.load(f)
+    # the sharded build writes a barrel per term partition, so only their postings are compared
+    metadata.pop("last_barrel", None)
+    index = open_index(monkeypatch)
+    postings = {}
+    for word in index.lexicon:
+        blocks = index.postings(index.lexicon[word]["id"])
+        postings[word] = [(block.ordinals.tolist(), block.frequencies.tolist(), block.lengths.tolist(),
+                           [list(block.get_positions(i)) for i in range(len(block.ordinals))])
+                          for block in blocks]
+    index.close()
+    return lexicon, forward_index, metadata, postings
+
+
+@pytest.mark.parametrize("workers, shard_rows", [(2, 40), (3, 7), (1, 1000)])
+def test_sharded_build_matches_sequential(built_index, tmp_path, monkeypatch, workers, shard_rows):
+    # opening an index writes to it, so the shared one is read through a copy
+    shutil.copytree(built_index / "server", tmp_path / "sequential" / "server")
+    monkeypatch.chdir(tmp_path / "sequential")
+    sequential = read_index(monkeypatch)
+
+    (tmp_path / "sharded").mkdir()
+    monkeypatch.chdir(tmp_path / "sharded")
+    reset_shared_state(monkeypatch)
+    write_corpus()
+    ParallelIndexBuilder(workers=workers, shard_rows=shard_rows).build()
+    # ids follow first occurrence over the whole corpus, not shard by shard
+    assert read_index(monkeypatch) == sequential
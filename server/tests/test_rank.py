@@ -0,0 +1,43 @@
+import random
+import pytest
+from server.functions.rank import calculate_bm25
+from server.tests.conftest import VOCAB_SIZE
+
+
+def assert_top_k_matches(terms, k):
+    top_k = calculate_bm25(terms, 0, top_k=k)[0]
+    assert top_k == calculate_bm25(terms, 0)[0][:k]
+    return top_k
+
+
+@pytest.mark.parametrize("k", [1, 5, 10, 50])
+@pytest.mark.parametrize("terms", [
+    ["term0"],                          # in most documents
+    ["term150"],                        # in a few
+    ["term0", "term1"],
+    ["term0", "term1", "term2"],
+    ["term0", "term300"],               # a common term and a rare one
+    ["term3", "term3"],                 # a repeated term counts twice
+    ["term0", "missing", "term7"],      # a term the lexicon does not have
+])
+def test_top_k_matches_exhaustive(index, terms, k):
+    assert assert_top_k_matches(terms, k)
+
+
+@pytest.mark.parametrize("terms", [["missing"], ["missing", "absent"], []])
+def test_unknown_terms_rank_nothing(index, terms):
+    assert calculate_bm25(terms, 0, top_k=10)[0] == calculate_bm25(terms, 0)[0] == []
+
+
+def test_ties_break_by_ordinal(index):
+    # the corpus repeats documents, so some pairs of them score exactly the same
+    top_k = assert_top_k_matches(["term0", "term1"], 50)
+    scores = [score for _, score in top_k]
+    assert len(scores) != len(set(scores))
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_queries(index, seed):
+    rng = random.Random(seed)
+    terms = [f"term{int(rng.paretovariate(0.6)) % VOCAB_SIZE}" for _ in range(rng.randint(1, 4))]
+    assert_top_k_matches(terms, rng.choice([1, 3, 10, 30]))
@@ -0,0 +1,89 @@
+import time
+import server.entities.segments as segments_module
+from server.functions.rank import calculate_bm25
+from server.tests.conftest import add_documents, corpus_texts, open_index
+
+WORDS = ["term0", "term3", "term40", "term250", "fresh1x0", "fresh2x4", "fresh3x7"]
+QUERIES = [["term0"], ["term3", "term40"], ["fresh1x0", "term0"], ["fresh2x4"], ["term250", "fresh3x7", "term3"]]
+
+
+def merged_postings(index, word):
+    """Every posting of a word across the base barrels, the segments and memory, by doc ordinal"""
+    entry = index.lexicon.get(word)
+    if entry is None:
+        return []
+    postings = []
+    for block in index.postings(entry["id"]):
+        for i, (ordinal, frequency, length) in enumerate(zip(block.ordinals.tolist(), block.frequencies.tolist(),
+                                                              block.lengths.tolist())):
+            postings.append((ordinal, tuple(frequency), length, tuple(block.get_positions(i))))
+    return sorted(postings)
+
+
+def snapshot(index):
+    return ({word: merged_postings(index, word) for word in WORDS},
+            [calculate_bm25(query, 0)[0] for query in QUERIES],
+            [calculate_bm25(query, 0, top_k=10)[0] for query in QUERIES])
+
+
+def add_batches(index, seeds):
+    for seed in seeds:
+        add_documents(index, corpus_texts(15, seed))
+
+
+def test_flush_keeps_postings(index, monkeypatch):
+    add_batches(index, [1, 2])
+    before = snapshot(index)
+    assert index.segments.stats()["memory_docs"] == 30
+
+    index.checkpoint()
+    assert index.segments.stats()["segment_docs"] == [30]
+    assert snapshot(index) == before
+    assert snapshot(open_index(monkeypatch)) == before
+
+
+def test_postings_span_barrels_segments_and_memory(index, monkeypatch):
+    add_batches(index, [1])
+    index.checkpoint()
+    add_batches(index, [2])
+    index.checkpoint()
+    add_batches(index, [3])
+    # the base barrel, two segments and the in-memory segment
+    assert len(index.postings(index.lexicon["term0"]["id"])) == 4
+    before = snapshot(index)
+    ordinals = [ordinal for ordinal, *_ in before[0]["term0"]]
+    assert all(any(start <= ordinal < start + 15 for ordinal in ordinals) for start in (300, 315, 330))
+    assert snapshot(open_index(monkeypatch)) == before
+
+
+def test_merge_keeps_postings(index, monkeypatch):
+    for seed in [1, 2, 3]:
+        add_batches(index, [seed])
+        index.checkpoint()
+    before = snapshot(index)
+    segments = index.segments
+    assert segments.stats()["segment_docs"] == [15, 15, 15]
+
+    segments.merge(segments.segments[1:])
+    assert segments.stats()["segment_docs"] == [15, 30]
+    assert snapshot(index) == before
+    segments.merge(segments.segments)
+    assert segments.stats()["segment_docs"] == [45]
+    assert snapshot(index) == before
+    assert snapshot(open_index(monkeypatch)) == before
+
+
+def test_flush_merges_a_full_tier(index, monkeypatch):
+    monkeypatch.setattr(segments_module, "SEGMENT_MERGE_FACTOR", 2)
+    add_batches(index, [1])
+    index.checkpoint()
+    add_batches(index, [2])
+    before = snapshot(index)
+    # the second segment of the tier starts a background merge
+    index.checkpoint()
+    deadline = time.time() + 30
+    while index.segments.stats()["merging"] and time.time() < deadline:
+        time.sleep(0.05)
+    assert index.segments.stats()["segment_docs"] == [30]
+    assert snapshot(index) == before
+    assert snapshot(open_index(monkeypatch)) == before
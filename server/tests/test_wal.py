@@ -0,0 +1,82 @@
+import pytest
+from server.entities.segments import SegmentIndex
+from server.entities.wal import WriteAheadLog
+from server.functions.rank import calculate_bm25
+from server.tests.conftest import add_documents, corpus_texts, open_index
+
+
+def test_replay_drops_a_torn_tail(tmp_path):
+    path = str(tmp_path / "pending.jsonl")
+    log = WriteAheadLog(path)
+    log.sync(log.append([{"n": 0}, {"n": 1}]))
+    with open(path, "ab") as f:
+        f.write(b'{"n": 2, "cut sh')
+
+    log = WriteAheadLog(path)
+    assert log.replay() == [{"n": 0}, {"n": 1}]
+    # the torn record is gone, so the next one is read back whole
+    log.sync(log.append([{"n": 3}]))
+    assert WriteAheadLog(path).replay() == [{"n": 0}, {"n": 1}, {"n": 3}]
+
+
+def test_replay_after_truncate(tmp_path):
+    path = str(tmp_path / "pending.jsonl")
+    log = WriteAheadLog(path)
+    first = log.append([{"n": 0}])
+    log.truncate()
+    # what the truncate dropped needs no fsync
+    log.sync(first)
+    second = log.append([{"n": 1}])
+    assert second > first
+    log.sync(second)
+    assert WriteAheadLog(path).replay() == [{"n": 1}]
+
+
+def snapshot(index, texts):
+    """What a restart must bring back: the documents, the lexicon entries of their words and their rankings"""
+    words = sorted({word for sections in texts for text in sections for word in text.split()})
+    queries = [[f"fresh{seed}x{i}"] for seed in range(1, 4) for i in range(3)] + [["term0", "term5"], ["term2", "term40"]]
+    ordinals = list(range(len(index.doc_map)))
+    return (index.document_count, index.avg_doc_length, index.doc_map.doc_ids(ordinals),
+            [document and document["title"] for document in index.documents.get_documents(ordinals, fields=["title"])],
+            {word: index.lexicon.get(word) for word in words},
+            [calculate_bm25(query, 0)[0] for query in queries])
+
+
+def test_restart_replays_the_log(index, monkeypatch):
+    texts = corpus_texts(20, seed=1)
+    add_documents(index, texts)
+    before = snapshot(index, texts)
+    assert before[0] == 320
+    assert snapshot(open_index(monkeypatch), texts) == before
+
+
+def test_restart_after_checkpoint(index, monkeypatch):
+    texts = corpus_texts(20, seed=1) + corpus_texts(20, seed=2)
+    add_documents(index, texts[:20])
+    index.checkpoint()
+    add_documents(index, texts[20:])
+    before = snapshot(index, texts)
+    reopened = open_index(monkeypatch)
+    assert reopened.segments.stats()["segments"] == 1
+    assert snapshot(reopened, texts) == before
+
+
+def test_crash_before_the_manifest_counts_words_once(index, monkeypatch):
+    texts = corpus_texts(20, seed=3)
+    add_documents(index, texts)
+    before = snapshot(index, texts)
+
+    # the lexicon is saved, then the flush dies before the manifest moves past the log
+    save_manifest = SegmentIndex._SegmentIndex__save_manifest
+
+    def crash(segments):
+        raise OSError("crashed")
+    monkeypatch.setattr(SegmentIndex, "_SegmentIndex__save_manifest", crash)
+    with pytest.raises(OSError):
+        index.checkpoint()
+    monkeypatch.setattr(SegmentIndex, "_SegmentIndex__save_manifest", save_manifest)
+
+    reopened = open_index(monkeypatch)
+    assert reopened.segments.stats()["memory_docs"] == 20
+    assert snapshot(reopened, texts) == before